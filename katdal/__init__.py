@@ -319,6 +319,58 @@ def open(filename, ref_ant='', time_offset=0.0, **kwargs):
             partition data set even if real timestamps are irregular, thereby
             avoiding the slow loading of real timestamps at the cost of
             slightly inaccurate label borders
+        local_store_path : string, optional
+            [VisibilityDataV4] Look for chunks in an NPY file chunk store in
+            this directory first, before the chunk store of the dataset
+        promote : bool, optional
+            [VisibilityDataV4] Copy chunks retrieved from the chunk store of
+            the dataset to the local store as well (default True)
+        cache_dir : string, optional
+            [VisibilityDataV4] Keep a local on-disk cache of the chunks read
+            from the chunk store in this directory, for faster repeat access
+        cache_size : int or float, optional
+            [VisibilityDataV4] Upper limit on size of local chunk cache, in
+            bytes (default 10 GB, least recently used chunks are evicted)
+        memory_cache_size : int or float, optional
+            [VisibilityDataV4] Keep up to this many bytes of recently used
+            chunks in memory, which speeds up repeated overlapping selections
+        chunk_stats : bool, optional
+            [VisibilityDataV4] Count chunk requests, bytes, errors and retries
+            and histogram their latencies per array, in the `stats` attribute
+            of the chunk store (default False)
+        chunk_stats_interval : float, optional
+            [VisibilityDataV4] Also log the chunk store statistics at this
+            interval, in seconds
+        batch_size : int, optional
+            [VisibilityDataV4] Number of chunks retrieved concurrently by each
+            dask task from an S3 chunk store (default 1)
+        max_connections : int, optional
+            [VisibilityDataV4] Upper limit on the number of requests in flight
+            to an S3 chunk store (default 100)
+        range_reads : bool, optional
+            [VisibilityDataV4] Only retrieve the selected parts of chunks from
+            an S3 chunk store via HTTP range requests, which speeds up narrow
+            selections of uncorrected visibilities (default False)
+        hedge_percentile : float, optional
+            [VisibilityDataV4] Send a duplicate request to an S3 chunk store
+            for chunks that take longer than this percentile of recent
+            request latencies, and use whichever response arrives first
+        mmap : bool, optional
+            [VisibilityDataV4] Memory-map chunks in an NPY file chunk store
+            instead of reading them, so that only selected data is read
+        prefetch : bool, optional
+            [VisibilityDataV4] Advise the OS to read memory-mapped chunk files
+            into the page cache ahead of access (for repeated access)
+        applycal_cache : bool, optional
+            [VisibilityDataV4] Keep the applycal corrections in the local
+            chunk cache directory (`cache_dir`) and reuse them when the
+            dataset is opened again, until its cal solutions change
+        read_ahead : int, optional
+            [VisibilityDataV4] Number of blocks of dumps to read ahead in the
+            background while vis / weights / flags are read in time order
+        read_ahead_size : int or float, optional
+            [VisibilityDataV4] Upper limit on size of blocks read ahead, in
+            bytes (default 1 GB)
 
     Returns
     -------
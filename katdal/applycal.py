@@ -18,9 +18,13 @@
 from __future__ import print_function, division, absolute_import
 from builtins import range, zip
 
+import os
+import errno
 import logging
+import hashlib
 import itertools
 import operator
+from collections import OrderedDict
 
 import numpy as np
 import dask.array as da
@@ -32,6 +36,7 @@ import numba
 from .categorical import CategoricalData, ComparableArrayWrapper
 from .spectral_window import SpectralWindow
 from .flags import POSTPROC
+from .chunkstore import ChunkCache
 
 
 # A constant indicating invalid / absent gain (typically due to flagged data)
@@ -142,6 +147,220 @@ def from_block_function(func, shape, chunks='auto', dtype=None, name=None, **kwa
     return da.Array(dsk, name, chunks, dtype=dtype)
 
 
+@numba.jit(nopython=True, nogil=True)
+def _make_interp_plan(x, xi, index, step, offset, offset_next):
+    """Locate `x` among `xi`, following :func:`numpy.interp`.
+
+    The index of the data point at or below each x is stored in `index`,
+    with special values for x below (-1) or above (-2) all data points,
+    or NaN (-3). Points that coincide with data points keep a zero `step`.
+    """
+    n = len(xi)
+    j = 0
+    for i in range(len(x)):
+        xv = x[i]
+        # Like numpy.interp, a single data point is also used for NaN x-coordinates
+        if np.isnan(xv) and n > 1:
+            index[i] = -3
+        elif xv < xi[0]:
+            index[i] = -1
+        elif xv > xi[n - 1]:
+            index[i] = -2
+        else:
+            # The x-coordinates are typically sorted, so first look just beyond the previous one
+            if xi[j] > xv or (j + 8 < n and xi[j + 8] <= xv):
+                j = np.searchsorted(xi, xv, side='right') - 1
+            else:
+                while j + 1 < n and xi[j + 1] <= xv:
+                    j += 1
+            index[i] = j
+            if j < n - 1 and xi[j] != xv:
+                step[i] = xi[j + 1] - xi[j]
+                offset[i] = xv - xi[j]
+                offset_next[i] = xv - xi[j + 1]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _interp_value(y0, y1, step, offset, offset_next):
+    """Interpolate between data points `y0` and `y1` like :func:`numpy.interp`."""
+    slope = (y1 - y0) / step
+    result = slope * offset + y0
+    # This is numpy.interp's fallback for infinite values
+    if np.isnan(result):
+        result = slope * offset_next + y1
+        if np.isnan(result) and y0 == y1:
+            result = y0
+    return result
+
+
+@numba.jit(nopython=True, nogil=True)
+def _interp_with_plan(y, yi, index, step, offset, offset_next, left, right):
+    """Apply interpolation plan to columns of `yi`, following :func:`numpy.interp`."""
+    for i in range(y.shape[0]):
+        j = index[i]
+        for k in range(y.shape[1]):
+            if j == -1:
+                y[i, k] = left[k]
+            elif j == -2:
+                y[i, k] = right[k]
+            elif j == -3:
+                y[i, k] = np.nan
+            elif step[i] == 0:
+                y[i, k] = yi[j, k]
+            else:
+                y[i, k] = _interp_value(yi[j, k], yi[j + 1, k], step[i], offset[i], offset_next[i])
+
+
+@numba.jit(nopython=True, nogil=True)
+def _complex_reciprocal_with_plan(y, mag_i, phase_i, index, step, offset, offset_next,
+                                  mag_left, phase_left, mag_right, phase_right):
+    """Apply interpolation plan to magnitude and phase and return reciprocal.
+
+    Row `k` of `y` gets the reciprocal of the complex values whose magnitude
+    and phase are interpolated from row `k` of `mag_i` and `phase_i`.
+    """
+    for k in range(y.shape[0]):
+        y_k, mag_k, phase_k = y[k], mag_i[k], phase_i[k]
+        for i in range(y.shape[1]):
+            j = index[i]
+            if j >= 0 and step[i] != 0:
+                mag = _interp_value(mag_k[j], mag_k[j + 1], step[i], offset[i], offset_next[i])
+                phase = _interp_value(phase_k[j], phase_k[j + 1], step[i], offset[i], offset_next[i])
+            elif j >= 0:
+                mag = mag_k[j]
+                phase = phase_k[j]
+            elif j == -1:
+                mag = mag_left[k]
+                phase = phase_left[k]
+            elif j == -2:
+                mag = mag_right[k]
+                phase = phase_right[k]
+            else:
+                mag = phase = np.nan
+            # 1 / (mag * exp(j phase)) = exp(-j phase) / mag
+            inv_mag = 1.0 / mag
+            y_k[i] = complex(inv_mag * np.cos(phase), -inv_mag * np.sin(phase))
+
+
+class InterpolationPlan(object):
+    """Reusable plan for linear interpolation from points `xi` to points `x`.
+
+    This does the work of :func:`numpy.interp` that only depends on the
+    x-coordinates (finding the interval of `xi` containing each `x` and
+    the distances to its ends) once, so that the rest can be applied to
+    many sets of y-coordinates in a single pass. The results are identical
+    to those of :func:`numpy.interp`.
+
+    Parameters
+    ----------
+    x : 1-D sequence of float, length *M*
+        The x-coordinates at which to evaluate the interpolated values
+    xi : 1-D sequence of float, length *N*
+        The x-coordinates of the data points, must be sorted in ascending order
+    """
+    def __init__(self, x, xi):
+        self.shape = np.shape(x)
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        xi = np.asarray(xi, dtype=np.float64)
+        self.n_points = len(xi)
+        self._index = np.empty(len(x), np.int64)
+        self._step = np.zeros(len(x))
+        self._offset = np.zeros(len(x))
+        self._offset_next = np.zeros(len(x))
+        _make_interp_plan(x, xi, self._index, self._step, self._offset, self._offset_next)
+
+    def interp(self, yi, left=None, right=None):
+        """Interpolate real values `yi`, like :func:`numpy.interp`.
+
+        Parameters
+        ----------
+        yi : array of float, shape (*N*,) or (*N*, *K*)
+            The y-coordinates of the data points, with one set per column
+        left, right : float or array of float, shape (*K*,), optional
+            Values to return for `x < xi[0]` and `x > xi[-1]`, respectively,
+            with defaults `yi[0]` and `yi[-1]`
+
+        Returns
+        -------
+        y : array of float64, shape (*M*,) or (*M*, *K*)
+            The evaluated y-coordinates
+        """
+        columns, left, right = self._columns(yi, left, right)
+        y = np.empty((len(self._index), columns.shape[1]))
+        _interp_with_plan(y, columns, self._index, self._step, self._offset, self._offset_next,
+                          left, right)
+        return y.reshape(self.shape + np.shape(yi)[1:])
+
+    def _columns(self, yi, left, right):
+        """Turn `yi` into 2-D array of columns and `left` / `right` into one value per column."""
+        yi = np.asarray(yi, dtype=np.float64)
+        if len(yi) != self.n_points:
+            raise ValueError('Expected {} data points, got {}'.format(self.n_points, len(yi)))
+        columns = np.ascontiguousarray(yi.reshape(self.n_points, -1))
+        n_columns = columns.shape[1]
+        left = np.array(np.broadcast_to(columns[0] if left is None else left, (n_columns,)),
+                        dtype=np.float64)
+        right = np.array(np.broadcast_to(columns[-1] if right is None else right, (n_columns,)),
+                         dtype=np.float64)
+        return columns, left, right
+
+    @staticmethod
+    def _magnitude_and_phase(yi, left, right):
+        """Split complex `yi`, `left` and `right` into magnitude and unwrapped phase."""
+        mag_i = np.abs(yi)
+        phase_i = np.unwrap(np.angle(yi), axis=0)
+        mag_left = phase_left = mag_right = phase_right = None
+        if left is not None:
+            mag_left = np.abs(left)
+            phase_left = np.unwrap(np.broadcast_arrays(phase_i[0], np.angle(left)), axis=0)[1]
+        if right is not None:
+            mag_right = np.abs(right)
+            phase_right = np.unwrap(np.broadcast_arrays(phase_i[-1], np.angle(right)), axis=0)[1]
+        return (mag_i, mag_left, mag_right), (phase_i, phase_left, phase_right)
+
+    def complex_interp(self, yi, left=None, right=None):
+        """Interpolate complex values `yi` in magnitude and phase.
+
+        See :func:`complex_interp` for details. Each column of a 2-D `yi`
+        is interpolated separately, with `left` and `right` either shared
+        by all columns or given per column.
+        """
+        yi = np.asarray(yi)
+        mag, phase = self._magnitude_and_phase(yi, left, right)
+        # Interpolate magnitude and phase separately, and reassemble
+        mag = self.interp(*mag)
+        phase = self.interp(*phase)
+        y = np.empty_like(phase, dtype=np.complex128)
+        np.cos(phase, out=y.real)
+        np.sin(phase, out=y.imag)
+        y *= mag
+        return y.astype(yi.dtype)
+
+    def complex_reciprocal(self, yi, left=None, right=None):
+        """Reciprocal of :meth:`complex_interp`, i.e. correction for gains `yi`.
+
+        This interpolates magnitude and phase, reassembles the complex values
+        and takes their reciprocal in a single pass over all columns, without
+        intermediate arrays. The result matches ``np.reciprocal(complex_interp(
+        yi, left, right))`` to within the precision of `yi`, but not bit for bit.
+
+        Returns
+        -------
+        y : array of complex, shape (*M*,) or (*M*, *K*)
+            The reciprocal of the interpolated values, with the same dtype as
+            `yi`, as a transposed view so that each column is contiguous
+        """
+        yi = np.asarray(yi)
+        mag, phase = self._magnitude_and_phase(yi, left, right)
+        mag_i, mag_left, mag_right = self._columns(*mag)
+        phase_i, phase_left, phase_right = self._columns(*phase)
+        y = np.empty((mag_i.shape[1], len(self._index)), yi.dtype)
+        _complex_reciprocal_with_plan(y, np.ascontiguousarray(mag_i.T), np.ascontiguousarray(phase_i.T),
+                                      self._index, self._step, self._offset, self._offset_next,
+                                      mag_left, phase_left, mag_right, phase_right)
+        return y.T.reshape(self.shape + yi.shape[1:])
+
+
 def complex_interp(x, xi, yi, left=None, right=None):
     """Piecewise linear interpolation of magnitude and phase of complex values.
 
@@ -171,25 +390,7 @@ def complex_interp(x, xi, yi, left=None, right=None):
     y : array of complex, length *M*
         The evaluated y-coordinates, same length as `x` and same dtype as `yi`
     """
-    # Extract magnitude and unwrapped phase
-    mag_i = np.abs(yi)
-    phase_i = np.unwrap(np.angle(yi))
-    # Prepare left and right interpolation extensions
-    mag_left = phase_left = mag_right = phase_right = None
-    if left is not None:
-        mag_left = np.abs(left)
-        phase_left = np.unwrap([phase_i[0], np.angle(left)])[1]
-    if right is not None:
-        mag_right = np.abs(right)
-        phase_right = np.unwrap([phase_i[-1], np.angle(right)])[1]
-    # Interpolate magnitude and phase separately, and reassemble
-    mag = np.interp(x, xi, mag_i, left=mag_left, right=mag_right)
-    phase = np.interp(x, xi, phase_i, left=phase_left, right=phase_right)
-    y = np.empty_like(phase, dtype=np.complex128)
-    np.cos(phase, out=y.real)
-    np.sin(phase, out=y.imag)
-    y *= mag
-    return y.astype(yi.dtype)
+    return InterpolationPlan(x, xi).complex_interp(yi, left, right)
 
 
 def has_cal_product(cache, attrs, product):
@@ -257,12 +458,16 @@ def calc_delay_correction(sensor, index, data_freqs):
     builds a categorical sensor for the corresponding complex correction terms
     (channelised by `data_freqs`).
 
+    If `index` is None, the corrections of all inputs are calculated at once,
+    with values of shape (n_data_chans, n_pols, n_ants).
+
     Invalid delays (NaNs) are replaced by zeros, since bandpass calibration
     still has a shot at fixing any residual delay.
     """
-    delays = [np.nan_to_num(value[index]) for segm, value in sensor.segments()]
+    delays = [np.nan_to_num(value if index is None else value[index])
+              for segm, value in sensor.segments()]
     # Delays produced by cal pipeline are raw phase slopes, i.e. exp(2 pi j d f)
-    corrections = [np.exp(-2j * np.pi * d * data_freqs).astype('complex64')
+    corrections = [np.exp(np.multiply.outer(data_freqs, -2j * np.pi * d)).astype('complex64')
                    for d in delays]
     corrections = [ComparableArrayWrapper(c) for c in corrections]
     return CategoricalData(corrections, sensor.events)
@@ -275,25 +480,50 @@ def calc_bandpass_correction(sensor, index, data_freqs, cal_freqs):
     series of bandpasses (channelised by `cal_freqs`) for the input specified
     by `index` (in the form (pol, ant)) and builds a categorical sensor for
     the corresponding complex correction terms (channelised by `data_freqs`).
+    If `index` is None, the corrections of all inputs are calculated at once,
+    with values of shape (n_data_chans, n_pols, n_ants).
 
     Invalid solutions (NaNs) are replaced by linear interpolations over
     frequency (separately for magnitude and phase), as long as some channels
     have valid solutions.
     """
     corrections = []
+    # Interpolation plans per set of valid channels, shared by inputs and segments
+    plans = {}
     for segment, value in sensor.segments():
-        bp = value[(slice(None),) + index]
-        valid = np.isfinite(bp)
-        if valid.any():
+        bp = value if index is None else value[(slice(None),) + index]
+        columns = bp.reshape(len(cal_freqs), -1)
+        valid = np.ascontiguousarray(np.isfinite(columns).T)
+        # Keep the channels of each input together, as inputs are used separately later
+        corrections_per_input = np.empty((columns.shape[1], len(data_freqs)), dtype=bp.dtype)
+        # Group the inputs by their valid channels
+        groups = {}
+        for n, mask in enumerate(valid):
+            groups.setdefault(mask.tobytes(), []).append(n)
+        for key, inputs in groups.items():
+            mask = valid[inputs[0]]
+            if not mask.any():
+                corrections_per_input[inputs] = np.reciprocal(INVALID_GAIN)
+                continue
+            if key not in plans:
+                plans[key] = InterpolationPlan(data_freqs, cal_freqs[mask])
             # Don't extrapolate to edges of band where gain typically drops off
-            bp = complex_interp(data_freqs, cal_freqs[valid], bp[valid],
-                                left=INVALID_GAIN, right=INVALID_GAIN)
-        else:
-            bp = np.full(len(data_freqs), INVALID_GAIN)
-        corrections.append(ComparableArrayWrapper(np.reciprocal(bp)))
+            corrections_per_input[inputs] = plans[key].complex_reciprocal(
+                columns[mask][:, inputs], left=INVALID_GAIN, right=INVALID_GAIN).T
+        bp = np.moveaxis(corrections_per_input.reshape(bp.shape[1:] + (len(data_freqs),)), -1, 0)
+        corrections.append(ComparableArrayWrapper(bp))
     return CategoricalData(corrections, sensor.events)
 
 
+def _select_input(sensor, index):
+    """Extract the values of a single input from a sensor covering all inputs."""
+    if not isinstance(sensor, CategoricalData):
+        return sensor[(slice(None),) + index]
+    values = [ComparableArrayWrapper(value[(slice(None),) + index])
+              for segment, value in sensor.segments()]
+    return CategoricalData(values, sensor.events)
+
+
 def calc_gain_correction(sensor, index):
     """Calculate correction sensor from gain calibration solution sensor.
 
@@ -302,13 +532,31 @@ def calc_gain_correction(sensor, index):
     and interpolates them over time to get the corresponding complex correction
     terms.
 
+    If `index` is None, the corrections of all inputs are calculated at once,
+    as an array of shape (n_dumps, n_pols, n_ants).
+
     Invalid solutions (NaNs) are replaced by linear interpolations over time
     (separately for magnitude and phase), as long as some dumps have valid
     solutions.
     """
     dumps = np.arange(sensor.events[-1])
-    events = sensor.events[:-1]
-    gains = np.array([value[index] for segment, value in sensor.segments()])
+    events = np.asarray(sensor.events[:-1])
+    gains = np.array([value if index is None else value[index]
+                      for segment, value in sensor.segments()])
+    if index is None:
+        columns = gains.reshape(len(events), -1)
+        valid = np.isfinite(columns)
+        corrections = np.full((len(dumps), columns.shape[1]), np.reciprocal(INVALID_GAIN), gains.dtype)
+        # Share an interpolation plan between inputs with the same valid solutions
+        groups = {}
+        for n, mask in enumerate(valid.T):
+            if mask.any():
+                groups.setdefault(mask.tobytes(), []).append(n)
+        for inputs in groups.values():
+            mask = valid[:, inputs[0]]
+            plan = InterpolationPlan(dumps, events[mask])
+            corrections[:, inputs] = plan.complex_reciprocal(columns[mask][:, inputs])
+        return corrections.reshape((len(dumps),) + gains.shape[1:])
     valid = np.isfinite(gains)
     if not valid.any():
         return CategoricalData([INVALID_GAIN], [0, len(dumps)])
@@ -316,7 +564,74 @@ def calc_gain_correction(sensor, index):
     return np.reciprocal(smooth_gains)
 
 
-def add_applycal_sensors(cache, attrs, data_freqs):
+def _calc_all_corrections(product, sensor, data_freqs, cal_freqs):
+    """Calculate corrections of all inputs from cal `product` solution `sensor`."""
+    if product == 'K':
+        return calc_delay_correction(sensor, None, data_freqs)
+    elif product == 'B':
+        return calc_bandpass_correction(sensor, None, data_freqs, cal_freqs)
+    elif product == 'G':
+        return calc_gain_correction(sensor, None)
+    else:
+        raise KeyError("Unknown calibration product '{}'".format(product))
+
+
+def _corrections_digest(product, sensor, *arrays):
+    """Fingerprint of cal `product` solutions in `sensor` and auxiliary `arrays`."""
+    digest = hashlib.sha1(product.encode('ascii'))
+    digest.update(np.asarray(sensor.events, np.int64).tobytes())
+    for segment, value in sensor.segments():
+        digest.update(np.ascontiguousarray(value).tobytes())
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def _load_corrections(filename):
+    """Load corrections saved by :func:`_save_corrections` (None if absent)."""
+    try:
+        with np.load(filename) as data:
+            values = data['values']
+            events = data['events'] if 'events' in data else None
+    except (IOError, OSError, KeyError, ValueError) as e:
+        if getattr(e, 'errno', None) != errno.ENOENT:
+            logger.warning('Ignoring unreadable applycal corrections in %r: %s', filename, e)
+        return None
+    if events is None:
+        return values
+    return CategoricalData([ComparableArrayWrapper(v) for v in values], events)
+
+
+def _save_corrections(filename, corrections):
+    """Save `corrections` sensor to NPZ file, replacing its stale versions."""
+    directory, basename = os.path.split(filename)
+    prefix = basename.rsplit('_', 1)[0] + '_'
+    if isinstance(corrections, CategoricalData):
+        arrays = {'values': np.array([value for segment, value in corrections.segments()]),
+                  'events': np.asarray(corrections.events)}
+    else:
+        arrays = {'values': corrections}
+    try:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Be happy if someone already created the path
+            if e.errno != errno.EEXIST:
+                raise
+        # Rename the file when done writing to make the save atomic
+        temp_filename = '{}.{}.writing'.format(filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(temp_filename, filename)
+        # Solutions have changed since older files were written
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith('.npz') and name != basename:
+                os.remove(os.path.join(directory, name))
+    except (IOError, OSError) as e:
+        logger.warning('Could not save applycal corrections to %r: %s', filename, e)
+
+
+def add_applycal_sensors(cache, attrs, data_freqs, corrections_dir=None, corrections_key=''):
     """Add virtual sensors that store calibration corrections, to sensor cache.
 
     This maps receptor inputs to the relevant indices in each calibration
@@ -325,7 +640,15 @@ def add_applycal_sensors(cache, attrs, data_freqs):
     with template 'Calibration/{inp}_correction_{product}'. The virtual sensor
     function picks the appropriate correction calculator based on the cal
     product name, which also uses auxiliary info like the channel frequencies,
-    `data_freqs`.
+    `data_freqs`. The corrections of all inputs are calculated together the
+    first time any input needs a given cal product.
+
+    If `corrections_dir` is given, these corrections are also saved there as
+    one NPZ file per cal product, and loaded from there by later sessions
+    instead of being calculated again. The file name combines
+    `corrections_key` (typically the capture block ID and stream name),
+    the cal product and a digest of its solutions and frequencies, so that
+    a file is replaced once the underlying cal solutions change.
     """
     cal_ants = attrs.get('cal_antlist', [])
     cal_pols = attrs.get('cal_pol_ordering', [])
@@ -343,25 +666,34 @@ def add_applycal_sensors(cache, attrs, data_freqs):
         logger.warning('Missing cal spectral attributes, disabling applycal')
         return
 
+    # Corrections of all inputs per cal product, calculated together on first use
+    all_corrections = {}
+
+    def calc_all_corrections(cache, product):
+        """Calculate (or load) corrections of all inputs from cal solutions."""
+        product_sensor = get_cal_product(cache, attrs, product)
+        if not corrections_dir:
+            return _calc_all_corrections(product, product_sensor, data_freqs, cal_freqs)
+        digest = _corrections_digest(product, product_sensor, data_freqs, cal_freqs)
+        filename = os.path.join(corrections_dir, '{}_{}_{}.npz'.format(
+            corrections_key, product, digest))
+        corrections = _load_corrections(filename)
+        if corrections is None:
+            corrections = _calc_all_corrections(product, product_sensor, data_freqs, cal_freqs)
+            _save_corrections(filename, corrections)
+        return corrections
+
     def calc_correction_per_input(cache, name, inp, product):
         """Calculate correction sensor for input `inp` from cal solutions."""
-        product_sensor = get_cal_product(cache, attrs, product)
+        if product not in all_corrections:
+            all_corrections[product] = calc_all_corrections(cache, product)
         try:
             index = cal_input_map[inp]
         except KeyError:
             raise KeyError("No calibration solutions available for input "
                            "'{}' - available ones are {}"
                            .format(inp, sorted(cal_input_map.keys())))
-        if product == 'K':
-            correction_sensor = calc_delay_correction(product_sensor, index,
-                                                      data_freqs)
-        elif product == 'B':
-            correction_sensor = calc_bandpass_correction(product_sensor, index,
-                                                         data_freqs, cal_freqs)
-        elif product == 'G':
-            correction_sensor = calc_gain_correction(product_sensor, index)
-        else:
-            raise KeyError("Unknown calibration product '{}'".format(product))
+        correction_sensor = _select_input(all_corrections[product], index)
         cache[name] = correction_sensor
         return correction_sensor
 
@@ -370,11 +702,27 @@ def add_applycal_sensors(cache, attrs, data_freqs):
 
 
 @numba.jit(nopython=True, nogil=True)
-def _correction_inputs_to_corrprods(g_per_cp, g_per_input, input1_index, input2_index):
+def _correction_inputs_to_corrprods(g_per_cp, g_per_input, slab_index, dump_gains,
+                                    input1_index, input2_index):
+    """Combine corrections per input into corrections per correlation product.
+
+    Dump `i` of `g_per_cp` combines the channel gains in slab `slab_index[i]`
+    of `g_per_input` with the gains per input in `dump_gains[i]`, which are
+    constant across channels.
+    """
     for i in range(g_per_cp.shape[0]):
+        g = g_per_input[slab_index[i]]
+        d = dump_gains[i]
+        d_per_cp = d[input1_index] * np.conj(d[input2_index])
         for j in range(g_per_cp.shape[1]):
-            g_per_cp[i, j] = (g_per_input[i, input1_index[j]]
-                              * np.conj(g_per_input[i, input2_index[j]]))
+            for k in range(g_per_cp.shape[2]):
+                g_per_cp[i, j, k] = (g[j, input1_index[k]] * np.conj(g[j, input2_index[k]])
+                                     * d_per_cp[k])
+
+
+def _is_dump_gain(sensor):
+    """True if correction `sensor` has a value per dump that is constant across channels."""
+    return not isinstance(sensor, CategoricalData) and np.ndim(sensor) == 1
 
 
 class CorrectionParams(object):
@@ -383,12 +731,18 @@ class CorrectionParams(object):
     Once constructed, the data in this class must not be modified, as it will
     be baked into dask graphs.
 
+    Corrections with a separate value per dump that is constant across
+    channels (like gains interpolated in time) are kept apart as "dump
+    gains", so that they don't prevent dumps from sharing the rest of the
+    corrections.
+
     Parameters
     ----------
     products : dict
-        A dictionary (indexed by cal product name) of lists (indexed
-        by input) of sequences (indexed by dump) of numpy arrays, with
-        corrections to apply.
+        A dictionary (indexed by cal product name) of lists (indexed by
+        input) of sensors with corrections to apply. Each sensor is either
+        a :class:`~katdal.categorical.CategoricalData` or a numpy array
+        indexed by dump.
     inputs : list of str
         Names of inputs, in the same order as the input axis of products
     input1_index, input2_index : ndarray
@@ -399,28 +753,118 @@ class CorrectionParams(object):
         self.input1_index = input1_index
         self.input2_index = input2_index
         self.products = products
+        self._dump_gains = None
+        for product in products.values():
+            for n, sensor in enumerate(product):
+                if _is_dump_gain(sensor):
+                    if self._dump_gains is None:
+                        self._dump_gains = np.ones((len(sensor), len(inputs)), np.complex64)
+                    self._dump_gains[:, n] *= sensor
+
+    def dump_gains(self, dumps, inputs):
+        """Product of dump gains at `dumps` for `inputs`, shape (n_dumps, n_inputs)."""
+        if self._dump_gains is None:
+            return np.ones((len(dumps), len(inputs)), np.complex64)
+        return np.ascontiguousarray(self._dump_gains[dumps][:, inputs])
+
+    def channel_gains(self, dumps, channels, inputs):
+        """Product of all corrections except dump gains, shape (n_dumps, n_chans, n_inputs)."""
+        n_channels = channels.stop - channels.start
+        g_per_input = np.ones((len(inputs), len(dumps), n_channels), dtype='complex64')
+        for product in self.products.values():
+            for n, inp in enumerate(inputs):
+                if not _is_dump_gain(product[inp]):
+                    _apply_sensor_to_dumps(g_per_input[n], product[inp], dumps, channels)
+        # Transpose to (dump, channel, input) order, and ensure C ordering
+        return np.ascontiguousarray(g_per_input.transpose(1, 2, 0))
+
+    def corrprod_inputs(self, corrprods):
+        """Inputs involved in `corrprods`, and indices of product inputs into them."""
+        input1_index = self.input1_index[corrprods]
+        input2_index = self.input2_index[corrprods]
+        inputs, input_index = np.unique(np.r_[input1_index, input2_index], return_inverse=True)
+        input1_index, input2_index = np.split(input_index, 2)
+        return inputs, input1_index, input2_index
+
+    def solution_ids(self, dumps):
+        """Identify the solutions that apply at each of `dumps`.
+
+        Categorical sensors are identified by the index of their value at
+        each dump. Dump gains are ignored, as they are applied separately.
+        Sensors with a separate value per dump and channel make each dump
+        unique.
+
+        Parameters
+        ----------
+        dumps : array of int
+            Dump indices (applicable to full data set, i.e. absolute)
+
+        Returns
+        -------
+        ids : array of int
+            Solution identifier per dump. Dumps with the same identifier
+            have identical :meth:`channel_gains`.
+        """
+        sensors = [sensor for product in self.products.values() for sensor in product
+                   if not _is_dump_gain(sensor)]
+        if not sensors:
+            return np.zeros(len(dumps), int)
+        keys = np.empty((len(dumps), len(sensors)), np.int64)
+        for n, sensor in enumerate(sensors):
+            if isinstance(sensor, CategoricalData):
+                segments = np.searchsorted(sensor.events, dumps, side='right') - 1
+                keys[:, n] = np.asarray(sensor.indices)[segments]
+            else:
+                # Values that vary across channels are unique to each dump
+                keys[:, n] = dumps
+        return np.unique(keys, axis=0, return_inverse=True)[1]
+
+
+def _apply_sensor_to_dumps(g, sensor, dumps, channels):
+    """Multiply `g` (shape (n_dumps, n_chans)) by `sensor` values at `dumps`."""
+    if isinstance(sensor, CategoricalData):
+        # Apply each distinct value to all its dumps at once
+        segments = np.searchsorted(sensor.events, dumps, side='right') - 1
+        indices = np.asarray(sensor.indices)[segments]
+        for index in np.unique(indices):
+            value = sensor.unique_values[index]
+            if np.shape(value) != ():
+                value = value[channels]
+            g[indices == index] *= value
+    else:
+        values = np.asarray(sensor[dumps])
+        if values.ndim > 1:
+            values = values[:, channels]
+        else:
+            values = values[:, np.newaxis]
+        g *= values
 
 
-def calc_correction_per_corrprod(dump, channels, params):
-    """Gain correction per channel per correlation product for a given dump.
+def calc_correction_per_corrprod(dump, channels, params, corrprods=slice(None)):
+    """Gain correction per channel per correlation product for given dump(s).
 
     This calculates an array of complex gain correction terms of shape
     (n_chans, n_corrprods) that can be directly applied to visibility data.
     This incorporates all requested calibration products at the specified
-    dump and channels.
+    dump and channels. If `dump` is a slice or sequence of dumps, the gains
+    of all of them are calculated together, with an extra leading dump axis.
 
     Parameters
     ----------
-    dump : int
-        Dump index (applicable to full data set, i.e. absolute)
+    dump : int, slice or sequence of int
+        Dump index, unit-stride range or indices (applicable to full data set,
+        i.e. absolute)
     channels : slice
         Channel indices (applicable to full data set, i.e. absolute)
     params : :class:`CorrectionParams`
         Data for obtaining corrections to merge
+    corrprods : slice, optional
+        Correlation product indices (applicable to the products in `params`).
+        Only the inputs involved in these products are corrected.
 
     Returns
     -------
-    gains : array of complex64, shape (n_chans, n_corrprods)
+    gains : array of complex64, shape ([n_dumps,] n_chans, n_corrprods)
         Gain corrections per channel per correlation product
 
     Raises
@@ -428,20 +872,17 @@ def calc_correction_per_corrprod(dump, channels, params):
     KeyError
         If input and/or cal product has no associated correction
     """
+    if isinstance(dump, slice):
+        dumps = np.arange(dump.start, dump.stop)
+    else:
+        dumps = np.atleast_1d(dump)
     n_channels = channels.stop - channels.start
-    g_per_input = np.ones((len(params.inputs), n_channels), dtype='complex64')
-    for product in params.products.values():
-        for n in range(len(params.inputs)):
-            sensor = product[n]
-            g_product = sensor[dump]
-            if np.shape(g_product) != ():
-                g_product = g_product[channels]
-            g_per_input[n] *= g_product
-    # Transpose to (channel, input) order, and ensure C ordering
-    g_per_input = np.ascontiguousarray(g_per_input.T)
-    g_per_cp = np.empty((n_channels, len(params.input1_index)), dtype='complex64')
-    _correction_inputs_to_corrprods(g_per_cp, g_per_input, params.input1_index, params.input2_index)
-    return g_per_cp
+    inputs, input1_index, input2_index = params.corrprod_inputs(corrprods)
+    g_per_input = params.channel_gains(dumps, channels, inputs)
+    g_per_cp = np.empty((len(dumps), n_channels, len(input1_index)), dtype='complex64')
+    _correction_inputs_to_corrprods(g_per_cp, g_per_input, np.arange(len(dumps)),
+                                    params.dump_gains(dumps, inputs), input1_index, input2_index)
+    return g_per_cp if isinstance(dump, slice) or np.ndim(dump) > 0 else g_per_cp[0]
 
 
 @numba.jit(nopython=True, nogil=True)
@@ -487,19 +928,53 @@ def apply_flags_correction(data, correction):
     return out
 
 
-def _correction_block(block_info, params):
+def _correction_block(block_info, params, solution_ids=None, cache=None):
     slices = tuple(slice(*l) for l in block_info['array-location'])
-    block_shape = tuple(s.stop - s.start for s in slices)
-    correction = np.empty(block_shape, np.complex64)
-    # TODO: make calc_correction_per_corrprod multi-dump aware
-    for n, dump in enumerate(range(slices[0].start, slices[0].stop)):
-        correction[n] = calc_correction_per_corrprod(dump, slices[1], params)
+    if cache is None or (solution_ids[slices[0]] < 0).all():
+        return calc_correction_per_corrprod(slices[0], slices[1], params, slices[2])
+    # Group dumps that share solutions, as they only need a single slab of channel gains
+    dumps = np.arange(slices[0].start, slices[0].stop)
+    groups = OrderedDict()
+    for n, solution in enumerate(solution_ids[slices[0]]):
+        # Dumps with solutions of their own get a key that never goes into the cache
+        key = ((solution, slices[1].start, slices[1].stop, slices[2].start, slices[2].stop)
+               if solution >= 0 else n)
+        groups.setdefault(key, []).append(n)
+    inputs, input1_index, input2_index = params.corrprod_inputs(slices[2])
+    n_channels = slices[1].stop - slices[1].start
+    slabs = np.empty((len(groups), n_channels, len(inputs)), np.complex64)
+    slab_index = np.empty(len(dumps), int)
+    missing = []
+    for n, (key, rows) in enumerate(groups.items()):
+        slab_index[rows] = n
+        slab = cache.get(key) if isinstance(key, tuple) else None
+        if slab is None:
+            missing.append((n, key, rows[0]))
+        else:
+            slabs[n] = slab
+    if missing:
+        indices, keys, rows = zip(*missing)
+        slabs[list(indices)] = params.channel_gains(dumps[list(rows)], slices[1], inputs)
+        for n, key in zip(indices, keys):
+            if isinstance(key, tuple):
+                cache.put(key, slabs[n].copy())
+    correction = np.empty((len(dumps), n_channels, len(input1_index)), np.complex64)
+    _correction_inputs_to_corrprods(correction, slabs, slab_index, params.dump_gains(dumps, inputs),
+                                    input1_index, input2_index)
     return correction
 
 
-def calc_correction(chunks, cache, corrprods, cal_products):
+def calc_correction(chunks, cache, corrprods, cal_products, max_cache_size=100e6):
     """Create a dask array containing applycal corrections.
 
+    Dumps that share the same calibration solutions (ignoring gains that
+    vary per dump but not per channel) also share corrections per input,
+    which are computed once and then kept in a cache of limited size for
+    other blocks of dumps to reuse. The per-dump gains are multiplied in
+    while forming the corrections per correlation product. Each block only
+    involves the inputs of its own correlation products, so the baseline
+    axis may be split too.
+
     Parameters
     ----------
     chunks : tuple of tuple of int
@@ -511,11 +986,11 @@ def calc_correction(chunks, cache, corrprods, cal_products):
         Selected correlation products as pairs of correlator input labels
     cal_products : sequence of string
         Calibration products that will contribute to corrections
+    max_cache_size : int or float, optional
+        Upper limit on the total size of cached corrections, in bytes
+        (set to 0 to disable the cache)
     """
     shape = tuple(sum(bd) for bd in chunks)
-    if len(chunks[2]) > 1:
-        logger.warning('ignoring chunking on baseline axis')
-        chunks = (chunks[0], chunks[1], (shape[2],))
     inputs = sorted(set(np.ravel(corrprods)))
     input1_index = np.array([inputs.index(cp[0]) for cp in corrprods])
     input2_index = np.array([inputs.index(cp[1]) for cp in corrprods])
@@ -524,19 +999,18 @@ def calc_correction(chunks, cache, corrprods, cal_products):
         products[product] = []
         for i, inp in enumerate(inputs):
             sensor_name = 'Calibration/{}_correction_{}'.format(inp, product)
-            sensor = cache.get(sensor_name)
-            # Indexing CategoricalData by dump is relatively slow (tens of
-            # microseconds), so expand it into a plain-old Python list.
-            if isinstance(sensor, CategoricalData):
-                data = [None] * sensor.events[-1]
-                for s, v in sensor.segments():
-                    for j in range(s.start, s.stop):
-                        data[j] = v
-            else:
-                data = sensor
-            products[product].append(data)
+            # CategoricalData is kept as is and applied a segment at a time
+            products[product].append(cache.get(sensor_name))
     params = CorrectionParams(inputs, input1_index, input2_index, products)
+    solution_ids = cache = None
+    if max_cache_size > 0:
+        solution_ids = params.solution_ids(np.arange(shape[0]))
+        # Only cache the corrections of solutions shared by several dumps
+        shared = np.bincount(solution_ids)[solution_ids] > 1
+        if shared.any():
+            solution_ids[~shared] = -1
+            cache = ChunkCache(max_cache_size)
     name = 'corrections[{}]'.format(','.join(cal_products))
     return from_block_function(
         _correction_block, shape=shape, chunks=chunks, dtype=np.complex64, name=name,
-        params=params)
+        params=params, solution_ids=solution_ids, cache=cache)
@@ -0,0 +1,281 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Recommend chunk shapes based on how the data will be accessed.
+
+Unlike :func:`~katdal.chunkstore.generate_chunks`, which splits an array
+greedily to meet a byte budget, this evaluates candidate chunk shapes
+against a set of *accesses*, i.e. the rectangular selections that a reader
+makes. Since chunk stores always retrieve whole chunks, each access costs
+one request per chunk that it touches, and the bytes of those chunks.
+The accesses come from a recorded access log or a declared workload.
+"""
+from __future__ import print_function, division, absolute_import
+from builtins import range
+
+import json
+import itertools
+import collections
+
+import numpy as np
+
+
+#: Names of the axes of visibility-shaped arrays, as used in access logs
+AXES = ('dumps', 'channels', 'corrprods')
+_AXIS_ALIASES = {'time': 'dumps', 'freq': 'channels', 'frequency': 'channels',
+                 'baseline': 'corrprods', 'baselines': 'corrprods'}
+
+#: Declared workloads, with the axis along which the data is traversed
+WORKLOADS = {
+    'per-dump-streaming': 0,
+    'per-channel-imaging': 1,
+    'per-baseline-calibration': 2,
+}
+
+
+class ChunkAdvice(collections.namedtuple(
+        'ChunkAdvice', 'chunks chunk_bytes bytes_read requests efficiency cost')):
+    """Estimated cost of accessing an array with a given chunk shape.
+
+    Attributes
+    ----------
+    chunks : tuple of int
+        Number of elements per chunk along each dimension
+    chunk_bytes : int
+        Size of a full chunk, in bytes
+    bytes_read : int
+        Total size of all chunks retrieved by the accesses, in bytes
+    requests : int
+        Total number of chunk requests made by the accesses
+    efficiency : float
+        Fraction of retrieved bytes that was actually selected
+    cost : float
+        Estimated time to perform the accesses, in seconds
+    """
+    __slots__ = ()
+
+
+def _normalise_accesses(shape, accesses):
+    """Turn accesses into arrays of (start, stop) per access and dimension."""
+    accesses = list(accesses)
+    starts = np.zeros((len(accesses), len(shape)), dtype=np.int64)
+    stops = np.tile(np.array(shape, dtype=np.int64), (len(accesses), 1))
+    for n, access in enumerate(accesses):
+        if not isinstance(access, tuple):
+            access = (access,)
+        if len(access) > len(shape):
+            raise ValueError('Access {} has more dimensions than array shape {}'
+                             .format(access, shape))
+        for dim, s in enumerate(access):
+            start, stop, step = s.indices(shape[dim])
+            if step != 1:
+                raise ValueError('Access {} should only contain unit-stride slices'
+                                 .format(access))
+            starts[n, dim] = start
+            stops[n, dim] = max(start, stop)
+    # Empty accesses don't touch any chunks
+    nonempty = np.all(stops > starts, axis=1)
+    return starts[nonempty], stops[nonempty]
+
+
+def estimate_reads(chunks, accesses, itemsize=1):
+    """Estimate the cost of accesses to a chunked array in a chunk store.
+
+    Parameters
+    ----------
+    chunks : tuple of tuple of int
+        Dask chunk specification of the array
+    accesses : sequence of tuple of slice
+        Selections made on the array, each a tuple of unit-stride slices
+        (missing trailing dimensions are selected in full)
+    itemsize : int, optional
+        Number of bytes per array element
+
+    Returns
+    -------
+    bytes_read : int
+        Total size of all chunks retrieved by the accesses, in bytes
+    requests : int
+        Total number of chunks retrieved by the accesses
+    bytes_selected : int
+        Total size of the selections, in bytes
+    """
+    shape = tuple(sum(c) for c in chunks)
+    starts, stops = _normalise_accesses(shape, accesses)
+    chunks_touched = np.ones(len(starts), dtype=np.int64)
+    elements_read = np.ones(len(starts), dtype=np.int64)
+    for dim, dim_chunks in enumerate(chunks):
+        bounds = np.cumsum((0,) + tuple(dim_chunks))
+        first = np.searchsorted(bounds, starts[:, dim], side='right') - 1
+        last = np.searchsorted(bounds, stops[:, dim] - 1, side='right') - 1
+        chunks_touched *= last - first + 1
+        elements_read *= bounds[last + 1] - bounds[first]
+    elements_selected = np.prod(stops - starts, axis=1)
+    return (int(elements_read.sum()) * itemsize, int(chunks_touched.sum()),
+            int(elements_selected.sum()) * itemsize)
+
+
+def workload_accesses(shape, workload, block=1):
+    """Accesses made by a declared workload on a visibility-shaped array.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the array, with dimensions ordered as in :data:`AXES`
+    workload : string
+        Name of workload (one of the keys of :data:`WORKLOADS`):
+
+        - 'per-dump-streaming': read `block` dumps at a time, all channels
+          and baselines (e.g. conversion to MS or time-ordered processing)
+        - 'per-channel-imaging': read `block` channels at a time, all dumps
+          and baselines (e.g. spectral-line imaging)
+        - 'per-baseline-calibration': read `block` correlation products at
+          a time, all dumps and channels
+    block : int, optional
+        Number of elements selected per access along the traversed axis
+
+    Returns
+    -------
+    accesses : list of tuple of slice
+        The selections made by the workload
+
+    Raises
+    ------
+    ValueError
+        If the workload is unknown
+    """
+    try:
+        axis = WORKLOADS[workload]
+    except KeyError:
+        raise ValueError('Unknown workload {!r}, should be one of {}'
+                         .format(workload, sorted(WORKLOADS)))
+    accesses = []
+    for start in range(0, shape[axis], block):
+        access = [slice(None)] * len(shape)
+        access[axis] = slice(start, min(start + block, shape[axis]))
+        accesses.append(tuple(access))
+    return accesses
+
+
+def load_access_log(filename):
+    """Load accesses from a log file.
+
+    The log has one JSON object per line, describing one selection as
+    a mapping from axis name (see :data:`AXES`, or the aliases 'time',
+    'freq' and 'baseline') to a [start, stop) pair of indices, e.g.::
+
+      {"dumps": [0, 10], "channels": [1024, 2048]}
+
+    Axes that are not mentioned are selected in full. Blank lines and
+    lines starting with '#' are ignored.
+
+    Returns
+    -------
+    accesses : list of tuple of slice
+        The selections in the log
+
+    Raises
+    ------
+    ValueError
+        If a line cannot be parsed or mentions an unknown axis
+    """
+    accesses = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                selection = json.loads(line)
+                access = [slice(None)] * len(AXES)
+                for axis, (start, stop) in selection.items():
+                    axis = _AXIS_ALIASES.get(axis, axis)
+                    access[AXES.index(axis)] = slice(int(start), int(stop))
+            except (TypeError, ValueError, AttributeError) as e:
+                raise ValueError('Line {} of access log {!r} is invalid: {}'
+                                 .format(line_number, filename, e))
+            accesses.append(tuple(access))
+    return accesses
+
+
+def _candidate_sizes(length):
+    """Powers of two up to `length`, plus `length` itself."""
+    sizes = set(2 ** n for n in range(int(np.log2(length)) + 1)) if length > 0 else set()
+    sizes.add(length)
+    return sorted(sizes)
+
+
+def advise_chunks(shape, itemsize, accesses, dims_to_split=(0, 1),
+                  min_chunk_size=1e6, max_chunk_size=100e6,
+                  latency=0.01, bandwidth=100e6, n_arrays=1, candidates=None):
+    """Recommend chunk shapes for an array based on how it will be accessed.
+
+    The candidate shapes have power-of-two numbers of elements (or the full
+    length) along each dimension in `dims_to_split`, and the full length
+    along the rest, with a chunk size in the range `min_chunk_size` to
+    `max_chunk_size` bytes. Each candidate is scored by a simple model of
+    the time taken by all the `accesses`: each chunk request costs `latency`
+    seconds and each byte retrieved costs 1 / `bandwidth` seconds.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the array
+    itemsize : float
+        Number of bytes per array element (this may be the combined size of
+        the corresponding elements of several arrays that are read together,
+        like vis, flags and weights)
+    accesses : sequence of tuple of slice
+        Selections made on the array (see e.g. :func:`workload_accesses` and
+        :func:`load_access_log`)
+    dims_to_split : sequence of int, optional
+        Indices of dimensions that may be split into chunks
+    min_chunk_size, max_chunk_size : float, optional
+        Range of acceptable chunk sizes, in bytes
+    latency : float, optional
+        Time per chunk request, in seconds
+    bandwidth : float, optional
+        Rate at which chunk data is retrieved, in bytes per second
+    n_arrays : int, optional
+        Number of arrays read together (multiplying the number of requests)
+    candidates : sequence of tuple of int, optional
+        Chunk shapes to evaluate instead of the automatically generated ones
+
+    Returns
+    -------
+    advice : list of :class:`ChunkAdvice`
+        Evaluated candidates, cheapest first (empty if none fits)
+    """
+    accesses = list(accesses)
+    if candidates is None:
+        sizes = [_candidate_sizes(length) if dim in dims_to_split else [length]
+                 for dim, length in enumerate(shape)]
+        candidates = [c for c in itertools.product(*sizes)
+                      if min_chunk_size <= np.prod(c) * itemsize <= max_chunk_size]
+    advice = []
+    for candidate in candidates:
+        chunks = tuple((size,) * (length // size) + ((length % size,) if length % size else ())
+                       for size, length in zip(candidate, shape))
+        bytes_read, requests, bytes_selected = estimate_reads(chunks, accesses, itemsize)
+        requests *= n_arrays
+        cost = requests * latency + bytes_read / bandwidth
+        efficiency = bytes_selected / bytes_read if bytes_read else 1.0
+        chunk_bytes = int(np.prod(candidate) * itemsize)
+        advice.append(ChunkAdvice(tuple(candidate), chunk_bytes, int(bytes_read),
+                                  requests, efficiency, cost))
+    # Prefer bigger chunks (fewer objects in the store) when costs are equal
+    advice.sort(key=lambda a: (a.cost, -a.chunk_bytes))
+    return advice
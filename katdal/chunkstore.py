@@ -21,13 +21,38 @@ from builtins import next, zip, range, object
 
 import contextlib
 import functools
+import itertools
+import operator
+import threading
+import time
+import logging
 import uuid
 import io
+import json
+import base64
+import zlib
+from collections import OrderedDict, defaultdict
 
+import future.utils
 import numpy as np
 import dask
 import dask.array as da
 import dask.highlevelgraph
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+logger = logging.getLogger(__name__)
 
 
 class ChunkStoreError(Exception):
@@ -51,6 +76,14 @@ def _floor_power_of_two(x):
     return 2 ** int(np.floor(np.log2(x)))
 
 
+def _as_bool(flag):
+    """Interpret `flag` as a boolean, also if it is a string like 'true' or '1'.
+
+    Flags may arrive as strings from the query part of a dataset URL.
+    """
+    return str(flag).lower() in ('1', 'true', 'yes')
+
+
 def generate_chunks(shape, dtype, max_chunk_size, dims_to_split=None,
                     power_of_two=False, max_dim_elements=None):
     """Generate dask chunk specification from ndarray parameters.
@@ -143,6 +176,97 @@ def _scalar_to_chunk(func):
     return func_returning_chunk
 
 
+class _ChunkGetter(object):
+    """Task that gets a chunk of the dask arrays of :meth:`ChunkStore.get_dask_array`.
+
+    Besides serving as the getter in the dask graph, this identifies the
+    chunks of the array in the store, so that readers like
+    :class:`~katdal.lazy_indexer.DaskLazyIndexer` can bypass dask and read
+    whole chunks straight into their output arrays via :meth:`get_chunk_into`.
+    """
+
+    def __init__(self, store, array_name, dtype, offset=()):
+        self.store = store
+        self.array_name = array_name
+        self.dtype = np.dtype(dtype)
+        self.offset = tuple(offset)
+
+    def _offset_slices(self, slices):
+        if not self.offset:
+            return slices
+        return tuple(slice(s.start + i, s.stop + i) for (s, i) in zip(slices, self.offset))
+
+    def __call__(self, array_name, slices):
+        return self.store.get_chunk_or_zeros(array_name, self._offset_slices(slices), self.dtype)
+
+    def get_chunk_into(self, slices, out):
+        """Get chunk at `slices` (without offset) into `out`, or zeros if missing."""
+        return self.store.get_chunk_into_or_zeros(self.array_name, self._offset_slices(slices),
+                                                  self.dtype, out)
+
+
+class _PartialChunkReader(object):
+    """Array-like view of a chunked array in a store that reads partial chunks.
+
+    This serves as the source array of the dask arrays returned by
+    :meth:`ChunkStore.get_dask_array` if the store supports partial reads.
+    The dask optimiser fuses the getter task of each chunk with any
+    subsequent slicing of the chunk, so that this object is indexed with
+    the final (smaller) selection, which is passed on to
+    :meth:`ChunkStore.get_partial_chunk`. Each index has to select
+    elements from a single chunk only.
+    """
+
+    def __init__(self, store, array_name, chunks, dtype, offset=()):
+        self.store = store
+        self.array_name = array_name
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(sum(c) for c in chunks)
+        self.ndim = len(self.shape)
+        self.offset = tuple(offset) if offset else self.ndim * (0,)
+        # Start indices of chunks along each dimension, with overall length at end
+        self._bounds = [np.cumsum((0,) + tuple(c)) for c in chunks]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index += (self.ndim - len(index)) * (slice(None),)
+        chunk_slices = []
+        chunk_index = []
+        for s, bounds, offset in zip(index, self._bounds, self.offset):
+            length = bounds[-1]
+            if isinstance(s, slice):
+                elements = range(*s.indices(length))
+                first = min(elements[0], elements[-1]) if elements else 0
+                last = max(elements[0], elements[-1]) if elements else 0
+            else:
+                first = last = s + length if s < 0 else s
+            # Find chunk that contains the first selected element
+            n = int(np.searchsorted(bounds, first, side='right')) - 1
+            n = min(max(n, 0), len(bounds) - 2)
+            start, stop = bounds[n], bounds[n + 1]
+            if last >= max(stop, start + 1):
+                raise IndexError('Array {!r}: index {} spans more than one chunk'
+                                 .format(self.array_name, index))
+            chunk_slices.append(slice(start + offset, stop + offset))
+            if not isinstance(s, slice):
+                chunk_index.append(first - start)
+            elif not elements:
+                chunk_index.append(slice(0, 0))
+            else:
+                step = elements.step
+                end = elements[-1] - start + (1 if step > 0 else -1)
+                chunk_index.append(slice(elements[0] - start, end if end >= 0 else None, step))
+        chunk_slices = tuple(chunk_slices)
+        chunk_index = tuple(chunk_index)
+        try:
+            return self.store.get_partial_chunk(self.array_name, chunk_slices,
+                                                self.dtype, chunk_index)
+        except ChunkNotFound:
+            chunk_name, shape = self.store.chunk_metadata(self.array_name, chunk_slices)
+            return np.zeros(shape, self.dtype)[chunk_index]
+
+
 def npy_header_and_body(chunk):
     """Prepare a chunk for low-level writing.
 
@@ -165,6 +289,542 @@ def npy_header_and_body(chunk):
     return header, chunk
 
 
+# Prefix of encoded (compressed) chunks, which has the same length as NPY magic
+CODEC_MAGIC = b'\x93KATCHK\x01'
+
+
+def _zlib_compress(data, itemsize):
+    return zlib.compress(data, 1)
+
+
+def _zlib_decompress(data, nbytes):
+    return zlib.decompress(data)
+
+
+def _zstd_compress(data, itemsize):
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data, nbytes):
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=nbytes)
+
+
+def _lz4_compress(data, itemsize):
+    return lz4.frame.compress(data)
+
+
+def _lz4_decompress(data, nbytes):
+    return lz4.frame.decompress(data)
+
+
+def _blosc_compress(data, itemsize):
+    # Byte shuffling groups similar bytes of neighbouring elements together
+    return blosc.compress(data, typesize=itemsize, cname='lz4', shuffle=blosc.SHUFFLE)
+
+
+def _blosc_decompress(data, nbytes):
+    return blosc.decompress(data)
+
+
+# Maps codec name to (module, compress function, decompress function)
+_CODECS = {
+    'zlib': (zlib, _zlib_compress, _zlib_decompress),
+    'zstd': (zstandard, _zstd_compress, _zstd_decompress),
+    'lz4': (lz4, _lz4_compress, _lz4_decompress),
+    'blosc': (blosc, _blosc_compress, _blosc_decompress),
+}
+
+
+def available_codecs():
+    """Names of chunk compression codecs that can be used in this environment."""
+    return sorted(name for name, (module, _, _) in _CODECS.items() if module is not None)
+
+
+def check_codec(codec):
+    """Check that `codec` is a valid codec name (or None for no compression).
+
+    Raises
+    ------
+    ValueError
+        If the codec is unknown
+    ImportError
+        If the codec is known but its Python package is not installed
+    """
+    if codec is None:
+        return
+    if codec not in _CODECS:
+        raise ValueError('Unknown chunk codec {!r} (should be one of {})'
+                         .format(codec, ', '.join(sorted(_CODECS))))
+    if _CODECS[codec][0] is None:
+        raise ImportError('Chunk codec {!r} is not available (install the '
+                          'corresponding Python package)'.format(codec))
+
+
+def encode_chunk(chunk, codec=None):
+    """Encode a chunk for storage, optionally compressing it.
+
+    Without a codec, the chunk is encoded as an ``.npy`` file (see
+    :func:`npy_header_and_body`). Otherwise the encoded chunk starts with
+    :data:`CODEC_MAGIC` and the codec name, followed by the uncompressed
+    ``.npy`` header and the compressed body, so that it is self-describing.
+
+    Parameters
+    ----------
+    chunk : :class:`numpy.ndarray` object
+        Chunk to encode
+    codec : string, optional
+        Name of compression codec (see :func:`available_codecs`)
+
+    Returns
+    -------
+    pieces : list of bytes-like objects
+        Pieces of the encoded chunk that should be concatenated for storage
+    """
+    header, chunk = npy_header_and_body(chunk)
+    if codec is None:
+        return [header, chunk]
+    check_codec(codec)
+    compress = _CODECS[codec][1]
+    if future.utils.PY2:
+        # Python 2's compression modules do not support memoryviews
+        data = chunk.tobytes()
+    else:
+        data = memoryview(chunk.reshape(-1).view(np.uint8))
+    body = compress(data, chunk.dtype.itemsize)
+    name = codec.encode('ascii')
+    prefix = CODEC_MAGIC + bytes(bytearray([len(name)])) + name + header
+    return [prefix, body]
+
+
+def is_encoded(data):
+    """True if `data` (or at least its first few bytes) is a compressed chunk."""
+    return bytes(data[:len(CODEC_MAGIC)]) == CODEC_MAGIC
+
+
+def decode_chunk(data):
+    """Turn a compressed chunk produced by :func:`encode_chunk` into an array.
+
+    The returned array is read-only, as it may share memory with the
+    decompression buffer.
+
+    Raises
+    ------
+    :exc:`chunkstore.BadChunk`
+        If the data is not a valid compressed chunk or its codec is unavailable
+    """
+    data = bytes(data)
+    if not is_encoded(data):
+        raise BadChunk('Data is not an encoded chunk')
+    pos = len(CODEC_MAGIC)
+    name_length = bytearray(data[pos:pos + 1])[0]
+    codec = data[pos + 1:pos + 1 + name_length].decode('ascii')
+    try:
+        check_codec(codec)
+    except (ValueError, ImportError) as err:
+        raise BadChunk(str(err))
+    fp = io.BytesIO(data)
+    fp.seek(pos + 1 + name_length)
+    try:
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+    except ValueError as err:
+        raise BadChunk('Encoded chunk has bad NPY header: {}'.format(err))
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    decompress = _CODECS[codec][2]
+    try:
+        body = decompress(memoryview(data)[fp.tell():], nbytes)
+    except Exception as err:
+        raise BadChunk('Could not decompress chunk with codec {!r}: {}'.format(codec, err))
+    if len(body) != nbytes:
+        raise BadChunk('Decompressed chunk has {} bytes but expected {}'
+                       .format(len(body), nbytes))
+    chunk = np.frombuffer(body, dtype)
+    return chunk.reshape(shape, order='F' if fortran_order else 'C')
+
+
+class ChunkCache(object):
+    """Thread-safe in-memory cache of chunks with a limit on total size.
+
+    The cache maps a chunk key, formed from the array name, chunk slices and
+    dtype, to the corresponding chunk. Once the total size of the cached
+    chunks exceeds `max_bytes`, the least recently used chunks are discarded.
+    The cache holds read-only views of the chunks, since they are handed out
+    to all subsequent users of the chunk, while the arrays passed to
+    :meth:`put` stay writable.
+
+    A single cache may be shared by several chunk stores (see the
+    :attr:`ChunkStore.chunk_cache` attribute). Like the rest of katdal, it
+    assumes that a chunk does not change once it has been written to a store.
+
+    Parameters
+    ----------
+    max_bytes : int or float
+        Upper limit on the total size of cached chunks, in bytes
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of lookups that found / did not find the chunk in the cache
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        # Maps chunk key to chunk, with most recently used at the end
+        self._chunks = OrderedDict()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """Total size of the cached chunks, in bytes."""
+        return self._nbytes
+
+    def __len__(self):
+        """Number of cached chunks."""
+        return len(self._chunks)
+
+    @staticmethod
+    def key(array_name, slices, dtype):
+        """Hashable cache key associated with a chunk."""
+        return (array_name, tuple((s.start, s.stop) for s in slices), np.dtype(dtype))
+
+    def get(self, key):
+        """Look up chunk in the cache, returning None if it is not there."""
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is None:
+                self.misses += 1
+            else:
+                # Mark the chunk as most recently used
+                self._chunks[key] = chunk
+                self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        """Add chunk to the cache, evicting older chunks to make space.
+
+        This returns the read-only view of `chunk` that is kept in the cache
+        (or `chunk` itself if it is too big to be cached).
+        """
+        if chunk.nbytes > self.max_bytes:
+            return chunk
+        chunk = chunk.view()
+        chunk.flags.writeable = False
+        with self._lock:
+            old_chunk = self._chunks.pop(key, None)
+            if old_chunk is not None:
+                self._nbytes -= old_chunk.nbytes
+            self._chunks[key] = chunk
+            self._nbytes += chunk.nbytes
+            while self._nbytes > self.max_bytes:
+                _, old_chunk = self._chunks.popitem(last=False)
+                self._nbytes -= old_chunk.nbytes
+        return chunk
+
+    def discard(self, key):
+        """Remove chunk from the cache if it is there."""
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is not None:
+                self._nbytes -= chunk.nbytes
+
+    def clear(self):
+        """Remove all chunks from the cache and reset the counters."""
+        with self._lock:
+            self._chunks.clear()
+            self._nbytes = 0
+            self.hits = self.misses = 0
+
+
+class OperationStats(object):
+    """Counters and latency histogram of one kind of chunk store operation.
+
+    Attributes
+    ----------
+    requests : int
+        Number of operations performed (successful or not)
+    bytes : int
+        Number of bytes of chunk data moved by successful operations
+    errors : int
+        Number of operations that failed, other than on missing chunks
+    missing : int
+        Number of operations that found no chunk in the store
+    retries : int
+        Number of times that the underlying requests were retried
+    latency : float
+        Total duration of the operations, in seconds
+    latency_histogram : :class:`numpy.ndarray` of int
+        Number of operations per latency bin, where bin `n` counts durations
+        up to ``latency_bins[n]`` seconds and the last bin counts the rest
+    """
+
+    #: Upper edges of the latency histogram bins, in seconds
+    latency_bins = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+                    0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)
+
+    def __init__(self):
+        self.requests = self.bytes = self.errors = self.missing = self.retries = 0
+        self.latency = 0.0
+        self.latency_histogram = np.zeros(len(self.latency_bins) + 1, dtype=np.int64)
+
+    def copy(self):
+        """Independent copy of the stats."""
+        other = OperationStats()
+        other += self
+        return other
+
+    def __iadd__(self, other):
+        self.requests += other.requests
+        self.bytes += other.bytes
+        self.errors += other.errors
+        self.missing += other.missing
+        self.retries += other.retries
+        self.latency += other.latency
+        self.latency_histogram += other.latency_histogram
+        return self
+
+    def add(self, latency, nbytes=0, error=False, missing=False, retries=0):
+        """Count a single operation that took `latency` seconds."""
+        self.requests += 1
+        self.bytes += nbytes
+        self.errors += int(error)
+        self.missing += int(missing)
+        self.retries += retries
+        self.latency += latency
+        self.latency_histogram[np.searchsorted(self.latency_bins, latency)] += 1
+
+    def latency_percentile(self, q):
+        """Upper bound on the `q`-th percentile of latency, from the histogram.
+
+        This returns the upper edge of the histogram bin containing the
+        percentile (infinity for the last bin, NaN if there are no requests).
+        """
+        if not self.requests:
+            return np.nan
+        counts = np.cumsum(self.latency_histogram)
+        n = int(np.searchsorted(counts, q / 100. * counts[-1]))
+        return self.latency_bins[n] if n < len(self.latency_bins) else np.inf
+
+    def __str__(self):
+        mean = self.latency / self.requests if self.requests else 0.0
+        return ('{} requests, {:.1f} MB, {} errors, {} missing, {} retries, '
+                'latency mean {:.1f} ms, p50 <= {:g} ms, p99 <= {:g} ms'
+                .format(self.requests, self.bytes / 1e6, self.errors, self.missing,
+                        self.retries, 1000 * mean, 1000 * self.latency_percentile(50),
+                        1000 * self.latency_percentile(99)))
+
+
+class _Measurement(object):
+    """Details of a single chunk store operation, filled in while it runs."""
+
+    __slots__ = ('nbytes', 'retries', 'discard', 'start')
+
+    def __init__(self):
+        self.nbytes = 0
+        self.retries = 0
+        # Time at which the store started serving the operation, if it keeps track
+        self.start = None
+        # Set this if the operation is handed off to another measured one
+        self.discard = False
+
+
+@contextlib.contextmanager
+def _unmeasured():
+    yield _Measurement()
+
+
+class ChunkStoreStats(object):
+    """Thread-safe statistics of chunk store operations, kept per array.
+
+    A chunk store with this object as its :attr:`ChunkStore.stats` attribute
+    records each chunk retrieval (operation 'get') and storage (operation
+    'put') in an :class:`OperationStats` object associated with the parent
+    array and operation. This shows where the time goes when reading data:
+    compare the latencies to the time spent in dask, for example.
+
+    Parameters
+    ----------
+    log_interval : float, optional
+        If specified, log the statistics (at INFO level) whenever an
+        operation completes at least this many seconds after the last log
+    """
+
+    def __init__(self, log_interval=None):
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_log = time.time()
+
+    def record(self, array_name, operation, latency, nbytes=0, error=False,
+               missing=False, retries=0):
+        """Count a single `operation` on a chunk of array `array_name`.
+
+        See :meth:`OperationStats.add` for the rest of the parameters.
+        """
+        log_now = False
+        with self._lock:
+            key = (array_name, operation)
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = OperationStats()
+            stats.add(latency, nbytes, error, missing, retries)
+            if self.log_interval is not None:
+                now = time.time()
+                if now - self._last_log >= self.log_interval:
+                    self._last_log = now
+                    log_now = True
+        if log_now:
+            self.log()
+
+    @contextlib.contextmanager
+    def measure(self, array_name, operation):
+        """Context manager that times `operation` and records it when done.
+
+        It yields a measurement object on which the operation sets its
+        `nbytes` and `retries` attributes (or sets `discard` to skip it).
+        Exceptions count as errors, except for :exc:`ChunkNotFound`.
+        """
+        measurement = _Measurement()
+        start = time.time()
+        try:
+            yield measurement
+        except ChunkNotFound:
+            self.record(array_name, operation, time.time() - start, missing=True,
+                        retries=measurement.retries)
+            raise
+        except Exception:
+            self.record(array_name, operation, time.time() - start, error=True,
+                        retries=measurement.retries)
+            raise
+        if not measurement.discard:
+            self.record(array_name, operation, time.time() - start,
+                        measurement.nbytes, retries=measurement.retries)
+
+    def keys(self):
+        """List of (array name, operation) pairs with recorded statistics."""
+        with self._lock:
+            return sorted(self._stats)
+
+    def __getitem__(self, key):
+        """Snapshot of :class:`OperationStats` for (array name, operation)."""
+        with self._lock:
+            return self._stats[key].copy()
+
+    def total(self, operation):
+        """Snapshot of :class:`OperationStats` for `operation` on all arrays."""
+        total = OperationStats()
+        with self._lock:
+            for (array_name, op), stats in self._stats.items():
+                if op == operation:
+                    total += stats
+        return total
+
+    def reset(self):
+        """Discard all statistics recorded so far."""
+        with self._lock:
+            self._stats.clear()
+            self._last_log = time.time()
+
+    def log(self):
+        """Log the statistics of each array and operation at INFO level."""
+        for key in self.keys():
+            logger.info('Chunk store %s %s: %s', key[1], key[0], self[key])
+
+
+class ChunkManifest(object):
+    """Compact record of which chunks of an array are present in a store.
+
+    The chunks are identified by their start indices along each dimension.
+    The manifest keeps the sorted distinct start indices per dimension, which
+    define a grid of possible chunks, together with a bitmap over this grid
+    that marks the chunks that are present. This is independent of how the
+    reader chunks the array, as long as it asks for chunks that were stored.
+
+    Parameters
+    ----------
+    starts : sequence of sequences of int
+        Distinct chunk start indices along each dimension, in ascending order
+    present : :class:`numpy.ndarray` of bool
+        Indicates which chunks are present, with one dimension per entry of
+        `starts` and shape matching the lengths of its entries
+    """
+
+    VERSION = 1
+
+    def __init__(self, starts, present):
+        self.starts = [[int(start) for start in dim_starts] for dim_starts in starts]
+        self.present = np.asarray(present, dtype=bool)
+        if self.present.shape != tuple(len(dim_starts) for dim_starts in self.starts):
+            raise ValueError('Chunk bitmap has shape {}, expected {}'.format(
+                self.present.shape, tuple(len(dim_starts) for dim_starts in self.starts)))
+        self._index = [dict((start, n) for (n, start) in enumerate(dim_starts))
+                       for dim_starts in self.starts]
+
+    def __len__(self):
+        """Number of chunks that are present."""
+        return int(self.present.sum())
+
+    @classmethod
+    def from_chunk_ids(cls, chunk_ids):
+        """Build manifest from a sequence of chunk ID strings of one array."""
+        chunk_starts = [[int(start) for start in chunk_id.split('_')] if chunk_id else []
+                        for chunk_id in chunk_ids]
+        ndim = len(chunk_starts[0]) if chunk_starts else 0
+        if any(len(starts) != ndim for starts in chunk_starts):
+            raise ValueError('Chunk IDs have inconsistent dimensions')
+        starts = [sorted(set(chunk[dim] for chunk in chunk_starts)) for dim in range(ndim)]
+        manifest = cls(starts, np.zeros([len(dim_starts) for dim_starts in starts], bool))
+        for chunk in chunk_starts:
+            index = tuple(manifest._index[dim][start] for (dim, start) in enumerate(chunk))
+            manifest.present[index] = True
+        return manifest
+
+    def has_chunk(self, slices):
+        """Check whether the chunk identified by `slices` is present."""
+        if len(slices) != len(self.starts):
+            return False
+        try:
+            index = tuple(dim_index[s.start] for (dim_index, s) in zip(self._index, slices))
+        except KeyError:
+            return False
+        return bool(self.present[index])
+
+    def to_bytes(self):
+        """Serialise manifest to bytes (JSON with a packed bitmap)."""
+        bitmap = np.packbits(self.present.ravel()).tobytes()
+        manifest = {'version': self.VERSION, 'starts': self.starts,
+                    'bitmap': base64.b64encode(bitmap).decode('ascii')}
+        return json.dumps(manifest, separators=(',', ':')).encode('ascii')
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load manifest from bytes produced by :meth:`to_bytes`.
+
+        Raises
+        ------
+        ValueError
+            If `data` is not a valid manifest
+        """
+        try:
+            manifest = json.loads(data.decode('ascii'))
+            if manifest['version'] != cls.VERSION:
+                raise ValueError('Unsupported manifest version {!r}'
+                                 .format(manifest['version']))
+            starts = manifest['starts']
+            bitmap = np.frombuffer(base64.b64decode(manifest['bitmap']), np.uint8)
+        except (UnicodeDecodeError, KeyError, TypeError, AttributeError) as e:
+            raise ValueError('Invalid chunk manifest: {}'.format(e))
+        shape = tuple(len(dim_starts) for dim_starts in starts)
+        n_chunks = int(np.prod(shape))
+        if len(bitmap) != (n_chunks + 7) // 8:
+            raise ValueError('Chunk manifest bitmap has wrong size')
+        return cls(starts, np.unpackbits(bitmap)[:n_chunks].reshape(shape))
+
+
 class ChunkStore(object):
     r"""Base class for accessing a store of chunks (i.e. N-dimensional arrays).
 
@@ -199,6 +859,25 @@ class ChunkStore(object):
     ----------
     error_map : dict mapping :class:`Exception` to :class:`Exception`, optional
         Dict that maps store-specific errors to standard ChunkStore errors
+
+    Attributes
+    ----------
+    chunk_cache : :class:`ChunkCache` object or None
+        In-memory cache consulted by :meth:`get_chunk_or_zeros` (and hence by
+        the dask arrays of :meth:`get_dask_array`), or None for no caching
+    batch_size : int
+        Number of chunks retrieved together by each task of the dask arrays
+        produced by :meth:`get_dask_array` (via :meth:`get_chunks_or_zeros`)
+    partial_reads : bool
+        True if the dask arrays produced by :meth:`get_dask_array` retrieve
+        only the selected parts of chunks (via :meth:`get_partial_chunk`)
+    codec : string or None
+        Name of codec used to compress chunks written by :meth:`put_chunk`,
+        or None to store them uncompressed (chunks are read with whatever
+        codec they were written with, as encoded chunks are self-describing)
+    stats : :class:`ChunkStoreStats` object or None
+        Statistics of chunk retrievals and storage, kept by stores that
+        support it, or None to skip the bookkeeping
     """
 
     def __init__(self, error_map=None):
@@ -206,6 +885,16 @@ class ChunkStore(object):
             error_map = {OSError: StoreUnavailable, KeyError: ChunkNotFound,
                          ValueError: BadChunk}
         self._error_map = error_map
+        self.chunk_cache = None
+        self.batch_size = 1
+        self.partial_reads = False
+        self.codec = None
+        self.stats = None
+
+    def _measure(self, array_name, operation):
+        """Context manager that records `operation` in :attr:`stats` (if any)."""
+        stats = self.stats
+        return _unmeasured() if stats is None else stats.measure(array_name, operation)
 
     def get_chunk(self, array_name, slices, dtype):
         """Get chunk from the store.
@@ -237,12 +926,182 @@ class ChunkStore(object):
         raise NotImplementedError
 
     def get_chunk_or_zeros(self, array_name, slices, dtype):
-        """Get chunk from the store but return zeros if it is missing."""
+        """Get chunk from the store but return zeros if it is missing.
+
+        If the store has a :attr:`chunk_cache`, the chunk is looked up there
+        first, and chunks retrieved from the store are added to it (missing
+        chunks are not cached, since they may still arrive later).
+        """
+        cache = self.chunk_cache
+        if cache is not None:
+            key = cache.key(array_name, slices, dtype)
+            chunk = cache.get(key)
+            if chunk is not None:
+                return chunk
         try:
-            return self.get_chunk(array_name, slices, dtype)
+            chunk = self.get_chunk(array_name, slices, dtype)
         except ChunkNotFound:
             chunk_name, shape = self.chunk_metadata(array_name, slices)
             return np.zeros(shape, dtype)
+        if cache is not None:
+            # Hand out the same read-only view as subsequent cache hits
+            chunk = cache.put(key, chunk)
+        return chunk
+
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """Get chunk from the store into an existing array.
+
+        This avoids allocating a new array for the chunk if the store is able
+        to read the chunk data straight into `out`. The default
+        implementation gets the chunk and copies it into `out`.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunk
+        slices : sequence of unit-stride slice objects
+            Identifier of individual chunk, to be extracted as `x[slices]`
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array `x`
+        out : :class:`numpy.ndarray` object
+            Destination array with the shape dictated by `slices` (data can
+            only be read into it directly if it is C-contiguous and has
+            dtype `dtype`, otherwise the chunk is copied into it)
+
+        Returns
+        -------
+        out : :class:`numpy.ndarray` object
+            The destination array, now containing the chunk
+
+        Raises
+        ------
+        :exc:`chunkstore.BadChunk`
+            If requested `dtype` does not match underlying parent array dtype,
+            `slices` has wrong specification, stored buffer has wrong size or
+            `out` has the wrong shape
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        :exc:`chunkstore.ChunkNotFound`
+            If requested chunk was not found in store
+        """
+        self._check_out(array_name, slices, out)
+        out[()] = self.get_chunk(array_name, slices, dtype)
+        return out
+
+    def get_chunk_into_or_zeros(self, array_name, slices, dtype, out):
+        """Get chunk from the store into `out` but fill it with zeros if missing.
+
+        If the store has a :attr:`chunk_cache`, the chunk is looked up there
+        first, but chunks retrieved from the store are not added to it (as
+        that would need a copy of each chunk).
+        """
+        cache = self.chunk_cache
+        if cache is not None:
+            chunk = cache.get(cache.key(array_name, slices, dtype))
+            if chunk is not None:
+                self._check_out(array_name, slices, out)
+                out[()] = chunk
+                return out
+        try:
+            return self.get_chunk_into(array_name, slices, dtype, out)
+        except ChunkNotFound:
+            out[()] = 0
+            return out
+
+    @classmethod
+    def _check_out(cls, array_name, slices, out):
+        """Check that `out` has the shape of the chunk at `slices`."""
+        chunk_name, shape = cls.chunk_metadata(array_name, slices)
+        if out.shape != shape:
+            raise BadChunk('Chunk {!r}: destination array has shape {} instead of {}'
+                           .format(chunk_name, out.shape, shape))
+        return chunk_name, shape
+
+    @staticmethod
+    def _can_read_into(out, shape, dtype):
+        """True if chunk data of given shape and dtype can be read straight into `out`."""
+        return out.shape == shape and out.dtype == dtype and out.flags.c_contiguous
+
+    def get_partial_chunk(self, array_name, slices, dtype, index):
+        """Get part of a chunk from the store, i.e. ``chunk[index]``.
+
+        The default implementation gets the whole chunk and indexes it.
+        Stores that are able to retrieve parts of a chunk more efficiently
+        should override this and enable :attr:`partial_reads`.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunk
+        slices : sequence of unit-stride slice objects
+            Identifier of individual chunk, to be extracted as `x[slices]`
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array `x`
+        index : tuple of slice objects and / or ints
+            Selection within the chunk, with one entry per dimension
+
+        Returns
+        -------
+        partial_chunk : :class:`numpy.ndarray` object
+            The selected part of the chunk
+
+        Raises
+        ------
+        :exc:`chunkstore.BadChunk`
+            If requested `dtype` does not match underlying parent array dtype
+            or stored buffer has wrong size / shape compared to `slices`
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        :exc:`chunkstore.ChunkNotFound`
+            If requested chunk was not found in store
+        """
+        return self.get_chunk(array_name, slices, dtype)[index]
+
+    def _map(self, func, items):
+        """Apply `func` to each of `items` and return a list of the results.
+
+        This does the work of the batch methods like :meth:`get_chunks`. The
+        default implementation is sequential, while stores with a high
+        latency per request may override it to process items concurrently.
+        """
+        return [func(item) for item in items]
+
+    def get_chunks(self, array_name, slices_list, dtype):
+        """Get several chunks of the same array from the store.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of parent array `x` of chunks
+        slices_list : sequence of sequences of unit-stride slice objects
+            Identifiers of individual chunks, each to be extracted as `x[slices]`
+        dtype : :class:`numpy.dtype` object or equivalent
+            Data type of array `x`
+
+        Returns
+        -------
+        chunks : list of :class:`numpy.ndarray` objects
+            Chunks as ndarrays, in the same order as `slices_list`
+
+        Raises
+        ------
+        :exc:`chunkstore.BadChunk`
+            If requested `dtype` does not match underlying parent array dtype,
+            `slices` has wrong specification or any stored chunk is malformed
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        :exc:`chunkstore.ChunkNotFound`
+            If any requested chunk was not found in store
+        """
+        def get(slices):
+            return self.get_chunk(array_name, slices, dtype)
+        return self._map(get, slices_list)
+
+    def get_chunks_or_zeros(self, array_name, slices_list, dtype):
+        """Get several chunks from the store but return zeros for missing ones."""
+        def get(slices):
+            return self.get_chunk_or_zeros(array_name, slices, dtype)
+        return self._map(get, slices_list)
 
     def create_array(self, array_name):
         """Create a new array if it does not already exist.
@@ -345,6 +1204,87 @@ class ChunkStore(object):
         """Check whether :meth:`mark_complete` has been called for this array."""
         raise NotImplementedError
 
+    def get_manifest(self, array_name):
+        """Load the manifest of chunks present in the store for this array.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of array in chunk store
+
+        Returns
+        -------
+        manifest : :class:`ChunkManifest` object or None
+            Manifest of array, or None if no manifest has been stored
+
+        Raises
+        ------
+        NotImplementedError
+            If the underlying store does not support manifests
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        """
+        raise NotImplementedError
+
+    def put_manifest(self, array_name, manifest):
+        """Store the manifest of chunks present in the store for this array.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of array in chunk store
+        manifest : :class:`ChunkManifest` object
+            Manifest of array, replacing any existing one
+
+        Raises
+        ------
+        NotImplementedError
+            If the underlying store does not support manifests
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        """
+        raise NotImplementedError
+
+    def write_manifest(self, array_name):
+        """Record the chunks currently in the store in manifests.
+
+        This lists the chunks associated with `array_name` once and stores
+        the result via :meth:`put_manifest`, so that :meth:`has_array` can
+        subsequently avoid listing the store. If `array_name` is the parent
+        of a hierarchy of arrays (as for :meth:`mark_complete`), a manifest
+        is written for each array that has chunks in the store.
+
+        The manifest is a snapshot: chunks added afterwards are ignored by
+        :meth:`has_array` until the manifest is written again.
+
+        Parameters
+        ----------
+        array_name : string
+            Identifier of array (or parent of arrays) in chunk store
+
+        Returns
+        -------
+        manifests : dict mapping string to :class:`ChunkManifest`
+            The manifests that were written, indexed by array name
+
+        Raises
+        ------
+        NotImplementedError
+            If the underlying store cannot list or store manifests
+        :exc:`chunkstore.StoreUnavailable`
+            If interaction with chunk store failed (offline, bad auth, bad config)
+        """
+        chunk_ids = defaultdict(list)
+        for chunk_id in self.list_chunk_ids(array_name):
+            sub_array, _, chunk_id = chunk_id.rpartition(self.NAME_SEP)
+            name = self.join(array_name, sub_array) if sub_array else array_name
+            chunk_ids[name].append(chunk_id)
+        manifests = {}
+        for name, ids in chunk_ids.items():
+            manifests[name] = ChunkManifest.from_chunk_ids(ids)
+            self.put_manifest(name, manifests[name])
+        return manifests
+
     NAME_SEP = '/'
     # Width sufficient to store any dump / channel / corrprod index for MeerKAT
     NAME_INDEX_WIDTH = 5
@@ -453,6 +1393,19 @@ class ChunkStore(object):
         Any missing chunks are replaced with zeros, suppressing any
         :exc:`ChunkNotFound` errors.
 
+        If :attr:`batch_size` is bigger than 1, consecutive chunks (in C
+        order) are grouped into batches that are retrieved by a single task
+        via :meth:`get_chunks_or_zeros`. This allows a store to keep many
+        requests in flight per dask worker thread. The catch is that a
+        computation that needs only part of a batch still retrieves all of it.
+
+        If :attr:`partial_reads` is enabled instead, slicing of the array is
+        pushed down into the chunk getters during dask graph optimisation,
+        which then only retrieve the selected part of each chunk. This takes
+        precedence over batching and bypasses :attr:`chunk_cache`. It only
+        benefits selections made directly on the returned array, i.e. not
+        after other dask operations.
+
         Parameters
         ----------
         array_name : string
@@ -469,13 +1422,42 @@ class ChunkStore(object):
         array : :class:`dask.array.Array` object
             Dask array of given dtype
         """
-        getter = functools.partial(self.get_chunk_or_zeros, dtype=dtype)
-        if offset:
-            getter = _add_offset_to_slices(getter, offset)
+        if self.partial_reads:
+            reader = _PartialChunkReader(self, array_name, chunks, dtype, offset)
+            reader_name = 'reader-' + dask.base.tokenize(array_name, chunks, dtype, offset)
+            # Build the graph like da.from_array so that slices get fused
+            dask_graph = da.core.getem(reader_name, chunks, da.core.getter_nofancy,
+                                       out_name=array_name, asarray=False)
+            dask_graph[reader_name] = reader
+            return da.Array(dask_graph, array_name, chunks, dtype)
+        if self.batch_size > 1:
+            dask_graph = self._batched_graph(array_name, chunks, dtype, offset)
+            return da.Array(dask_graph, array_name, chunks, dtype)
+        getter = _ChunkGetter(self, array_name, dtype, offset)
         # Use dask utility function that forms the core of da.from_array
         dask_graph = da.core.getem(array_name, chunks, getter)
         return da.Array(dask_graph, array_name, chunks, dtype)
 
+    def _batched_graph(self, array_name, chunks, dtype, offset=()):
+        """Dask graph that gets chunks in batches (see :meth:`get_dask_array`)."""
+        keys = list(itertools.product([array_name], *[range(len(c)) for c in chunks]))
+        # This has the same (C) order as the keys above
+        slices = da.core.slices_from_chunks(chunks)
+        if offset:
+            slices = [tuple(slice(ss.start + i, ss.stop + i)
+                            for (ss, i) in zip(s, offset))
+                      for s in slices]
+        getter = functools.partial(self.get_chunks_or_zeros, dtype=dtype)
+        batch_name = 'batch-' + array_name
+        graph = {}
+        for n, start in enumerate(range(0, len(keys), self.batch_size)):
+            batch_key = (batch_name, n)
+            batch_slices = slices[start:start + self.batch_size]
+            graph[batch_key] = (getter, array_name, batch_slices)
+            for i, key in enumerate(keys[start:start + self.batch_size]):
+                graph[key] = (operator.getitem, batch_key, i)
+        return graph
+
     def put_dask_array(self, array_name, array, offset=()):
         """Put dask array into the store.
 
@@ -552,7 +1534,9 @@ class ChunkStore(object):
 
         Notes
         -----
-        If the underlying store implements :meth:`list_chunk_ids`, that is
+        If a manifest of the array has been stored (see :meth:`write_manifest`),
+        it is used, unless it is unreadable (which is logged). Failing that, if
+        the underlying store implements :meth:`list_chunk_ids`, that is
         preferred; otherwise :meth:`has_chunk` is called for each chunk.
         """
         slices = da.core.slices_from_chunks(chunks)
@@ -560,6 +1544,17 @@ class ChunkStore(object):
             slices = [tuple(slice(ss.start + i, ss.stop + i)
                             for (ss, i) in zip(s, offset))
                       for s in slices]
+        try:
+            manifest = self.get_manifest(array_name)
+        except NotImplementedError:
+            manifest = None
+        except BadChunk as e:
+            # A manifest only saves time, so look for the chunks themselves instead
+            logger.warning('Ignoring corrupt manifest of array %r: %s', array_name, e)
+            manifest = None
+        if manifest is not None:
+            success = [manifest.has_chunk(s) for s in slices]
+            return np.array(success).reshape(tuple(len(c) for c in chunks))
         try:
             # Obtain ID strings of all chunks in store associated with array_name
             # This might not be implemented by underlying store
@@ -0,0 +1,271 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""A chunk store that keeps a local on-disk cache of another chunk store."""
+from __future__ import print_function, division, absolute_import
+
+import os
+import errno
+import logging
+import threading
+from collections import OrderedDict
+
+from .chunkstore import ChunkStore, ChunkStoreError, ChunkNotFound
+from .chunkstore_npy import NpyFileChunkStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class CachingChunkStore(ChunkStore):
+    """A chunk store that keeps a local on-disk cache of another chunk store.
+
+    This wraps any :class:`ChunkStore` (typically a slow or remote one like
+    :class:`~katdal.chunkstore_s3.S3ChunkStore`) and keeps the chunks fetched
+    from it as NPY files in a local directory, in the same layout as
+    :class:`~katdal.chunkstore_npy.NpyFileChunkStore`. Subsequent requests
+    for the same chunk are then served from local disk. The total size of the
+    cached files is kept below `max_bytes` by evicting the least recently
+    used chunks first.
+
+    Writes go straight to the underlying store (and invalidate any cached
+    copy of the chunk), while the remaining methods are passed through.
+    The :attr:`batch_size` and :attr:`partial_reads` settings are taken from
+    the underlying store, which also provides the concurrency of the batch
+    methods like :meth:`get_chunks`, so that dask arrays retrieve chunks
+    in the way that suits it.
+
+    The cache directory may be reused across processes, which picks up the
+    existing files on construction (ordered by access time). Each process
+    enforces the byte budget only for the files it knows about, so the
+    budget is approximate when several processes share the directory.
+
+    Parameters
+    ----------
+    store : :class:`ChunkStore` object
+        Underlying chunk store that is the authoritative source of chunks
+    path : string
+        Directory that contains the cache (created if it does not exist)
+    max_bytes : int or float, optional
+        Upper limit on the total size of cached chunk files, in bytes
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of :meth:`get_chunk` / :meth:`get_partial_chunk` calls served
+        from cache / underlying store
+
+    Raises
+    ------
+    :exc:`chunkstore.StoreUnavailable`
+        If the cache directory could not be created
+    """
+
+    def __init__(self, store, path, max_bytes=10e9):
+        super(CachingChunkStore, self).__init__()
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # Be happy if someone already created the path
+            if e.errno != errno.EEXIST:
+                raise
+        self.store = store
+        self.batch_size = store.batch_size
+        self.partial_reads = store.partial_reads
+        self.cache = NpyFileChunkStore(path)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        # Maps chunk name to file size, with most recently used at the end
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._scan()
+
+    @property
+    def nbytes(self):
+        """Total size of the cached chunk files, in bytes."""
+        return self._nbytes
+
+    def _filename(self, chunk_name):
+        return os.path.join(self.cache.path, chunk_name) + '.npy'
+
+    def _scan(self):
+        """Index existing chunk files in cache directory (oldest access first)."""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.cache.path):
+            for filename in filenames:
+                # Skip anything that is not a finished chunk file
+                if not filename.endswith('.npy') or filename.endswith('.writing.npy'):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                chunk_name = os.path.relpath(full_path, self.cache.path)[:-4]
+                chunk_name = self.join(*chunk_name.split(os.sep))
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                found.append((stat.st_atime, chunk_name, stat.st_size))
+        with self._lock:
+            for atime, chunk_name, size in sorted(found):
+                self._entries[chunk_name] = size
+                self._nbytes += size
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used files until cache fits into budget.
+
+        This assumes that the lock is held by the caller.
+        """
+        while self._nbytes > self.max_bytes and self._entries:
+            chunk_name, size = self._entries.popitem(last=False)
+            self._nbytes -= size
+            self._remove_file(chunk_name)
+
+    def _remove_file(self, chunk_name):
+        try:
+            os.remove(self._filename(chunk_name))
+        except OSError as e:
+            # Another process sharing the cache may have removed it already
+            if e.errno != errno.ENOENT:
+                logger.warning('Could not remove cached chunk %r: %s', chunk_name, e)
+
+    def _forget(self, chunk_name):
+        """Drop chunk from the cache index and return its file size (or None)."""
+        with self._lock:
+            size = self._entries.pop(chunk_name, None)
+            if size is not None:
+                self._nbytes -= size
+        return size
+
+    def _add(self, array_name, slices, chunk):
+        """Store chunk in cache, making space for it if necessary."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+        if chunk.nbytes > self.max_bytes:
+            return
+        try:
+            self.cache.create_array(array_name)
+            self.cache.put_chunk(array_name, slices, chunk)
+            size = os.path.getsize(self._filename(chunk_name))
+        except (OSError, ChunkStoreError) as e:
+            # A failure to cache (e.g. disk full) should not fail the read
+            logger.warning('Could not cache chunk %r: %s', chunk_name, e)
+            return
+        with self._lock:
+            old_size = self._entries.pop(chunk_name, None)
+            if old_size is not None:
+                self._nbytes -= old_size
+            self._entries[chunk_name] = size
+            self._nbytes += size
+            self._evict()
+
+    def _get_cached(self, array_name, slices, dtype):
+        """Get chunk from cache (or None if it is not cached), counting hits."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
+        with self._lock:
+            size = self._entries.pop(chunk_name, None)
+            if size is not None:
+                # Mark the chunk as most recently used
+                self._entries[chunk_name] = size
+        if size is not None:
+            try:
+                chunk = self.cache.get_chunk(array_name, slices, dtype)
+            except ChunkNotFound:
+                # The file was evicted by another process or is corrupted
+                self._forget(chunk_name)
+            else:
+                with self._lock:
+                    self.hits += 1
+                return chunk
+        return None
+
+    def _map(self, func, items):
+        # Batches are as concurrent as the underlying store would make them
+        return self.store._map(func, items)
+
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        chunk = self._get_cached(array_name, slices, dtype)
+        if chunk is not None:
+            return chunk
+        with self._lock:
+            self.misses += 1
+        chunk = self.store.get_chunk(array_name, slices, dtype)
+        self._add(array_name, slices, chunk)
+        return chunk
+
+    def get_partial_chunk(self, array_name, slices, dtype, index):
+        """See the docstring of :meth:`ChunkStore.get_partial_chunk`.
+
+        A cached chunk is read from disk and indexed, while an uncached one
+        is partially retrieved from the underlying store and hence not added
+        to the cache.
+        """
+        chunk = self._get_cached(array_name, slices, dtype)
+        if chunk is not None:
+            return chunk[index]
+        with self._lock:
+            self.misses += 1
+        return self.store.get_partial_chunk(array_name, slices, dtype, index)
+
+    def create_array(self, array_name):
+        """See the docstring of :meth:`ChunkStore.create_array`."""
+        self.store.create_array(array_name)
+
+    def put_chunk(self, array_name, slices, chunk):
+        """See the docstring of :meth:`ChunkStore.put_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+        # Invalidate the cached version first, since the new chunk replaces it
+        if self._forget(chunk_name) is not None:
+            self._remove_file(chunk_name)
+        self.store.put_chunk(array_name, slices, chunk)
+
+    def has_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.has_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
+        with self._lock:
+            if chunk_name in self._entries:
+                return True
+        return self.store.has_chunk(array_name, slices, dtype)
+
+    def list_chunk_ids(self, array_name):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
+        return self.store.list_chunk_ids(array_name)
+
+    def get_manifest(self, array_name):
+        """See the docstring of :meth:`ChunkStore.get_manifest`."""
+        return self.store.get_manifest(array_name)
+
+    def put_manifest(self, array_name, manifest):
+        """See the docstring of :meth:`ChunkStore.put_manifest`."""
+        self.store.put_manifest(array_name, manifest)
+
+    def mark_complete(self, array_name):
+        """See the docstring of :meth:`ChunkStore.mark_complete`."""
+        self.store.mark_complete(array_name)
+
+    def is_complete(self, array_name):
+        """See the docstring of :meth:`ChunkStore.is_complete`."""
+        return self.store.is_complete(array_name)
+
+    get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
+    create_array.__doc__ = ChunkStore.create_array.__doc__
+    put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
+    has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
+    list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
+    get_manifest.__doc__ = ChunkStore.get_manifest.__doc__
+    put_manifest.__doc__ = ChunkStore.put_manifest.__doc__
+    mark_complete.__doc__ = ChunkStore.mark_complete.__doc__
+    is_complete.__doc__ = ChunkStore.is_complete.__doc__
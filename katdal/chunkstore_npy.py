@@ -25,19 +25,25 @@ import contextlib
 import numpy as np
 
 from .chunkstore import (ChunkStore, StoreUnavailable, ChunkNotFound, BadChunk,
-                         npy_header_and_body)
+                         ChunkManifest, encode_chunk, is_encoded, decode_chunk,
+                         check_codec, CODEC_MAGIC)
 
 
-def _write_chunk(filename, chunk, direct_write):
-    if not direct_write:
+def _write_chunk(filename, chunk, direct_write, codec=None):
+    if not direct_write and codec is None:
         return np.save(filename, chunk, allow_pickle=False)
-    header, chunk = npy_header_and_body(chunk)
-    size = len(header) + chunk.nbytes
+    header, body = encode_chunk(chunk, codec)
+    if not direct_write:
+        with open(filename, 'wb') as f:
+            f.write(header)
+            f.write(body)
+        return
+    size = len(header) + memoryview(body).nbytes
     gran = mmap.ALLOCATIONGRANULARITY
     aligned_size = (size + gran - 1) // gran * gran
     with contextlib.closing(mmap.mmap(-1, aligned_size)) as aligned:
         aligned.write(header)
-        aligned.write(chunk)
+        aligned.write(body)
         aligned.seek(0)
         fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666)
         try:
@@ -48,6 +54,41 @@ def _write_chunk(filename, chunk, direct_write):
             os.close(fd)
 
 
+def _load_mmap(filename, prefetch=False):
+    """Load NPY file as read-only memory-mapped array, optionally prefetching it."""
+    if prefetch and hasattr(os, 'posix_fadvise'):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    chunk = np.load(filename, mmap_mode='r', allow_pickle=False)
+    mapped = getattr(chunk, '_mmap', None)
+    if prefetch and mapped is not None and hasattr(mapped, 'madvise'):
+        # Python >= 3.8 also allows advice on the mapping itself
+        mapped.madvise(mmap.MADV_WILLNEED)
+    # Present it as a plain ndarray (the view still keeps the mapping alive)
+    return chunk.view(np.ndarray)
+
+
+def _read_header(f):
+    """Read NPY header from file `f`, or return None if the chunk is encoded.
+
+    This returns the (shape, fortran_order, dtype) tuple of the header and
+    leaves the file positioned at the start of the array data.
+    """
+    if is_encoded(f.read(len(CODEC_MAGIC))):
+        return None
+    f.seek(0)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        return np.lib.format.read_array_header_2_0(f)
+    else:
+        raise ValueError('Unsupported .npy version {}'.format(version))
+
+
 class NpyFileChunkStore(ChunkStore):
     """A store of chunks (i.e. N-dimensional arrays) based on NPY files.
 
@@ -72,6 +113,20 @@ class NpyFileChunkStore(ChunkStore):
         If true, use ``O_DIRECT`` when writing the file. This bypasses the
         OS page cache, which can be useful to avoid filling it up with
         files that won't be read again.
+    mmap : bool
+        If true, :meth:`get_chunk` returns read-only memory-mapped chunks.
+        Data is then only read from disk when accessed, which makes small
+        selections of big chunks much cheaper.
+    prefetch : bool
+        If true (and `mmap` is enabled), advise the OS that each mapped chunk
+        file will be needed soon (``MADV_WILLNEED`` / ``POSIX_FADV_WILLNEED``),
+        which reads the whole file into the page cache in the background.
+        This suits chunks that are accessed repeatedly.
+    codec : string, optional
+        Compress chunks written by :meth:`put_chunk` with this codec (see
+        :func:`~katdal.chunkstore.available_codecs`). Compressed chunks are
+        still recognised when reading without it, but they cannot be
+        memory-mapped.
 
     Raises
     ------
@@ -81,13 +136,17 @@ class NpyFileChunkStore(ChunkStore):
         If `direct_write` was requested but is not available
     """
 
-    def __init__(self, path, direct_write=False):
+    def __init__(self, path, direct_write=False, mmap=False, prefetch=False, codec=None):
         super(NpyFileChunkStore, self).__init__({IOError: ChunkNotFound,
                                                  ValueError: ChunkNotFound})
         if not os.path.isdir(path):
             raise StoreUnavailable('Directory {!r} does not exist'.format(path))
         self.path = path
         self.direct_write = direct_write
+        self.mmap = mmap
+        self.prefetch = prefetch
+        check_codec(codec)
+        self.codec = codec
         if direct_write and not hasattr(os, 'O_DIRECT'):
             raise StoreUnavailable('direct_write requested but not supported on this OS')
 
@@ -95,15 +154,57 @@ class NpyFileChunkStore(ChunkStore):
         """See the docstring of :meth:`ChunkStore.get_chunk`."""
         chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
         filename = os.path.join(self.path, chunk_name) + '.npy'
-        with self._standard_errors(chunk_name):
-            chunk = np.load(filename, allow_pickle=False)
-        if chunk.shape != shape or chunk.dtype != dtype:
-            raise BadChunk('Chunk {!r}: NPY file dtype {} and/or shape {} '
-                           'differs from expected dtype {} and shape {}'
-                           .format(chunk_name, chunk.dtype, chunk.shape,
-                                   dtype, shape))
+        with self._measure(array_name, 'get') as measurement:
+            with self._standard_errors(chunk_name):
+                with open(filename, 'rb') as f:
+                    encoded = is_encoded(f.read(len(CODEC_MAGIC)))
+                    f.seek(0)
+                    if encoded:
+                        data = f.read()
+                    elif not self.mmap:
+                        chunk = np.load(f, allow_pickle=False)
+                if self.mmap and not encoded:
+                    chunk = _load_mmap(filename, self.prefetch)
+            if encoded:
+                # Decode outside the error context, so that a corrupted chunk
+                # is not mistaken for a missing one
+                chunk = decode_chunk(data)
+            if chunk.shape != shape or chunk.dtype != dtype:
+                raise BadChunk('Chunk {!r}: NPY file dtype {} and/or shape {} '
+                               'differs from expected dtype {} and shape {}'
+                               .format(chunk_name, chunk.dtype, chunk.shape,
+                                       dtype, shape))
+            measurement.nbytes = len(data) if encoded else chunk.nbytes
         return chunk
 
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`.
+
+        If `out` is suitable, the NPY header is parsed and the rest of the
+        file is read straight into `out` (even if `mmap` is enabled).
+        """
+        chunk_name, shape = self._check_out(array_name, slices, out)
+        dtype = np.dtype(dtype)
+        if not self._can_read_into(out, shape, dtype):
+            return super(NpyFileChunkStore, self).get_chunk_into(array_name, slices, dtype, out)
+        filename = os.path.join(self.path, chunk_name) + '.npy'
+        with self._measure(array_name, 'get') as measurement:
+            with self._standard_errors(chunk_name):
+                with open(filename, 'rb') as f:
+                    header = _read_header(f)
+                    if header is not None:
+                        stored_shape, fortran_order, stored_dtype = header
+                        if (stored_shape == shape and stored_dtype == dtype
+                                and (not fortran_order or len(shape) <= 1)):
+                            buf = memoryview(out.reshape(-1).view(np.uint8))
+                            if f.readinto(buf) == len(buf):
+                                measurement.nbytes = out.nbytes
+                                return out
+            # The fallback below records its own measurement
+            measurement.discard = True
+        # Leave compressed, Fortran-ordered and malformed chunks to get_chunk
+        return super(NpyFileChunkStore, self).get_chunk_into(array_name, slices, dtype, out)
+
     def create_array(self, array_name):
         """See the docstring of :meth:`ChunkStore.create_array`."""
         # Ensure any subdirectories are in place
@@ -119,11 +220,13 @@ class NpyFileChunkStore(ChunkStore):
         """See the docstring of :meth:`ChunkStore.put_chunk`."""
         chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
         base_filename = os.path.join(self.path, chunk_name)
-        with self._standard_errors(chunk_name):
+        with self._standard_errors(chunk_name), \
+                self._measure(array_name, 'put') as measurement:
             # Rename the file when done writing to make put_chunk() atomic
             temp_filename = base_filename + '.writing.npy'
-            _write_chunk(temp_filename, chunk, self.direct_write)
+            _write_chunk(temp_filename, chunk, self.direct_write, self.codec)
             os.rename(temp_filename, base_filename + '.npy')
+            measurement.nbytes = os.path.getsize(base_filename + '.npy')
 
     def has_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.has_chunk`."""
@@ -134,17 +237,45 @@ class NpyFileChunkStore(ChunkStore):
     def list_chunk_ids(self, array_name):
         """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
         array_dir = os.path.join(self.path, array_name)
-        # Strip the .npy extension to get the chunk ID string
+        # Strip the .npy extension to get the chunk ID string (skipping partial writes)
         try:
-            return [fn[:-4] for fn in os.listdir(array_dir) if fn.endswith('.npy')]
+            return [fn[:-4] for fn in os.listdir(array_dir)
+                    if fn.endswith('.npy') and not fn.endswith('.writing.npy')]
         except OSError as e:
             # If the directory is missing, there cannot be any objects
             if e.errno != errno.ENOENT:
                 raise
             return []
 
+    def get_manifest(self, array_name):
+        """See the docstring of :meth:`ChunkStore.get_manifest`."""
+        filename = os.path.join(self.path, array_name, 'manifest.json')
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise StoreUnavailable('Could not read manifest {!r}: {}'.format(filename, e))
+            return None
+        try:
+            return ChunkManifest.from_bytes(data)
+        except ValueError as e:
+            raise BadChunk('Manifest {!r}: {}'.format(filename, e))
+
+    def put_manifest(self, array_name, manifest):
+        """See the docstring of :meth:`ChunkStore.put_manifest`."""
+        self.create_array(array_name)
+        filename = os.path.join(self.path, array_name, 'manifest.json')
+        with self._standard_errors(array_name):
+            # Rename the file when done writing to make it atomic
+            with open(filename + '.writing', 'wb') as f:
+                f.write(manifest.to_bytes())
+            os.rename(filename + '.writing', filename)
+
     def mark_complete(self, array_name):
         """See the docstring of :meth:`ChunkStore.mark_complete`."""
+        # Record the chunks first so that a completed array always has a manifest
+        self.write_manifest(array_name)
         self.create_array(array_name)
         touch_file = os.path.join(self.path, array_name, 'complete')
         with open(touch_file, 'a'):
@@ -159,5 +290,7 @@ class NpyFileChunkStore(ChunkStore):
     put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
     has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
     list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
+    get_manifest.__doc__ = ChunkStore.get_manifest.__doc__
+    put_manifest.__doc__ = ChunkStore.put_manifest.__doc__
     mark_complete.__doc__ = ChunkStore.mark_complete.__doc__
     is_complete.__doc__ = ChunkStore.is_complete.__doc__
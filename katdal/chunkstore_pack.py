@@ -0,0 +1,386 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""A store of chunks (i.e. N-dimensional arrays) packed into large files."""
+from __future__ import print_function, division, absolute_import
+
+import os
+import io
+import errno
+import struct
+import threading
+import uuid
+
+import numpy as np
+
+from .chunkstore import (ChunkStore, StoreUnavailable, ChunkNotFound, BadChunk,
+                         encode_chunk, is_encoded, decode_chunk)
+from .chunkstore_npy import NpyFileChunkStore
+
+
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.index'
+# Number of bytes read up front to find the NPY header of a chunk
+_HEADER_PEEK = 4096
+
+
+def contains_packs(path):
+    """True if directory `path` contains pack files of a :class:`PackFileChunkStore`."""
+    try:
+        return any(fn.endswith(INDEX_SUFFIX) for fn in os.listdir(path))
+    except OSError:
+        return False
+
+
+def _read_at(fd, view, offset):
+    """Fill writable buffer `view` from file descriptor `fd` starting at `offset`.
+
+    Returns the number of bytes read, which is less than the buffer size
+    only if the end of the file was reached.
+    """
+    view = memoryview(view).cast('B')
+    total = 0
+    while total < len(view):
+        if hasattr(os, 'preadv'):
+            nbytes = os.preadv(fd, [view[total:]], offset + total)
+        else:
+            data = os.pread(fd, len(view) - total, offset + total)
+            nbytes = len(data)
+            view[total:total + nbytes] = data
+        if nbytes == 0:
+            break
+        total += nbytes
+    return total
+
+
+def _write_all(fd, pieces):
+    """Write all bytes-like `pieces` to file descriptor `fd` and return size."""
+    size = 0
+    for piece in pieces:
+        if isinstance(piece, np.ndarray):
+            piece = piece.reshape(-1).view(np.uint8)
+        view = memoryview(piece).cast('B')
+        while len(view):
+            nbytes = os.write(fd, view)
+            view = view[nbytes:]
+            size += nbytes
+    return size
+
+
+def _npy_header_length(prefix):
+    """Length of the NPY header that starts with bytes-like `prefix`."""
+    prefix = bytes(prefix[:12])
+    major = bytearray(prefix[6:7])[0] if len(prefix) > 6 else None
+    if major == 1 and len(prefix) >= 10:
+        return 10 + struct.unpack('<H', prefix[8:10])[0]
+    elif major in (2, 3) and len(prefix) >= 12:
+        return 12 + struct.unpack('<I', prefix[8:12])[0]
+    raise ValueError('Not a valid NPY header')
+
+
+def _parse_npy_header(header):
+    """Parse NPY `header` bytes into (shape, fortran_order, dtype)."""
+    fp = io.BytesIO(header)
+    version = np.lib.format.read_magic(fp)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(fp)
+    elif version == (2, 0):
+        return np.lib.format.read_array_header_2_0(fp)
+    else:
+        raise ValueError('Unsupported .npy version {}'.format(version))
+
+
+class _PackWriter(object):
+    """Appends chunks of an array to a pack file and its index."""
+
+    def __init__(self, array_dir):
+        name = uuid.uuid4().hex
+        self.pid = os.getpid()
+        self.pack = name + PACK_SUFFIX
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        self._pack_fd = os.open(os.path.join(array_dir, self.pack), flags, 0o666)
+        self._index_fd = os.open(os.path.join(array_dir, name + INDEX_SUFFIX), flags, 0o666)
+        self.size = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def append(self, chunk_id, pieces):
+        """Append encoded chunk to the pack and return its (offset, size).
+
+        This assumes that the lock is held by the caller and that the
+        writer is not closed.
+        """
+        offset = self.size
+        nbytes = _write_all(self._pack_fd, pieces)
+        self.size += nbytes
+        # The index entry only appears once the chunk data is in place
+        entry = '{} {} {}\n'.format(chunk_id, offset, nbytes).encode('ascii')
+        _write_all(self._index_fd, [entry])
+        return offset, nbytes
+
+    def close(self):
+        # Wait for any append in progress, since its file descriptors may be reused
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                os.close(self._pack_fd)
+                os.close(self._index_fd)
+
+
+class _PackIndex(object):
+    """Locations of the chunks of an array, gathered from the index files."""
+
+    def __init__(self):
+        # Maps chunk ID to (pack filename, offset, size)
+        self.entries = {}
+        # Maps index filename to the number of bytes already parsed
+        self.parsed = {}
+
+
+class PackFileChunkStore(NpyFileChunkStore):
+    """A store of chunks (i.e. N-dimensional arrays) packed into large files.
+
+    Instead of writing each chunk to its own file like
+    :class:`~katdal.chunkstore_npy.NpyFileChunkStore`, this appends the
+    chunks of each array (in ``.npy`` format, or compressed by `codec`) to a
+    few large *pack* files in the directory
+
+      "<path>/<array>/"
+
+    Each pack file "<name>.pack" is accompanied by an append-only text index
+    "<name>.index" with a line "<idx> <offset> <size>" per chunk, which is
+    written once the chunk data is in place. Readers combine the indices of
+    all packs in the directory and read chunks with ``pread``. Every store
+    object (and process) writes to its own packs, starting a new one when the
+    current one reaches `max_pack_size`. If a chunk is written more than
+    once, the last write by the same writer wins (the order of writes by
+    different writers is undefined).
+
+    Manifests and completion markers are stored as for
+    :class:`~katdal.chunkstore_npy.NpyFileChunkStore`.
+
+    Parameters
+    ----------
+    path : string
+        Top-level directory that contains the pack files of chunk store
+    codec : string, optional
+        Compress chunks written by :meth:`put_chunk` with this codec (see
+        :func:`~katdal.chunkstore.available_codecs`)
+    max_pack_size : int or float, optional
+        Start a new pack file once the current one has reached this size,
+        in bytes
+
+    Raises
+    ------
+    :exc:`chunkstore.StoreUnavailable`
+        If path does not exist / is not readable, or ``pread`` is not
+        supported on this OS / Python version
+    """
+
+    def __init__(self, path, codec=None, max_pack_size=4e9):
+        super(PackFileChunkStore, self).__init__(path, codec=codec)
+        if not hasattr(os, 'pread'):
+            raise StoreUnavailable('PackFileChunkStore needs os.pread (Python 3 on a POSIX OS)')
+        self.max_pack_size = max_pack_size
+        self._lock = threading.Lock()
+        # Maps array name to _PackIndex and _PackWriter objects, respectively
+        self._indices = {}
+        self._writers = {}
+        # Maps full pack filename to file descriptor used for reading
+        self._fds = {}
+
+    def _refresh(self, array_name, index):
+        """Parse new entries in the index files of array.
+
+        This assumes that the lock is held by the caller.
+        """
+        array_dir = os.path.join(self.path, array_name)
+        try:
+            filenames = os.listdir(array_dir)
+        except OSError as e:
+            # If the directory is missing, there cannot be any chunks
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for filename in filenames:
+            if not filename.endswith(INDEX_SUFFIX):
+                continue
+            parsed = index.parsed.get(filename, 0)
+            full_path = os.path.join(array_dir, filename)
+            if os.path.getsize(full_path) <= parsed:
+                continue
+            with open(full_path, 'rb') as f:
+                f.seek(parsed)
+                data = f.read()
+            # Ignore any partially written line at the end
+            data = data[:data.rfind(b'\n') + 1]
+            pack = filename[:-len(INDEX_SUFFIX)] + PACK_SUFFIX
+            for line in data.splitlines():
+                chunk_id, offset, nbytes = line.decode('ascii').split()
+                index.entries[chunk_id] = (pack, int(offset), int(nbytes))
+            index.parsed[filename] = parsed + len(data)
+
+    def _locate(self, array_name, chunk_id):
+        """Find (pack filename, offset, size) of chunk, or None if not in store."""
+        with self._lock:
+            index = self._indices.setdefault(array_name, _PackIndex())
+            entry = index.entries.get(chunk_id)
+            if entry is None:
+                # The chunk may have been added by another writer since
+                self._refresh(array_name, index)
+                entry = index.entries.get(chunk_id)
+            return entry
+
+    def _fd(self, array_name, pack):
+        """File descriptor for reading given pack file of array."""
+        filename = os.path.join(self.path, array_name, pack)
+        with self._lock:
+            fd = self._fds.get(filename)
+            if fd is None:
+                fd = self._fds[filename] = os.open(filename, os.O_RDONLY)
+            return fd
+
+    def _chunk_location(self, array_name, slices, dtype):
+        """Check parameters and find the chunk (see :meth:`_locate`)."""
+        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        entry = self._locate(array_name, self.chunk_id_str(slices))
+        if entry is None:
+            raise ChunkNotFound('Chunk {!r} not found in packs'.format(chunk_name))
+        return chunk_name, shape, entry
+
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        dtype = np.dtype(dtype)
+        with self._measure(array_name, 'get') as measurement:
+            chunk_name, shape, (pack, offset, nbytes) = self._chunk_location(array_name, slices, dtype)
+            data = bytearray(nbytes)
+            with self._standard_errors(chunk_name):
+                fd = self._fd(array_name, pack)
+                size = _read_at(fd, data, offset)
+            if size != nbytes:
+                raise BadChunk('Chunk {!r}: pack {!r} is truncated'.format(chunk_name, pack))
+            if is_encoded(data):
+                chunk = decode_chunk(data)
+            else:
+                try:
+                    header_length = _npy_header_length(data)
+                    stored_shape, fortran_order, stored_dtype = \
+                        _parse_npy_header(bytes(data[:header_length]))
+                    chunk = np.frombuffer(data, stored_dtype, offset=header_length)
+                    chunk = chunk.reshape(stored_shape, order='F' if fortran_order else 'C')
+                except ValueError as e:
+                    raise BadChunk('Chunk {!r}: could not parse NPY data: {}'.format(chunk_name, e))
+            if chunk.shape != shape or chunk.dtype != dtype:
+                raise BadChunk('Chunk {!r}: packed dtype {} and/or shape {} '
+                               'differs from expected dtype {} and shape {}'
+                               .format(chunk_name, chunk.dtype, chunk.shape,
+                                       dtype, shape))
+            measurement.nbytes = nbytes
+        return chunk
+
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`.
+
+        If `out` is suitable, the NPY header is read first and the chunk
+        data is then read straight into `out`.
+        """
+        dtype = np.dtype(dtype)
+        self._check_out(array_name, slices, out)
+        with self._measure(array_name, 'get') as measurement:
+            chunk_name, shape, (pack, offset, nbytes) = self._chunk_location(array_name, slices, dtype)
+            if self._can_read_into(out, shape, dtype):
+                peek = bytearray(min(nbytes, _HEADER_PEEK))
+                with self._standard_errors(chunk_name):
+                    fd = self._fd(array_name, pack)
+                    _read_at(fd, peek, offset)
+                header = None
+                if not is_encoded(peek):
+                    try:
+                        header_length = _npy_header_length(peek)
+                        if header_length <= len(peek):
+                            header = _parse_npy_header(bytes(peek[:header_length]))
+                    except ValueError:
+                        pass
+                if (header is not None and header == (shape, False, dtype)
+                        and nbytes - header_length == out.nbytes):
+                    buf = out.reshape(-1).view(np.uint8)
+                    with self._standard_errors(chunk_name):
+                        size = _read_at(fd, buf, offset + header_length)
+                    if size == out.nbytes:
+                        measurement.nbytes = nbytes
+                        return out
+            # The fallback below records its own measurement
+            measurement.discard = True
+        # Leave compressed, unusual and malformed chunks to get_chunk
+        return super(NpyFileChunkStore, self).get_chunk_into(array_name, slices, dtype, out)
+
+    def _writer(self, array_name):
+        """Writer for array, starting a new pack if necessary."""
+        with self._lock:
+            writer = self._writers.get(array_name)
+            if writer is None or writer.size >= self.max_pack_size or writer.pid != os.getpid():
+                if writer is not None and writer.pid == os.getpid():
+                    writer.close()
+                writer = self._writers[array_name] = \
+                    _PackWriter(os.path.join(self.path, array_name))
+            return writer
+
+    def put_chunk(self, array_name, slices, chunk):
+        """See the docstring of :meth:`ChunkStore.put_chunk`."""
+        chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+        chunk_id = self.chunk_id_str(slices)
+        pieces = encode_chunk(chunk, self.codec)
+        with self._standard_errors(chunk_name), \
+                self._measure(array_name, 'put') as measurement:
+            while True:
+                writer = self._writer(array_name)
+                with writer.lock:
+                    # Another thread may have rolled over to a new pack in the meantime
+                    if not writer.closed:
+                        offset, nbytes = writer.append(chunk_id, pieces)
+                        break
+            measurement.nbytes = nbytes
+        with self._lock:
+            index = self._indices.setdefault(array_name, _PackIndex())
+            index.entries[chunk_id] = (writer.pack, offset, nbytes)
+
+    def has_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.has_chunk`."""
+        self.chunk_metadata(array_name, slices, dtype=dtype)
+        return self._locate(array_name, self.chunk_id_str(slices)) is not None
+
+    def list_chunk_ids(self, array_name):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
+        with self._lock:
+            index = self._indices.setdefault(array_name, _PackIndex())
+            self._refresh(array_name, index)
+            return list(index.entries)
+
+    def close(self):
+        """Close all pack files (the store can still be used afterwards)."""
+        with self._lock:
+            for writer in self._writers.values():
+                if writer.pid == os.getpid():
+                    writer.close()
+            for fd in self._fds.values():
+                os.close(fd)
+            self._writers = {}
+            self._fds = {}
+
+    get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
+    put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
+    has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
+    list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
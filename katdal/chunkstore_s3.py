@@ -22,15 +22,17 @@ code to provide HTTP authentication.
 from __future__ import print_function, division, absolute_import
 from future import standard_library
 standard_library.install_aliases()  # noqa: E402
-from builtins import object
+from builtins import object, range
 import future.utils
 from future.utils import raise_, bytes_to_native_str
 
 import contextlib
 import io
+import itertools
 import threading
 import queue
 import sys
+import time
 import urllib.parse
 import urllib.request
 import urllib.error
@@ -40,6 +42,7 @@ import re
 import warnings
 import copy
 import json
+from collections import deque
 
 import defusedxml.ElementTree
 import defusedxml.cElementTree
@@ -53,7 +56,8 @@ except ImportError:
     botocore = None
 
 from .chunkstore import (ChunkStore, StoreUnavailable, ChunkNotFound, BadChunk,
-                         npy_header_and_body)
+                         ChunkManifest, encode_chunk, is_encoded, decode_chunk,
+                         check_codec, CODEC_MAGIC, _as_bool, _Measurement)
 from .sensordata import to_str
 
 
@@ -72,7 +76,7 @@ _BUCKET_POLICY = {
 }
 
 
-def read_array(fp):
+def read_array(fp, out=None):
     """Read a numpy array in npy format from a file descriptor.
 
     This is the same concept as :func:`numpy.lib.format.read_array`, but
@@ -80,9 +84,17 @@ def read_array(fp):
     Using the numpy function reads pieces out then copies them into the
     array, while this implementation uses `readinto`.
 
-    It does not allow pickled dtypes.
+    It does not allow pickled dtypes. It also accepts compressed chunks
+    produced by :func:`katdal.chunkstore.encode_chunk`.
+
+    If `out` is given and it is a C-contiguous array with the shape and dtype
+    of the stored (uncompressed, C-ordered) array, the data is read straight
+    into `out`, which is then returned. Otherwise a new array is returned.
     """
-    version = np.lib.format.read_magic(fp)
+    magic = fp.read(len(CODEC_MAGIC))
+    if is_encoded(magic):
+        return decode_chunk(magic + fp.read())
+    version = np.lib.format.read_magic(io.BytesIO(magic))
     if version == (1, 0):
         shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
     elif version == (2, 0):
@@ -91,6 +103,10 @@ def read_array(fp):
         raise ValueError('Unsupported .npy version {}'.format(version))
     if dtype.hasobject:
         raise ValueError('Object arrays are not supported')
+    if (out is not None and not (fortran_order and len(shape) > 1)
+            and ChunkStore._can_read_into(out, shape, dtype)):
+        fp.readinto(memoryview(out.reshape(-1).view(np.uint8)))
+        return out
     count = int(np.product(shape))
     data = np.ndarray(count, dtype=dtype)
     # For HTTPResponse it works to just pass in `data` directly, but the
@@ -105,6 +121,80 @@ def read_array(fp):
     return data
 
 
+def _byte_spans(index, shape, max_spans):
+    """Turn an index into a C-ordered array into contiguous spans of elements.
+
+    The elements selected by `index` are covered by a box (a simple slice
+    along each dimension) that is then split into contiguous runs of
+    elements in the flattened array. If this needs more than `max_spans`
+    runs, the box is grown by including whole trailing dimensions, which
+    reduces the number of (longer) runs.
+
+    Parameters
+    ----------
+    index : tuple of slice objects and / or ints
+        Selection within array, with one entry per dimension
+    shape : tuple of int
+        Shape of array
+    max_spans : int
+        Upper limit on number of contiguous runs of elements
+
+    Returns
+    -------
+    box_shape : tuple of int
+        Shape of box containing the selection
+    spans : list of int
+        Flattened array index of first element of each contiguous run
+    run_length : int
+        Number of elements in each run
+    box_index : tuple of slice objects and / or ints
+        Index that extracts the selection from the box
+    """
+    starts, stops, ranges = [], [], []
+    for s, length in zip(index, shape):
+        if isinstance(s, slice):
+            elements = range(*s.indices(length))
+        else:
+            s = s + length if s < 0 else s
+            elements = range(s, s + 1)
+        if elements:
+            starts.append(min(elements[0], elements[-1]))
+            stops.append(max(elements[0], elements[-1]) + 1)
+        else:
+            starts.append(0)
+            stops.append(0)
+        ranges.append(elements)
+    # The dimension along which the box breaks into separate runs
+    k = len(shape) - 1
+    while True:
+        while k > 0 and (starts[k], stops[k]) == (0, shape[k]):
+            k -= 1
+        if k <= 0 or np.prod(np.subtract(stops[:k], starts[:k])) <= max_spans:
+            break
+        starts[k], stops[k] = 0, shape[k]
+    box_shape = tuple(np.subtract(stops, starts))
+    if k < 0 or not np.prod(box_shape):
+        spans = []
+        run_length = 0
+    else:
+        run_length = (stops[k] - starts[k]) * int(np.prod(shape[k + 1:]))
+        outer = [range(start, stop) for start, stop in zip(starts[:k], stops[:k])]
+        spans = [int(np.ravel_multi_index(outer_index + (starts[k],) + (0,) * (len(shape) - k - 1),
+                                          shape))
+                 for outer_index in itertools.product(*outer)]
+    box_index = []
+    for s, elements, start in zip(index, ranges, starts):
+        if not isinstance(s, slice):
+            box_index.append(elements[0] - start)
+        elif not elements:
+            box_index.append(slice(0, 0))
+        else:
+            end = elements[-1] - start + (1 if elements.step > 0 else -1)
+            box_index.append(slice(elements[0] - start, end if end >= 0 else None,
+                                   elements.step))
+    return box_shape, spans, run_length, tuple(box_index)
+
+
 class _TimeoutHTTPAdapter(_HTTPAdapter):
     """Allow an HTTPAdapter to have a default timeout"""
     def __init__(self, *args, **kwargs):
@@ -163,6 +253,12 @@ class _Multipart(object):
         return sum(memoryview(item).nbytes for item in self.items)
 
 
+def _retries(response):
+    """Number of times that the request behind `response` was retried."""
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
+
+
 def _raise_for_status(response):
     """Like :meth:`requests.Response.raise_for_status`, but uses ChunkStore exception types."""
     try:
@@ -175,33 +271,101 @@ def _raise_for_status(response):
 
 
 class _Pool(object):
-    """Thread-safe pool of objects constructed by a factory as needed."""
-    def __init__(self, factory):
+    """Thread-safe pool of objects constructed by a factory as needed.
+
+    If `limit` is specified, at most that many objects are handed out at any
+    time and :meth:`get` blocks until an object is returned to the pool.
+    """
+    def __init__(self, factory, limit=None):
         self._factory = factory
         self._pool = []
         self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(limit) if limit else None
 
     def get(self):
         """Obtain an item from the pool, creating a new one if the pool is empty."""
-        with self._lock:
-            if not self._pool:
-                return self._factory()
-            else:
-                return self._pool.pop()
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            with self._lock:
+                if self._pool:
+                    return self._pool.pop()
+            return self._factory()
+        except BaseException:
+            self.discard()
+            raise
 
     def put(self, item):
         """Return an item to the pool"""
         with self._lock:
             self._pool.append(item)
+        if self._slots is not None:
+            self._slots.release()
+
+    def discard(self):
+        """Give up on an item obtained via :meth:`get` without returning it"""
+        if self._slots is not None:
+            self._slots.release()
 
     @contextlib.contextmanager
     def __call__(self):
         """Context manager interface to get and put an item"""
         item = self.get()
-        yield item
+        try:
+            yield item
+        except BaseException:
+            # Don't return the item to the pool, as it might be in a bad state
+            self.discard()
+            raise
         self.put(item)
 
 
+class _Executor(object):
+    """Thread-safe pool of reusable daemon threads that run submitted functions.
+
+    A function submitted via :meth:`submit` is handed to an idle thread if
+    there is one, and otherwise to a new thread. This avoids the cost of
+    starting a thread per request, while never making a function wait for
+    another one (so that functions may submit and wait for further ones).
+    Threads that stay idle for `idle_timeout` seconds exit.
+    """
+    def __init__(self, idle_timeout=10.0):
+        self.idle_timeout = idle_timeout
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        # Number of idle threads that have not been promised a task yet
+        self._idle = 0
+
+    def submit(self, func):
+        """Run `func` (which handles its own exceptions) in a pool thread."""
+        with self._lock:
+            new_thread = self._idle == 0
+            if not new_thread:
+                self._idle -= 1
+        self._tasks.put(func)
+        if new_thread:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            try:
+                func = self._tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # Only leave if no queued task is counting on this thread
+                    if self._idle > 0:
+                        self._idle -= 1
+                        return
+                continue
+            # The function handles its own errors (if it does not, the thread
+            # dies without being counted as idle, so nothing will wait for it)
+            func()
+            with self._lock:
+                self._idle += 1
+
+
 class _CacheSettingsSession(requests.Session):
     """Session that caches the result of proxy lookup.
 
@@ -267,6 +431,30 @@ class S3ChunkStore(ChunkStore):
     public_read : bool
         If set to true, new buckets will be created with a policy that allows
         everyone (including unauthenticated users) to read the data.
+    max_connections : int, optional
+        Upper limit on the number of sessions (and hence requests in flight)
+    batch_size : int, optional
+        Number of chunks retrieved concurrently by each dask task
+    range_reads : bool, optional
+        If set to true, dask arrays only retrieve the parts of chunks that
+        are selected, via HTTP range requests (see :meth:`get_partial_chunk`)
+    codec : string, optional
+        Compress chunks written by :meth:`put_chunk` with this codec (see
+        :func:`~katdal.chunkstore.available_codecs`). Compressed chunks are
+        recognised when reading regardless of this setting.
+    hedge_percentile : float, optional
+        If specified, :meth:`get_chunk` sends a duplicate ("hedged") request
+        on another session whenever the first one takes longer than this
+        percentile of recently observed request latencies, and uses the
+        response that arrives first. Hedging starts once
+        :attr:`hedge_min_samples` latencies have been observed.
+
+    Attributes
+    ----------
+    hedges_fired : int
+        Number of hedged requests sent by :meth:`get_chunk`
+    hedges_won : int
+        Number of hedged requests that completed before the original request
 
     Raises
     ------
@@ -274,7 +462,10 @@ class S3ChunkStore(ChunkStore):
         If requests is not installed (it's an optional dependency otherwise)
     """
 
-    def __init__(self, session_factory, url, public_read=False):
+    def __init__(self, session_factory, url, public_read=False,
+                 max_connections=100, batch_size=1, range_reads=False, codec=None,
+                 hedge_percentile=None):
+        check_codec(codec)
         try:
             # Quick smoke test to see if the S3 server is available, by listing
             # buckets. Depending on the server in use, this may return a 403
@@ -291,12 +482,25 @@ class S3ChunkStore(ChunkStore):
         error_map = {requests.exceptions.RequestException: StoreUnavailable,
                      defusedxml.ElementTree.ParseError: StoreUnavailable}
         super(S3ChunkStore, self).__init__(error_map)
-        self._session_pool = _Pool(session_factory)
+        self._session_pool = _Pool(session_factory, max_connections)
         self._url = to_str(url)
         self.public_read = public_read
+        self.max_connections = max_connections
+        self.batch_size = batch_size
+        self.partial_reads = range_reads
+        self.codec = codec
+        # Maps (array name, chunk shape, dtype) to length of NPY header
+        self._header_lengths = {}
+        self._header_lock = threading.Lock()
+        self.hedge_percentile = hedge_percentile
+        self.hedges_fired = self.hedges_won = 0
+        self._latencies = deque(maxlen=self.hedge_window)
+        self._hedge_lock = threading.Lock()
+        self._executor = _Executor()
 
     @classmethod
-    def _from_url(cls, url, timeout, token, credentials, public_read):
+    def _from_url(cls, url, timeout, token, credentials, public_read,
+                  max_connections, batch_size, range_reads, codec, hedge_percentile):
         """Construct S3 chunk store from endpoint URL (see :meth:`from_url`)."""
         if token is not None:
             parsed = urllib.parse.urlparse(url)
@@ -318,11 +522,14 @@ class S3ChunkStore(ChunkStore):
             session.mount(url, adapter)
             return session
 
-        return cls(session_factory, url, public_read)
+        return cls(session_factory, url, public_read, max_connections, batch_size,
+                   range_reads, codec, hedge_percentile)
 
     @classmethod
     def from_url(cls, url, timeout=300, extra_timeout=10,
-                 token=None, credentials=None, public_read=False, **kwargs):
+                 token=None, credentials=None, public_read=False,
+                 max_connections=100, batch_size=1, range_reads=False, codec=None,
+                 hedge_percentile=None, **kwargs):
         """Construct S3 chunk store from endpoint URL.
 
         Parameters
@@ -341,6 +548,17 @@ class S3ChunkStore(ChunkStore):
         public_read : bool
             If set to true, new buckets will be created with a policy that allows
             everyone (including unauthenticated users) to read the data.
+        max_connections : int or string, optional
+            Upper limit on the number of requests in flight
+        batch_size : int or string, optional
+            Number of chunks retrieved concurrently by each dask task
+        range_reads : bool or string, optional
+            Only retrieve the selected parts of chunks via HTTP range requests
+        codec : string, optional
+            Compress chunks written by :meth:`put_chunk` with this codec
+        hedge_percentile : float or string, optional
+            Send a duplicate request for chunks that take longer than this
+            percentile of recent request latencies (e.g. 95)
         kwargs : dict
             Extra keyword arguments (unused)
 
@@ -351,20 +569,28 @@ class S3ChunkStore(ChunkStore):
         """
         if token is not None and credentials is not None:
             raise ValueError('Cannot specify both token and credentials')
+        # These may arrive as strings from the query part of a dataset URL
+        max_connections = int(max_connections)
+        batch_size = int(batch_size)
+        range_reads = _as_bool(range_reads)
+        if hedge_percentile is not None:
+            hedge_percentile = float(hedge_percentile)
 
         # XXX This is a poor man's attempt at concurrent.futures functionality
         # (avoiding extra dependency on Python 2, revisit when Python 3 only)
         q = queue.Queue()
 
-        def _from_url(url, timeout, token, credentials, public_read):
+        def _from_url(*args):
             """Construct chunk store and return it (or exception) via queue."""
             try:
-                q.put(cls._from_url(url, timeout, token, credentials, public_read))
+                q.put(cls._from_url(*args))
             except BaseException:
                 q.put(sys.exc_info())
 
         thread = threading.Thread(target=_from_url,
-                                  args=(url, timeout, token, credentials, public_read))
+                                  args=(url, timeout, token, credentials, public_read,
+                                        max_connections, batch_size, range_reads, codec,
+                                        hedge_percentile))
         thread.daemon = True
         thread.start()
         if timeout is not None:
@@ -382,26 +608,159 @@ class S3ChunkStore(ChunkStore):
                 # Assume result is (exception type, exception value, traceback)
                 raise_(result[0], result[1], result[2])
 
+    def _map(self, func, items):
+        """Apply `func` to `items` concurrently, using up to `max_connections` threads.
+
+        The threads come from a pool that is shared with hedged requests.
+        """
+        items = list(items)
+        n_threads = min(len(items), self.max_connections)
+        if n_threads <= 1:
+            return [func(item) for item in items]
+        todo = queue.Queue()
+        for index_item in enumerate(items):
+            todo.put(index_item)
+        results = [None] * len(items)
+        errors = []
+
+        done = queue.Queue()
+
+        def worker():
+            # Stop picking up new work once something went wrong
+            while not errors:
+                try:
+                    index, item = todo.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    results[index] = func(item)
+                except BaseException:
+                    errors.append(sys.exc_info())
+            done.put(None)
+
+        for n in range(n_threads):
+            self._executor.submit(worker)
+        for n in range(n_threads):
+            done.get()
+        if errors:
+            raise_(*errors[0])
+        return results
+
     def _chunk_url(self, chunk_name):
         return urllib.parse.urljoin(self._url, to_str(urllib.parse.quote(chunk_name + '.npy')))
 
     @contextlib.contextmanager
-    def _request(self, chunk_name, method, url, *args, **kwargs):
-        """Run a request on a session from the pool, raising HTTP errors"""
+    def _request(self, chunk_name, method, url, measurement=None, **kwargs):
+        """Run a request on a session from the pool, raising HTTP errors.
+
+        If a `measurement` is given, its start time is set once a session has
+        been obtained, so that it excludes any wait for a free connection.
+        """
         with self._standard_errors(chunk_name), self._session_pool() as session:
-            with session.request(method, url, *args, **kwargs) as response:
+            if measurement is not None:
+                measurement.start = time.time()
+            with session.request(method, url, **kwargs) as response:
                 _raise_for_status(response)
                 yield response
 
-    def get_chunk(self, array_name, slices, dtype):
-        """See the docstring of :meth:`ChunkStore.get_chunk`."""
-        dtype = np.dtype(dtype)
-        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
-        url = self._chunk_url(chunk_name)
+    # Parameters of hedged requests
+    hedge_window = 1000
+    hedge_min_samples = 20
+
+    def _hedge_delay(self):
+        """Time after which to send a hedged request, or None to not hedge."""
+        if self.hedge_percentile is None:
+            return None
+        with self._hedge_lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            latencies = list(self._latencies)
+        return np.percentile(latencies, self.hedge_percentile)
+
+    def _record_latency(self, measurement):
+        """Note the latency of a successful request for the hedge delay."""
+        if measurement.start is not None:
+            with self._hedge_lock:
+                self._latencies.append(time.time() - measurement.start)
+
+    def _hedged(self, func, measurement):
+        """Call `func`, calling it again concurrently if it is slow to finish.
+
+        This returns the result of the call that finishes first. If that call
+        fails, the result of the other call is used instead (if there is one).
+        The slower call is abandoned but still runs to completion in the
+        background, which ties up a session in the meantime.
+
+        The function is passed a :class:`_Measurement` object to fill in.
+        Concurrent calls get their own one, and only the details of the call
+        whose result (or error) is returned end up in `measurement`. The
+        hedge delay and the recorded latencies both start once a call has a
+        session (see :meth:`_request`), so that waiting for a free connection
+        neither triggers a hedge nor inflates the latency percentile.
+        """
+        if self.hedge_percentile is None:
+            return func(measurement)
+        delay = self._hedge_delay()
+        if delay is None:
+            # Not enough latencies yet, so just collect another one
+            result = func(measurement)
+            self._record_latency(measurement)
+            return result
+        results = queue.Queue()
+        first = _Measurement()
+
+        def attempt(hedge):
+            own_measurement = _Measurement() if hedge else first
+            try:
+                result = func(own_measurement)
+            except BaseException:
+                results.put((hedge, own_measurement, None, sys.exc_info()))
+            else:
+                self._record_latency(own_measurement)
+                results.put((hedge, own_measurement, result, None))
+
+        self._executor.submit(lambda: attempt(False))
+        while True:
+            timeout = delay if first.start is None else first.start + delay - time.time()
+            try:
+                hedge, winner, result, error = results.get(timeout=max(timeout, 0.0))
+                attempts = 1
+                break
+            except queue.Empty:
+                if first.start is not None and time.time() >= first.start + delay:
+                    with self._hedge_lock:
+                        self.hedges_fired += 1
+                    self._executor.submit(lambda: attempt(True))
+                    hedge, winner, result, error = results.get()
+                    attempts = 2
+                    break
+        if error is not None and attempts == 2:
+            # Fall back to the other attempt if the first one to finish failed
+            other_hedge, other, other_result, other_error = results.get()
+            if other_error is None:
+                hedge, winner, result, error = other_hedge, other, other_result, None
+        measurement.nbytes = winner.nbytes
+        measurement.retries += winner.retries
+        if error is not None:
+            raise_(*error)
+        if hedge:
+            with self._hedge_lock:
+                self.hedges_won += 1
+        return result
+
+    def _get_chunk_data(self, chunk_name, url, measurement, out=None):
+        """Retrieve a chunk from the store with a single request (into `out` if possible).
+
+        The size of the response and the number of retries are added to
+        `measurement`.
+        """
         # Our hacky optimisation to speed up response reading doesn't
         # work with non-identity encodings.
         headers = {'Accept-Encoding': 'identity'}
-        with self._request(chunk_name, 'GET', url, headers=headers, stream=True) as response:
+        with self._request(chunk_name, 'GET', url, measurement,
+                           headers=headers, stream=True) as response:
+            measurement.retries += _retries(response)
+            measurement.nbytes = int(response.headers.get('Content-Length', 0))
             data = response.raw
             # Workaround for https://github.com/urllib3/urllib3/issues/1540
             # On Python 2, http.client.HTTPResponse doesn't implement
@@ -411,19 +770,156 @@ class S3ChunkStore(ChunkStore):
             if ('Content-encoding' not in response.headers
                     and hasattr(data, '_fp')
                     and hasattr(data._fp, 'readinto')):
-                chunk = read_array(data._fp)
+                chunk = read_array(data._fp, out)
             else:
-                chunk = read_array(data)
+                chunk = read_array(data, out)
             # This shouldn't actually read any data, but will make requests
             # aware that we've consumed all the data and hence it can
             # reuse the connection.
             response.content
-        if chunk.shape != shape or chunk.dtype != dtype:
+        return chunk
+
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        dtype = np.dtype(dtype)
+        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        url = self._chunk_url(chunk_name)
+        with self._measure(array_name, 'get') as measurement:
+            chunk = self._hedged(lambda m: self._get_chunk_data(chunk_name, url, m), measurement)
+            if chunk.shape != shape or chunk.dtype != dtype:
+                raise BadChunk('Chunk {!r}: dtype {} and/or shape {} in store '
+                               'differs from expected dtype {} and shape {}'
+                               .format(chunk_name, chunk.dtype, chunk.shape,
+                                       dtype, shape))
+        return chunk
+
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`.
+
+        If `out` is suitable, the response body is read straight into it.
+        """
+        dtype = np.dtype(dtype)
+        chunk_name, shape = self._check_out(array_name, slices, out)
+        url = self._chunk_url(chunk_name)
+        with self._measure(array_name, 'get') as measurement:
+            if self.hedge_percentile is None:
+                chunk = self._get_chunk_data(chunk_name, url, measurement, out)
+            else:
+                # A hedged request that loses the race may still be writing to
+                # its destination, so each request reads into its own array
+                chunk = self._hedged(lambda m: self._get_chunk_data(chunk_name, url, m), measurement)
+            if chunk.shape != shape or chunk.dtype != dtype:
+                raise BadChunk('Chunk {!r}: dtype {} and/or shape {} in store '
+                               'differs from expected dtype {} and shape {}'
+                               .format(chunk_name, chunk.dtype, chunk.shape,
+                                       dtype, shape))
+        if chunk is not out:
+            out[()] = chunk
+        return out
+
+    # Parameters of range reads
+    range_read_max_spans = 64
+    range_read_max_fraction = 0.5
+    range_read_header_size = 4096
+
+    def _npy_header_length(self, array_name, chunk_name, shape, dtype):
+        """Length of NPY header of chunk, or None if range reads are not possible.
+
+        The header length is assumed to be the same for all chunks of the
+        array with the same shape and dtype, so that it is only retrieved
+        once (this is checked against the object size for each request).
+        """
+        key = (array_name, shape, dtype)
+        with self._header_lock:
+            if key in self._header_lengths:
+                return self._header_lengths[key]
+        url = self._chunk_url(chunk_name)
+        headers = {'Range': 'bytes=0-{}'.format(self.range_read_header_size - 1)}
+        with self._request(chunk_name, 'GET', url, headers=headers) as response:
+            fp = io.BytesIO(response.content)
+        if is_encoded(fp.getvalue()):
+            # Compressed chunks have to be retrieved in full
+            with self._header_lock:
+                self._header_lengths[key] = None
+            return None
+        try:
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(fp)
+            elif version == (2, 0):
+                header = np.lib.format.read_array_header_2_0(fp)
+            else:
+                raise ValueError('Unsupported .npy version {}'.format(version))
+        except ValueError as err:
+            raise BadChunk('Chunk {!r}: could not parse NPY header: {}'.format(chunk_name, err))
+        stored_shape, fortran_order, stored_dtype = header
+        if stored_shape != shape or stored_dtype != dtype:
             raise BadChunk('Chunk {!r}: dtype {} and/or shape {} in store '
                            'differs from expected dtype {} and shape {}'
-                           .format(chunk_name, chunk.dtype, chunk.shape,
-                                   dtype, shape))
-        return chunk
+                           .format(chunk_name, stored_dtype, stored_shape, dtype, shape))
+        # Only C-ordered chunks map selections onto a few spans of bytes
+        header_length = None if fortran_order and len(shape) > 1 else fp.tell()
+        with self._header_lock:
+            self._header_lengths[key] = header_length
+        return header_length
+
+    def get_partial_chunk(self, array_name, slices, dtype, index):
+        """Get part of a chunk from the store, i.e. ``chunk[index]``.
+
+        This parses the NPY header of the chunk and issues HTTP range
+        requests (concurrently) for the contiguous spans of bytes that
+        contain the selection. If the selection needs more than
+        :attr:`range_read_max_spans` spans, neighbouring spans are merged,
+        and if it covers more than :attr:`range_read_max_fraction` of the
+        chunk anyway, the whole chunk is retrieved instead.
+
+        See the docstring of :meth:`ChunkStore.get_partial_chunk` for the
+        parameters.
+        """
+        dtype = np.dtype(dtype)
+        chunk_name, shape = self.chunk_metadata(array_name, slices, dtype=dtype)
+        box_shape, spans, run_length, box_index = _byte_spans(index, shape,
+                                                              self.range_read_max_spans)
+        box_size = int(np.prod(box_shape))
+        if box_size == 0:
+            return np.zeros(box_shape, dtype)[box_index]
+        if not spans or box_size > self.range_read_max_fraction * np.prod(shape):
+            return self.get_chunk(array_name, slices, dtype)[index]
+        header_length = self._npy_header_length(array_name, chunk_name, shape, dtype)
+        if header_length is None:
+            return self.get_chunk(array_name, slices, dtype)[index]
+        url = self._chunk_url(chunk_name)
+        object_size = header_length + int(np.prod(shape)) * dtype.itemsize
+        run_bytes = run_length * dtype.itemsize
+        box = np.empty(box_shape, dtype)
+        box_bytes = box.reshape(-1).view(np.uint8)
+
+        def read_span(n_span):
+            n, span = n_span
+            first = header_length + span * dtype.itemsize
+            headers = {'Range': 'bytes={}-{}'.format(first, first + run_bytes - 1),
+                       'Accept-Encoding': 'identity'}
+            with self._request(chunk_name, 'GET', url, headers=headers) as response:
+                data = response.content
+                content_range = response.headers.get('Content-Range', '')
+                retries = _retries(response)
+            if response.status_code == 200:
+                # The server ignored the range, so it sent the whole object
+                data = data[first:first + run_bytes]
+                size = len(response.content)
+            else:
+                size = int(content_range.rpartition('/')[2] or -1)
+            if size != object_size or len(data) != run_bytes:
+                raise BadChunk('Chunk {!r}: object has {} bytes but expected {} '
+                               '(received {} of {} bytes in range)'
+                               .format(chunk_name, size, object_size, len(data), run_bytes))
+            box_bytes[n * run_bytes:(n + 1) * run_bytes] = np.frombuffer(data, np.uint8)
+            return retries
+
+        with self._measure(array_name, 'get') as measurement:
+            measurement.retries = sum(self._map(read_span, enumerate(spans)))
+            measurement.nbytes = len(spans) * run_bytes
+        return box[box_index]
 
     def create_array(self, array_name):
         """See the docstring of :meth:`ChunkStore.create_array`."""
@@ -450,20 +946,23 @@ class S3ChunkStore(ChunkStore):
         """See the docstring of :meth:`ChunkStore.put_chunk`."""
         chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
         url = self._chunk_url(chunk_name)
-        npy_header, chunk = npy_header_and_body(chunk)
+        # The body is either the chunk itself or its compressed version
+        header, body = encode_chunk(chunk, self.codec)
         # Compute the MD5 sum to protect the object against corruption in
         # transmission.
-        md5_gen = hashlib.md5(npy_header)
-        md5_gen.update(chunk)
+        md5_gen = hashlib.md5(header)
+        md5_gen.update(body)
         md5 = base64.b64encode(md5_gen.digest())
         headers = {'Content-MD5': bytes_to_native_str(md5)}
         if future.utils.PY2:
             # Python 2's httplib doesn't support a sequence of byte-likes.
-            data = npy_header + chunk.tobytes()
+            data = header + (body.tobytes() if isinstance(body, np.ndarray) else body)
         else:
-            data = _Multipart([npy_header, memoryview(chunk)])
-        with self._request(chunk_name, 'PUT', url, headers=headers, data=data):
-            pass
+            data = _Multipart([header, memoryview(body)])
+        with self._measure(array_name, 'put') as measurement:
+            with self._request(chunk_name, 'PUT', url, headers=headers, data=data) as response:
+                measurement.retries = _retries(response)
+            measurement.nbytes = len(header) + memoryview(body).nbytes
 
     def has_chunk(self, array_name, slices, dtype):
         """See the docstring of :meth:`ChunkStore.has_chunk`."""
@@ -479,39 +978,135 @@ class S3ChunkStore(ChunkStore):
             return True
 
     list_max_keys = 100000
+    # Maximum number of key ranges listed concurrently for a large array
+    list_partitions = 16
 
-    def list_chunk_ids(self, array_name):
-        """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
+    def _list_page(self, url, prefix, marker=None, max_keys=None):
+        """List one page of object keys in bucket at `url` starting with `prefix`.
+
+        This returns the keys that sort after `marker`, together with the
+        marker for the next page (or None if there are no more pages).
+        """
         NS = '{http://s3.amazonaws.com/doc/2006-03-01/}'
-        bucket, prefix = self.split(array_name, 1)
-        url = urllib.parse.urljoin(self._url, to_str(urllib.parse.quote(bucket)))
         params = {
             'prefix': prefix,
-            'max-keys': self.list_max_keys
+            'max-keys': max_keys or self.list_max_keys
         }
+        if marker is not None:
+            params['marker'] = marker
+        with self._request(None, 'GET', url, params=params) as response:
+            root = defusedxml.cElementTree.fromstring(response.content)
+        keys = [child.text for child in root.iter(NS + 'Key')]
+        truncated = root.find(NS + 'IsTruncated')
+        next_marker = None
+        if truncated is not None and truncated.text == 'true':
+            next_marker = root.find(NS + 'NextMarker')
+            if next_marker is not None:
+                next_marker = next_marker.text
+            elif keys:
+                next_marker = keys[-1]
+            else:
+                warnings.warn('Result had no keys but was marked as truncated')
+        return keys, next_marker
 
+    def _list_range(self, url, prefix, marker, stop=None):
+        """List all keys starting with `prefix` after `marker` and before `stop`."""
         keys = []
-        more = True
-        while more:
-            with self._request(None, 'GET', url, params=params) as response:
-                root = defusedxml.cElementTree.fromstring(response.content)
-            keys.extend(child.text for child in root.iter(NS + 'Key'))
-            truncated = root.find(NS + 'IsTruncated')
-            more = (truncated is not None and truncated.text == 'true')
-            if more:
-                next_marker = root.find(NS + 'NextMarker')
-                if next_marker:
-                    params['marker'] = next_marker.text
-                elif keys:
-                    params['marker'] = keys[-1]
-                else:
-                    warnings.warn('Result had no keys but was marked as truncated')
-                    more = False
+        while marker is not None:
+            page, marker = self._list_page(url, prefix, marker)
+            if stop is not None and page and page[-1] >= stop:
+                page = [key for key in page if key < stop]
+                marker = None
+            keys.extend(page)
+        return keys
+
+    @staticmethod
+    def _leading_index(key, start):
+        """Index along first dimension of chunk with object `key` (or None if not a chunk)."""
+        leading = key[start:].split('_')[0].split('.')[0]
+        return int(leading) if leading.isdigit() else None
+
+    def _leading_indices(self, url, prefix, first_index):
+        """Find dimension-0 chunk indices that split the keys of a large array.
+
+        The chunk ID strings of an array start with the zero-padded index of
+        the chunk along the first dimension. Probe the listing at
+        exponentially spaced indices (concurrently and one key each) to find
+        an upper bound on this index, and then divide the range of indices
+        above `first_index` evenly.
+        """
+        max_index = 10 ** self.NAME_INDEX_WIDTH
+        probes = [2 ** n for n in range(max_index.bit_length()) if first_index < 2 ** n < max_index]
+
+        def probe(index):
+            marker = prefix + '{:0{w}d}'.format(index, w=self.NAME_INDEX_WIDTH)
+            keys, _ = self._list_page(url, prefix, marker, max_keys=1)
+            leading = self._leading_index(keys[0], len(prefix)) if keys else None
+            return leading is not None and leading >= index
+
+        found = [index for (index, has_keys) in zip(probes, self._map(probe, probes)) if has_keys]
+        # The next probe found nothing, so its index bounds the chunk indices
+        if found:
+            stop_index = min(2 * found[-1], max_index)
+        else:
+            stop_index = probes[0] if probes else max_index
+        n_parts = max(min(self.list_partitions, stop_index - first_index), 1)
+        indices = np.linspace(first_index, stop_index, n_parts + 1)[1:-1]
+        return sorted(set(int(index) for index in indices if int(index) > first_index))
+
+    def list_chunk_ids(self, array_name):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`."""
+        # The array name may also refer to a whole bucket
+        bucket, _, prefix = array_name.partition(self.NAME_SEP)
+        url = urllib.parse.urljoin(self._url, to_str(urllib.parse.quote(bucket)))
+        # Only list objects inside the array, and not those of e.g. prefix + '-2'
+        prefix = prefix + self.NAME_SEP if prefix else ''
+        keys, marker = self._list_page(url, prefix)
+        leading = self._leading_index(keys[-1], len(prefix)) if keys and prefix else None
+        if marker is not None and leading is not None:
+            # This is a large array: split the remaining keys into ranges
+            # based on the leading chunk index and list them concurrently
+            indices = self._leading_indices(url, prefix, leading)
+            bounds = [prefix + '{:0{w}d}'.format(index, w=self.NAME_INDEX_WIDTH)
+                      for index in indices]
+            bounds = [bound for bound in bounds if bound > marker]
+            ranges = list(zip([marker] + bounds, bounds + [None]))
+            for range_keys in self._map(lambda r: self._list_range(url, prefix, *r), ranges):
+                keys.extend(range_keys)
+        elif marker is not None:
+            keys.extend(self._list_range(url, prefix, marker))
         # Strip the array name and .npy extension to get the chunk ID string
-        return [key[len(prefix) + 1:-4] for key in keys if key.endswith('.npy')]
+        return [key[len(prefix):-4] for key in keys if key.endswith('.npy')]
+
+    def get_manifest(self, array_name):
+        """See the docstring of :meth:`ChunkStore.get_manifest`."""
+        obj_name = self.join(array_name, 'manifest.json')
+        url = urllib.parse.urljoin(self._url, obj_name)
+        try:
+            with self._request(obj_name, 'GET', url) as response:
+                data = response.content
+        except ChunkNotFound:
+            return None
+        try:
+            return ChunkManifest.from_bytes(data)
+        except ValueError as e:
+            raise BadChunk('Manifest {!r}: {}'.format(obj_name, e))
+
+    def put_manifest(self, array_name, manifest):
+        """See the docstring of :meth:`ChunkStore.put_manifest`."""
+        self.create_array(array_name)
+        obj_name = self.join(array_name, 'manifest.json')
+        url = urllib.parse.urljoin(self._url, obj_name)
+        data = manifest.to_bytes()
+        md5 = base64.b64encode(hashlib.md5(data).digest())
+        headers = {'Content-MD5': bytes_to_native_str(md5)}
+        with self._request(obj_name, 'PUT', url, headers=headers, data=data):
+            pass
 
     def mark_complete(self, array_name):
         """See the docstring of :meth:`ChunkStore.mark_complete`."""
+        # Record the chunks first so that a completed array always has a manifest
+        self.write_manifest(array_name)
         self.create_array(array_name)
         obj_name = self.join(array_name, 'complete')
         url = urllib.parse.urljoin(self._url, obj_name)
@@ -533,5 +1128,7 @@ class S3ChunkStore(ChunkStore):
     put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
     has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
     list_chunk_ids.__doc__ = ChunkStore.list_chunk_ids.__doc__
+    get_manifest.__doc__ = ChunkStore.get_manifest.__doc__
+    put_manifest.__doc__ = ChunkStore.put_manifest.__doc__
     mark_complete.__doc__ = ChunkStore.mark_complete.__doc__
     is_complete.__doc__ = ChunkStore.is_complete.__doc__
@@ -0,0 +1,222 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""A chunk store that looks up chunks in an ordered list of chunk stores."""
+from __future__ import print_function, division, absolute_import
+
+import logging
+import threading
+
+import numpy as np
+
+from .chunkstore import ChunkStore, ChunkStoreError, ChunkNotFound
+
+
+logger = logging.getLogger(__name__)
+
+
+class TieredChunkStore(ChunkStore):
+    """A chunk store that looks up chunks in an ordered list of chunk stores.
+
+    The stores (or *tiers*) are ordered from fastest to slowest, e.g. an
+    :class:`~katdal.chunkstore_npy.NpyFileChunkStore` on local disk followed
+    by an :class:`~katdal.chunkstore_s3.S3ChunkStore`. Each chunk is
+    retrieved from the first tier that has it. If `promote` is True, chunks
+    found in a slower tier are also copied into all faster tiers, so that
+    subsequent requests are served locally. Unlike
+    :class:`~katdal.chunkstore_cache.CachingChunkStore` there is no limit on
+    the size of the faster tiers.
+
+    Writes go through to all tiers (slowest first, so that a chunk only
+    appears in a faster tier once it is safely in the slower ones). The
+    presence checks :meth:`has_chunk`, :meth:`has_array` and
+    :meth:`list_chunk_ids` treat the store as the union of its tiers.
+
+    The :attr:`batch_size` and :attr:`partial_reads` settings are taken from
+    the slowest tier, which also provides the concurrency of the batch
+    methods like :meth:`get_chunks`, since its latency dominates the reads.
+
+    Parameters
+    ----------
+    stores : sequence of :class:`ChunkStore` objects
+        Tiers of chunk store, from fastest to slowest
+    promote : bool, optional
+        True if chunks retrieved from slower tiers are copied to faster tiers
+
+    Attributes
+    ----------
+    tier_hits : list of int
+        Number of :meth:`get_chunk` / :meth:`get_partial_chunk` calls served
+        by each tier
+    promotions : int
+        Number of chunks copied into faster tiers
+
+    Raises
+    ------
+    ValueError
+        If no stores are provided
+    """
+
+    def __init__(self, stores, promote=True):
+        super(TieredChunkStore, self).__init__()
+        self.stores = list(stores)
+        if not self.stores:
+            raise ValueError('TieredChunkStore needs at least one chunk store')
+        self.batch_size = self.stores[-1].batch_size
+        self.partial_reads = self.stores[-1].partial_reads
+        self.promote = promote
+        self.tier_hits = [0] * len(self.stores)
+        self.promotions = 0
+        self._lock = threading.Lock()
+
+    def _promote(self, tiers, array_name, slices, chunk):
+        """Copy chunk into given (faster) tiers, without failing the read."""
+        for store in tiers:
+            try:
+                store.create_array(array_name)
+                store.put_chunk(array_name, slices, chunk)
+            except (OSError, ChunkStoreError, NotImplementedError) as e:
+                chunk_name, _ = self.chunk_metadata(array_name, slices, chunk=chunk)
+                logger.warning('Could not promote chunk %r to %r: %s', chunk_name, store, e)
+            else:
+                with self._lock:
+                    self.promotions += 1
+
+    def _map(self, func, items):
+        # Batches are as concurrent as the slowest tier would make them
+        return self.stores[-1]._map(func, items)
+
+    def get_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.get_chunk`."""
+        for tier, store in enumerate(self.stores):
+            try:
+                chunk = store.get_chunk(array_name, slices, dtype)
+            except ChunkNotFound:
+                continue
+            with self._lock:
+                self.tier_hits[tier] += 1
+            if self.promote and tier > 0:
+                self._promote(self.stores[:tier], array_name, slices, chunk)
+            return chunk
+        chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
+        raise ChunkNotFound('Chunk {!r} not found in any tier'.format(chunk_name))
+
+    def get_chunk_into(self, array_name, slices, dtype, out):
+        """See the docstring of :meth:`ChunkStore.get_chunk_into`."""
+        chunk_name, _ = self._check_out(array_name, slices, out)
+        for tier, store in enumerate(self.stores):
+            try:
+                store.get_chunk_into(array_name, slices, dtype, out)
+            except ChunkNotFound:
+                continue
+            with self._lock:
+                self.tier_hits[tier] += 1
+            if self.promote and tier > 0:
+                self._promote(self.stores[:tier], array_name, slices, out)
+            return out
+        raise ChunkNotFound('Chunk {!r} not found in any tier'.format(chunk_name))
+
+    def get_partial_chunk(self, array_name, slices, dtype, index):
+        """See the docstring of :meth:`ChunkStore.get_partial_chunk`.
+
+        Each tier is tried in turn as in :meth:`get_chunk`, but the partial
+        chunk is not promoted to faster tiers.
+        """
+        for tier, store in enumerate(self.stores):
+            try:
+                partial_chunk = store.get_partial_chunk(array_name, slices, dtype, index)
+            except ChunkNotFound:
+                continue
+            with self._lock:
+                self.tier_hits[tier] += 1
+            return partial_chunk
+        chunk_name, _ = self.chunk_metadata(array_name, slices, dtype=dtype)
+        raise ChunkNotFound('Chunk {!r} not found in any tier'.format(chunk_name))
+
+    def create_array(self, array_name):
+        """See the docstring of :meth:`ChunkStore.create_array`."""
+        for store in self.stores:
+            store.create_array(array_name)
+
+    def put_chunk(self, array_name, slices, chunk):
+        """See the docstring of :meth:`ChunkStore.put_chunk`."""
+        for store in reversed(self.stores):
+            store.put_chunk(array_name, slices, chunk)
+
+    def has_chunk(self, array_name, slices, dtype):
+        """See the docstring of :meth:`ChunkStore.has_chunk`."""
+        return any(store.has_chunk(array_name, slices, dtype) for store in self.stores)
+
+    def has_array(self, array_name, chunks, dtype, offset=()):
+        """See the docstring of :meth:`ChunkStore.has_array`.
+
+        Each tier is checked separately (using its own manifest or listing)
+        and a chunk is present if it is in any tier.
+        """
+        success = [store.has_array(array_name, chunks, dtype, offset)
+                   for store in self.stores]
+        return np.logical_or.reduce(success)
+
+    def list_chunk_ids(self, array_name):
+        """See the docstring of :meth:`ChunkStore.list_chunk_ids`.
+
+        This lists the union of the chunks in all tiers that can be listed.
+        """
+        chunk_ids = set()
+        listed = False
+        for store in self.stores:
+            try:
+                chunk_ids.update(store.list_chunk_ids(array_name))
+            except NotImplementedError:
+                continue
+            listed = True
+        if not listed:
+            raise NotImplementedError
+        return sorted(chunk_ids)
+
+    def mark_complete(self, array_name):
+        """See the docstring of :meth:`ChunkStore.mark_complete`."""
+        marked = False
+        for store in self.stores:
+            try:
+                store.mark_complete(array_name)
+            except NotImplementedError:
+                continue
+            marked = True
+        if not marked:
+            raise NotImplementedError
+
+    def is_complete(self, array_name):
+        """See the docstring of :meth:`ChunkStore.is_complete`."""
+        checked = False
+        for store in self.stores:
+            try:
+                if store.is_complete(array_name):
+                    return True
+            except NotImplementedError:
+                continue
+            checked = True
+        if not checked:
+            raise NotImplementedError
+        return False
+
+    get_chunk.__doc__ = ChunkStore.get_chunk.__doc__
+    get_chunk_into.__doc__ = ChunkStore.get_chunk_into.__doc__
+    create_array.__doc__ = ChunkStore.create_array.__doc__
+    put_chunk.__doc__ = ChunkStore.put_chunk.__doc__
+    has_chunk.__doc__ = ChunkStore.has_chunk.__doc__
+    mark_complete.__doc__ = ChunkStore.mark_complete.__doc__
+    is_complete.__doc__ = ChunkStore.is_complete.__doc__
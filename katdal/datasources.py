@@ -23,19 +23,22 @@ from builtins import zip, object
 import urllib.parse
 import os
 import logging
-from collections import defaultdict
 
 import katsdptelstate
 import katsdptelstate.memory
 import numpy as np
 import dask.array as da
-from dask.array.rechunk import intersect_chunks
 import numba
 
 from .sensordata import TelstateSensorData, TelstateToStr
+from .chunkstore import ChunkCache, ChunkStoreStats, check_codec, _as_bool
 from .chunkstore_s3 import S3ChunkStore
 from .chunkstore_npy import NpyFileChunkStore
-from .flags import DATA_LOST
+from .chunkstore_pack import PackFileChunkStore, contains_packs
+from .chunkstore_cache import CachingChunkStore
+from .chunkstore_tiered import TieredChunkStore
+from .flags import DATA_LOST, POSTPROC
+from .applycal import apply_vis_correction, apply_flags_correction, apply_weights_correction
 
 
 logger = logging.getLogger(__name__)
@@ -92,13 +95,106 @@ class VisFlagsWeights(object):
     def shape(self):
         return self.vis.shape
 
+    def corrected_vis(self, correction=None):
+        """Visibilities with `correction` applied (if not None).
 
-def _apply_data_lost(orig_flags, lost, block_id):
-    mark = lost.get(block_id)
-    if not mark:
-        return orig_flags    # Common case - no data lost
-    flags = orig_flags.copy()
-    for idx in mark:
+        Parameters
+        ----------
+        correction : :class:`dask.array.Array` of complex64, shape (*T*, *F*, *B*), optional
+            Correction per visibility (see :func:`katdal.applycal.calc_correction`)
+        """
+        if correction is None:
+            return self.vis
+        return da.core.elemwise(apply_vis_correction, self.vis, correction, dtype=self.vis.dtype)
+
+    def corrected_weights(self, correction=None):
+        """Weights with `correction` applied (if not None).
+
+        Parameters
+        ----------
+        correction : :class:`dask.array.Array` of complex64, shape (*T*, *F*, *B*), optional
+            Correction per visibility (see :func:`katdal.applycal.calc_correction`)
+        """
+        if correction is None:
+            return self.weights
+        return da.core.elemwise(apply_weights_correction, self.weights, correction,
+                                dtype=self.weights.dtype)
+
+    def corrected_flags(self, correction=None, select=0xFF):
+        """Boolean flags with `correction` applied, keeping only selected flag types.
+
+        Parameters
+        ----------
+        correction : :class:`dask.array.Array` of complex64, shape (*T*, *F*, *B*), optional
+            Correction per visibility (see :func:`katdal.applycal.calc_correction`).
+            Visibilities with an invalid correction are flagged as 'postproc'.
+        select : int, optional
+            Bit mask of the flag types that are kept (all by default)
+        """
+        flags = self.flags
+        if correction is not None:
+            flags = da.core.elemwise(apply_flags_correction, flags, correction, dtype=flags.dtype)
+        select = np.uint8(select)
+        if ~select != 0:
+            flags = da.bitwise_and(select, flags)
+        return flags.view(np.bool_)
+
+
+def _chunk_bounds(chunks):
+    """Turn chunk specification into boundaries of chunks along each dimension."""
+    return [np.cumsum((0,) + tuple(c)) for c in chunks]
+
+
+def _lost_regions(lost, flags_bounds, block_id):
+    """Find the regions of a block of flags where other arrays have missing chunks.
+
+    This works out which missing chunks overlap with the given block of
+    flags when the block is computed, instead of doing it for all blocks up
+    front.
+
+    Parameters
+    ----------
+    lost : list of pairs of (:class:`numpy.ndarray` of bool, list of arrays)
+        Indicator of missing chunks per array, along with the chunk boundaries
+        of that array (see :func:`_chunk_bounds`). The arrays may have fewer
+        dimensions than the flags, in which case the missing chunks extend
+        over the remaining dimensions.
+    flags_bounds : list of arrays
+        Chunk boundaries of the full flags array
+    block_id : tuple of int
+        Index of the block of flags
+
+    Yields
+    ------
+    index : tuple of slice
+        Index into the block of flags of a region covered by a missing chunk
+    """
+    location = [(bounds[i], bounds[i + 1]) for (bounds, i) in zip(flags_bounds, block_id)]
+    for missing, bounds in lost:
+        # Find the range of chunks of the array that overlap with the block
+        ranges = tuple(slice(np.searchsorted(dim_bounds, start, side='right') - 1,
+                             np.searchsorted(dim_bounds, stop, side='left'))
+                       for ((start, stop), dim_bounds) in zip(location, bounds))
+        for index in zip(*np.nonzero(missing[ranges])):
+            chunk = [r.start + i for (r, i) in zip(ranges, index)]
+            yield tuple(slice(max(dim_bounds[c], start) - start, min(dim_bounds[c + 1], stop) - start)
+                        for (c, dim_bounds, (start, stop)) in zip(chunk, bounds, location))
+
+
+def _apply_data_lost(orig_flags, lost, flags_bounds, block_id):
+    """Set the DATA_LOST flag where chunks of other arrays are missing.
+
+    Parameters
+    ----------
+    orig_flags : :class:`numpy.ndarray`
+        Block of flags
+    lost, flags_bounds, block_id
+        See :func:`_lost_regions`
+    """
+    flags = orig_flags
+    for idx in _lost_regions(lost, flags_bounds, block_id):
+        if flags is orig_flags:
+            flags = orig_flags.copy()
         flags[idx] |= DATA_LOST
     return flags
 
@@ -164,11 +260,26 @@ def corrprod_to_autocorr(corrprods):
     return _narrow(np.array(auto_indices)), _narrow(np.array(index1)), _narrow(np.array(index2))
 
 
+@numba.jit(nopython=True, nogil=True)
+def _power_scale(scale1, scale2):
+    """Weight scale factor of a baseline from reciprocal autocorrelation powers."""
+    p = scale1 * scale2
+    # If either or both of the autocorrelations has zero power then
+    # there is likely something wrong with the system. Set the
+    # weight to very close to zero (not actually zero, since that
+    # can cause divide-by-zero problems downstream).
+    if not np.isfinite(p):
+        p = np.float32(2.0**-32)
+    return p
+
+
 @numba.jit(nopython=True, nogil=True)
 def weight_power_scale(vis, weights, auto_indices, index1, index2, out=None):
     """Compute scaled weights from visibility data.
 
     This function is designed to be usable with :func:`dask.array.blockwise`.
+    It is kept for API compatibility, since :class:`ChunkStoreVisFlagsWeights`
+    now folds the same scaling into a single pass over the weights.
 
     Parameters
     ----------
@@ -185,23 +296,76 @@ def weight_power_scale(vis, weights, auto_indices, index1, index2, out=None):
     """
     auto_scale = np.empty(len(auto_indices), np.float32)
     out = np.empty(vis.shape, np.float32) if out is None else out
-    bad_weight = np.float32(2.0**-32)
     for i in range(vis.shape[0]):
         for j in range(vis.shape[1]):
             for k in range(len(auto_indices)):
                 auto_scale[k] = np.reciprocal(vis[i, j, auto_indices[k]].real)
             for k in range(vis.shape[2]):
-                p = auto_scale[index1[k]] * auto_scale[index2[k]]
-                # If either or both of the autocorrelations has zero power then
-                # there is likely something wrong with the system. Set the
-                # weight to very close to zero (not actually zero, since that
-                # can cause divide-by-zero problems downstream).
-                if not np.isfinite(p):
-                    p = bad_weight
+                p = _power_scale(auto_scale[index1[k]], auto_scale[index2[k]])
                 out[i, j, k] = p * weights[i, j, k]
     return out
 
 
+@numba.jit(nopython=True, nogil=True)
+def _fused_weights(weights, weights_channel, auto_scale, index1, index2, correction):
+    """Produce final weights from their ingredients in a single pass.
+
+    This is equivalent to multiplying `weights` by `weights_channel`, scaling
+    the result by :func:`weight_power_scale` (unless `auto_scale` is None) and
+    then applying :func:`~katdal.applycal.apply_weights_correction` (unless
+    `correction` is None), but without any intermediate arrays. The power
+    scaling uses the reciprocal autocorrelation powers in `auto_scale`, with
+    dimensions time, frequency and autocorrelation, so that `weights` may be
+    any subset of the baselines, as long as `index1` and `index2` refer to
+    the same subset.
+    """
+    out = np.empty(weights.shape, np.float32)
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            for k in range(out.shape[2]):
+                w = np.float32(weights[i, j, k]) * weights_channel[i, j]
+                if auto_scale is not None:
+                    w = _power_scale(auto_scale[i, j, index1[k]], auto_scale[i, j, index2[k]]) * w
+                if correction is not None:
+                    cc = correction[i, j, k]
+                    c = cc.real**2 + cc.imag**2
+                    if c > 0:   # Will be false if c is NaN
+                        w = w / c
+                    else:
+                        w = np.float32(0)
+                out[i, j, k] = w
+    return out
+
+
+@numba.jit(nopython=True, nogil=True)
+def _fused_flags(flags, correction, select):
+    """Apply `correction` to `flags` and keep `select` flag bits as booleans.
+
+    This is equivalent to :func:`~katdal.applycal.apply_flags_correction`
+    (unless `correction` is None) followed by a bitwise AND with `select`
+    and a conversion to bool, but without any intermediate arrays.
+    """
+    out = np.empty(flags.shape, np.bool_)
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            for k in range(out.shape[2]):
+                f = flags[i, j, k]
+                if correction is not None:
+                    if np.isnan(correction[i, j, k]):
+                        f |= POSTPROC
+                out[i, j, k] = (f & select) != 0
+    return out
+
+
+def _corrected_flags(flags, correction, select, lost, flags_bounds, block_id):
+    """Block function combining :func:`_fused_flags` and DATA_LOST flags."""
+    out = _fused_flags(flags, correction, select)
+    if select & DATA_LOST:
+        for idx in _lost_regions(lost, flags_bounds, block_id):
+            out[idx] = True
+    return out
+
+
 class ChunkStoreVisFlagsWeights(VisFlagsWeights):
     """Correlator data stored in a chunk store.
 
@@ -210,7 +374,8 @@ class ChunkStoreVisFlagsWeights(VisFlagsWeights):
     store : :class:`ChunkStore` object
         Chunk store
     chunk_info : dict mapping array name to info dict
-        Dict specifying prefix, dtype, shape and chunks per array
+        Dict specifying prefix, dtype, shape and chunks per array (and
+        optionally the codec used to compress the chunks)
     corrprods : sequence of 2-tuples of input labels
         Correlation products. If given, the weights for baseline (inp1, inp2)
         will be divided by the square root of the product of the corresponding
@@ -220,54 +385,80 @@ class ChunkStoreVisFlagsWeights(VisFlagsWeights):
     ----------
     vis_prefix : string
         Prefix of correlator_data / visibility array, viz. its S3 bucket name
+
+    Raises
+    ------
+    ImportError
+        If the arrays are compressed with a codec that is not installed
     """
     def __init__(self, store, chunk_info, corrprods):
         self.store = store
         self.vis_prefix = chunk_info['correlator_data']['prefix']
         darray = {}
-        has_arrays = []
+        lost = []
         for array, info in chunk_info.items():
+            # The store detects the codec by itself, but fail early if it is missing
+            check_codec(info.get('codec'))
             array_name = store.join(info['prefix'], array)
             chunk_args = (array_name, info['chunks'], info['dtype'])
             darray[array] = store.get_dask_array(*chunk_args)
-            # Find all missing chunks in array and convert to 'data_lost' flags
-            has_arrays.append((store.has_array(array_name, info['chunks'], info['dtype']),
-                               info['chunks']))
+            # Find all missing chunks in array, to be turned into 'data_lost' flags
+            has_array = store.has_array(array_name, info['chunks'], info['dtype'])
+            if not has_array.all():
+                lost.append((~has_array, _chunk_bounds(info['chunks'])))
         vis = darray['correlator_data']
         flags_raw_name = store.join(chunk_info['flags']['prefix'], 'flags_raw')
         # Combine original flags with data_lost indicating where values were lost from
-        # other arrays.
-        lost = defaultdict(list)  # Maps chunk index to list of index expressions to mark as lost
-        for has_array, chunks in has_arrays:
-            # array may have fewer dimensions than flags
-            # (specifically, for weights_channel).
-            if has_array.ndim < darray['flags'].ndim:
-                chunks += tuple((x,) for x in darray['flags'].shape[has_array.ndim:])
-            intersections = intersect_chunks(darray['flags'].chunks, chunks)
-            for has, pieces in zip(has_array.flat, intersections):
-                if not has:
-                    for piece in pieces:
-                        chunk_idx, slices = zip(*piece)
-                        lost[chunk_idx].append(slices)
+        # other arrays. The overlaps are only worked out per block of flags as needed.
         flags = da.map_blocks(_apply_data_lost, darray['flags'], dtype=np.uint8,
-                              name=flags_raw_name, lost=lost)
-        # Combine low-resolution weights and high-resolution weights_channel
-        weights = darray['weights'] * darray['weights_channel'][..., np.newaxis]
+                              name=flags_raw_name, lost=lost,
+                              flags_bounds=_chunk_bounds(darray['flags'].chunks))
+        weights = darray['weights']
         # Scale weights according to power
+        self._power_scale = (None, None, None)
         if corrprods is not None:
             assert len(corrprods) == vis.shape[2]
-            # Ensure that we have only a single chunk on the baseline axis.
-            if len(vis.chunks[2]) > 1:
-                vis = vis.rechunk({2: vis.shape[2]})
-            if len(weights.chunks[2]) > 1:
-                weights = weights.rechunk({2: weights.shape[2]})
             auto_indices, index1, index2 = corrprod_to_autocorr(corrprods)
-            weights = da.blockwise(weight_power_scale, 'ijk', vis, 'ijk', weights, 'ijk',
-                                   dtype=np.float32,
-                                   auto_indices=auto_indices, index1=index1, index2=index2)
+            # Gather the reciprocal autocorrelation powers into a small side array
+            # with a single chunk on the baseline axis, which serves every chunk of
+            # weights, so that the vis and weights keep their chunking on that axis.
+            auto_scale = da.reciprocal(vis[:, :, auto_indices].real).rechunk({2: -1})
+            baseline_chunks = (weights.chunks[2],)
+            self._power_scale = (auto_scale, da.from_array(index1, chunks=baseline_chunks),
+                                 da.from_array(index2, chunks=baseline_chunks))
+        # Keep the ingredients of flags and weights around for fused corrections
+        self._raw_flags = darray['flags']
+        self._raw_weights = weights
+        self._weights_channel = darray['weights_channel']
+        self._lost = lost
+        # Combine low-resolution weights and high-resolution weights_channel
+        weights = self.corrected_weights()
 
         VisFlagsWeights.__init__(self, vis, flags, weights, self.vis_prefix)
 
+    def corrected_weights(self, correction=None):
+        # Compute weights straight from the stored arrays in one pass per chunk
+        auto_scale, index1, index2 = self._power_scale
+        power_scale = auto_scale is not None
+        args = [self._raw_weights, 'ijk', self._weights_channel, 'ij',
+                auto_scale, 'ija' if power_scale else None,
+                index1, 'k' if power_scale else None, index2, 'k' if power_scale else None,
+                correction, 'ijk' if correction is not None else None]
+        # The autocorrelation axis 'a' has a single chunk that each block gets in full
+        return da.blockwise(_fused_weights, 'ijk', *args, dtype=np.float32, concatenate=True)
+
+    def corrected_flags(self, correction=None, select=0xFF):
+        # Correct and select flags (including DATA_LOST) in one pass per chunk
+        flags = self._raw_flags
+        if correction is not None:
+            _, (flags, correction) = da.core.unify_chunks(flags, 'ijk', correction, 'ijk')
+        return da.map_blocks(_corrected_flags, flags, correction, dtype=np.bool_,
+                             select=int(select), lost=self._lost,
+                             flags_bounds=_chunk_bounds(flags.chunks))
+
+    corrected_weights.__doc__ = VisFlagsWeights.corrected_weights.__doc__
+    corrected_flags.__doc__ = VisFlagsWeights.corrected_flags.__doc__
+
 
 class DataSource(object):
     """A generic data source presenting both correlator data and metadata.
@@ -281,11 +472,17 @@ class DataSource(object):
     data : :class:`VisFlagsWeights` object, optional
         Correlator data (visibilities, flags and weights)
 
+    Attributes
+    ----------
+    cache_dir : string or None
+        Directory of the local chunk cache, if the source has one
+
     """
     def __init__(self, metadata, timestamps, data=None):
         self.metadata = metadata
         self.timestamps = timestamps
         self.data = data
+        self.cache_dir = None
 
     @property
     def name(self):
@@ -465,7 +662,10 @@ def _align_chunk_info(chunk_info):
 
 
 def infer_chunk_store(url_parts, telstate, npy_store_path=None,
-                      s3_endpoint_url=None, array='correlator_data', **kwargs):
+                      s3_endpoint_url=None, array='correlator_data',
+                      local_store_path=None, promote=True,
+                      cache_dir=None, cache_size=None, memory_cache_size=None,
+                      chunk_stats=False, chunk_stats_interval=None, **kwargs):
     """Construct chunk store automatically from dataset URL and telstate.
 
     Parameters
@@ -480,6 +680,31 @@ def infer_chunk_store(url_parts, telstate, npy_store_path=None,
         Endpoint of S3 service, e.g. 'http://127.0.0.1:9000' (overrides default)
     array : string, optional
         Array within the bucket from which to determine the prefix
+    local_store_path : string, optional
+        Top-level directory of a local NpyFileChunkStore that is searched
+        for chunks first, by combining it with the inferred store in a
+        :class:`TieredChunkStore` (no local store if None or empty)
+    promote : bool or string, optional
+        Copy chunks not found in the local store to it once retrieved
+    cache_dir : string, optional
+        Keep a local on-disk cache of chunks in this directory (no cache if
+        None or empty), by wrapping the store in a :class:`CachingChunkStore`
+    cache_size : int or float or string, optional
+        Upper limit on size of local chunk cache, in bytes (default 10 GB)
+    memory_cache_size : int or float or string, optional
+        Keep up to this many bytes of recently used chunks in an in-memory
+        :class:`ChunkCache` shared by all dask tasks (no cache if None or 0)
+    chunk_stats : bool or string, optional
+        Keep request, byte and latency statistics of the inferred store in a
+        :class:`ChunkStoreStats` object, available as the `stats` attribute
+        of the returned store
+    chunk_stats_interval : float or string, optional
+        Also log these statistics at this interval, in seconds (this implies
+        `chunk_stats`)
+    mmap : bool or string, optional
+        Memory-map chunks of an :class:`NpyFileChunkStore` instead of reading them
+    prefetch : bool or string, optional
+        Advise the OS to read memory-mapped chunk files ahead of access
     kwargs : dict, optional
         Extra keyword arguments, typically meant for other methods and ignored
 
@@ -495,14 +720,38 @@ def infer_chunk_store(url_parts, telstate, npy_store_path=None,
     :exc:`katdal.chunkstore.StoreUnavailable`
         If the chunk store could not be constructed
     """
+    store = _infer_base_chunk_store(url_parts, telstate, npy_store_path,
+                                    s3_endpoint_url, array, **kwargs)
+    if chunk_stats_interval is not None or _as_bool(chunk_stats):
+        interval = None if chunk_stats_interval is None else float(chunk_stats_interval)
+        store.stats = ChunkStoreStats(interval)
+    stats = store.stats
+    if local_store_path:
+        store = TieredChunkStore([NpyFileChunkStore(local_store_path), store], _as_bool(promote))
+    if cache_dir:
+        # Sizes may arrive as strings from the query part of a dataset URL
+        cache_kwargs = {} if cache_size is None else {'max_bytes': float(cache_size)}
+        store = CachingChunkStore(store, cache_dir, **cache_kwargs)
+    if memory_cache_size and float(memory_cache_size) > 0:
+        store.chunk_cache = ChunkCache(float(memory_cache_size))
+    # Only the inferred store keeps statistics, but make them easy to find
+    store.stats = stats
+    return store
+
+
+def _infer_base_chunk_store(url_parts, telstate, npy_store_path,
+                            s3_endpoint_url, array, mmap=False, prefetch=False,
+                            **kwargs):
+    """Construct underlying chunk store (see :func:`infer_chunk_store`)."""
+    npy_kwargs = {'mmap': _as_bool(mmap), 'prefetch': _as_bool(prefetch)}
     # Use overrides if provided, regardless of URL and telstate (NPY first)
     if npy_store_path:
-        return NpyFileChunkStore(npy_store_path)
+        return NpyFileChunkStore(npy_store_path, **npy_kwargs)
     if s3_endpoint_url:
         return S3ChunkStore.from_url(s3_endpoint_url, **kwargs)
     # NPY chunk store is an option if the dataset is an RDB file
     if url_parts.scheme == 'file':
-        # Look for adjacent data directory (presumably containing NPY files)
+        # Look for adjacent data directory (containing NPY or pack files)
         rdb_path = os.path.abspath(url_parts.path)
         store_path = os.path.dirname(os.path.dirname(rdb_path))
         chunk_info = telstate['chunk_info']
@@ -510,7 +759,9 @@ def infer_chunk_store(url_parts, telstate, npy_store_path=None,
         vis_prefix = chunk_info[array]['prefix']
         data_path = os.path.join(store_path, vis_prefix)
         if os.path.isdir(data_path):
-            return NpyFileChunkStore(store_path)
+            if contains_packs(os.path.join(data_path, array)):
+                return PackFileChunkStore(store_path)
+            return NpyFileChunkStore(store_path, **npy_kwargs)
     return S3ChunkStore.from_url(telstate['s3_endpoint_url'], **kwargs)
 
 
@@ -646,8 +897,11 @@ class TelstateDataSource(DataSource):
         telstate, capture_block_id, stream_name = view_l0_capture_stream(telstate, **kwargs)
         if chunk_store == 'auto':
             chunk_store = infer_chunk_store(url_parts, telstate, **kwargs)
-        return cls(telstate, capture_block_id, stream_name,
-                   chunk_store, source_name=url_parts.geturl(), upgrade_flags=upgrade_flags)
+        source = cls(telstate, capture_block_id, stream_name,
+                     chunk_store, source_name=url_parts.geturl(), upgrade_flags=upgrade_flags)
+        # The cache directory may also hold other local products of the data
+        source.cache_dir = kwargs.get('cache_dir') or None
+        return source
 
 
 def open_data_source(url, **kwargs):
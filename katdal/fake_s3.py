@@ -0,0 +1,249 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""A minimal in-process S3 server for testing and benchmarking :class:`S3ChunkStore`.
+
+It keeps objects in memory and implements just enough of the S3 API for the
+chunk store: creating buckets (and setting their policy), putting, getting
+(also by byte range) and checking objects, and listing the objects in a
+bucket. There is no authentication. A configurable delay per object request
+simulates the latency of a real (remote) service, including occasional slow
+responses, and an optional bandwidth limit adds a delay proportional to the
+size of each response.
+"""
+from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()  # noqa: E402
+
+import threading
+import time
+import http.server
+import socketserver
+import urllib.parse
+from xml.sax.saxutils import escape
+
+
+_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class _FakeS3RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve S3 requests from the dict of buckets of a :class:`FakeS3Server`."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so without this a keep-alive
+    # connection waits for a delayed ACK (about 40 ms) on every response
+    disable_nagle_algorithm = True
+
+    def _parse_path(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(parsed.path).lstrip('/')
+        bucket, _, key = path.partition('/')
+        query = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+        return bucket, key, dict((k, v[0]) for (k, v) in query.items())
+
+    def _send(self, status, body=b'', content_type='application/xml', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_error(self, status, code):
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{}</Code></Error>'
+        self._send(status, body.format(code).encode('utf-8'))
+
+    def _list_bucket(self, bucket, query):
+        objects = self.server.buckets[bucket]
+        with self.server.lock:
+            self.server.list_requests += 1
+        prefix = query.get('prefix', '')
+        marker = query.get('marker', '')
+        max_keys = int(query.get('max-keys', 1000))
+        with self.server.lock:
+            keys = sorted(key for key in objects
+                          if key.startswith(prefix) and key > marker)
+        truncated = len(keys) > max_keys
+        contents = ''.join('<Contents><Key>{}</Key></Contents>'.format(escape(key))
+                           for key in keys[:max_keys])
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<ListBucketResult xmlns="{}"><Name>{}</Name><Prefix>{}</Prefix>'
+                '<IsTruncated>{}</IsTruncated>{}</ListBucketResult>'
+                .format(_NS, escape(bucket), escape(prefix),
+                        'true' if truncated else 'false', contents))
+        self._send(200, body.encode('utf-8'))
+
+    def _throttle(self, nbytes):
+        """Delay sending `nbytes` of object data according to server bandwidth."""
+        if self.server.bandwidth and self.command != 'HEAD':
+            time.sleep(nbytes / self.server.bandwidth)
+
+    def _get_object(self, bucket, key):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            if server.in_flight >= server.hold_until:
+                server._released.set()
+        try:
+            # Hold requests until enough of them overlap (or give up eventually)
+            if server.hold_until:
+                server._released.wait(server.hold_timeout)
+            latency = server.latency() if callable(server.latency) else server.latency
+            if latency:
+                time.sleep(latency)
+            with server.lock:
+                data = server.buckets[bucket].get(key)
+            # Only a single range of the form 'bytes=first-last' is supported
+            byte_range = self.headers.get('Range', '')
+            if data is None:
+                self._send_error(404, 'NoSuchKey')
+            elif byte_range.startswith('bytes='):
+                first, last = [int(b) for b in byte_range[6:].split('-')]
+                if first >= len(data):
+                    self._send_error(416, 'InvalidRange')
+                    return
+                last = min(last, len(data) - 1)
+                content_range = 'bytes {}-{}/{}'.format(first, last, len(data))
+                self._throttle(last + 1 - first)
+                self._send(206, data[first:last + 1], 'application/octet-stream',
+                           [('Content-Range', content_range)])
+                with server.lock:
+                    server.bytes_sent += last + 1 - first
+            else:
+                self._throttle(len(data))
+                self._send(200, data, 'application/octet-stream')
+                with server.lock:
+                    server.bytes_sent += len(data)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def do_GET(self):
+        bucket, key, query = self._parse_path()
+        if not bucket:
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<ListAllMyBucketsResult xmlns="{}"><Buckets/></ListAllMyBucketsResult>'
+                    .format(_NS))
+            self._send(200, body.encode('utf-8'))
+        elif bucket not in self.server.buckets:
+            self._send_error(404, 'NoSuchBucket')
+        elif not key:
+            self._list_bucket(bucket, query)
+        else:
+            self._get_object(bucket, key)
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        bucket, key, query = self._parse_path()
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        buckets = self.server.buckets
+        with self.server.lock:
+            if not key:
+                if 'policy' in query:
+                    status = 204 if bucket in buckets else 404
+                elif bucket in buckets:
+                    status = 409
+                else:
+                    buckets[bucket] = {}
+                    status = 200
+            elif bucket in buckets:
+                buckets[bucket][key] = data
+                status = 200
+            else:
+                status = 404
+        if status == 409:
+            self._send_error(status, 'BucketAlreadyOwnedByYou')
+        elif status == 404:
+            self._send_error(status, 'NoSuchBucket')
+        else:
+            self._send(status)
+
+    def log_message(self, format, *args):
+        # Keep quiet during normal operation
+        pass
+
+
+class FakeS3Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """In-memory S3 service on a local port, served by a background thread.
+
+    Parameters
+    ----------
+    host : string, optional
+        Address on which to listen (an unused port is picked automatically)
+    latency : float or callable, optional
+        Delay added to each object GET / HEAD request, in seconds (or a
+        function without arguments returning the delay of each request)
+    bandwidth : float, optional
+        Rate at which each object is served, in bytes per second (this is
+        unlimited by default and applies to every request independently)
+
+    Attributes
+    ----------
+    url : string
+        Base URL of service, to be passed to :meth:`S3ChunkStore.from_url`
+    buckets : dict mapping string to dict mapping string to bytes
+        Contents of the store as bucket name -> object key -> object data
+    requests : int
+        Number of object GET / HEAD requests served so far
+    bytes_sent : int
+        Number of bytes of object data sent by GET requests so far
+    max_in_flight : int
+        Largest number of object requests that were handled concurrently
+    list_requests : int
+        Number of bucket listing requests served so far
+    hold_until : int
+        If nonzero, object requests are held back until this many of them are
+        in flight at once (or `hold_timeout` seconds pass), which ensures that
+        concurrent clients overlap without depending on wall-clock timing
+    hold_timeout : float
+        Maximum time that a request is held back, in seconds
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', latency=0.0, bandwidth=None):
+        # In Python 2.7 HTTPServer is an old-style class, so super doesn't work
+        http.server.HTTPServer.__init__(self, (host, 0), _FakeS3RequestHandler)
+        self.url = 'http://{}:{}'.format(*self.server_address[:2])
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.requests = self.in_flight = self.max_in_flight = self.bytes_sent = 0
+        self.list_requests = 0
+        self.hold_until = 0
+        self.hold_timeout = 5.0
+        self._released = threading.Event()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reset_counters(self):
+        """Reset the request statistics."""
+        with self.lock:
+            self.requests = self.max_in_flight = self.bytes_sent = 0
+            self.list_requests = 0
+            self._released.clear()
+
+    def close(self):
+        """Stop serving requests and release the port."""
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
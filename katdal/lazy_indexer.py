@@ -18,12 +18,17 @@
 from __future__ import print_function, division, absolute_import
 from builtins import zip, range, object
 
+import sys
 import copy
+import itertools
 import threading
+from collections import OrderedDict
 from numbers import Integral
 from functools import reduce, partial
 
+from future.utils import raise_
 import numpy as np
+import dask
 import dask.array as da
 import dask.optimization
 
@@ -462,6 +467,354 @@ class LazyIndexer(object):
                       self.transforms, self._initial_dtype)
 
 
+def _chunk_getter(x):
+    """The getter that retrieves the chunks of dask array `x` from a chunk store.
+
+    This recognises the arrays produced by
+    :meth:`katdal.chunkstore.ChunkStore.get_dask_array` by the getter in
+    their graphs, which is able to read a chunk into an existing array via
+    its `get_chunk_into` method. Return None for all other arrays.
+    """
+    key = (x.name,) + x.ndim * (0,)
+    try:
+        task = x.__dask_graph__()[key]
+    except (KeyError, TypeError):
+        return None
+    getter = task[0] if isinstance(task, tuple) and task else None
+    return getter if hasattr(getter, 'get_chunk_into') else None
+
+
+def _oindex_positions(indices, shape):
+    """Turn an oindex expression into the selected positions along each axis.
+
+    This returns None if `indices` drops axes or adds new ones.
+    """
+    indices = da.slicing.normalize_index(indices, shape)
+    if len(indices) != len(shape):
+        return None
+    positions = []
+    for index, length in zip(indices, shape):
+        if isinstance(index, slice):
+            positions.append(np.arange(length)[index])
+        elif isinstance(index, np.ndarray) and index.ndim == 1:
+            if index.dtype == np.bool_:
+                positions.append(np.flatnonzero(index))
+            else:
+                positions.append(np.where(index < 0, index + length, index))
+        else:
+            return None
+    return positions
+
+
+def _chunk_runs(positions, chunks):
+    """Split selected positions along an axis into whole chunks.
+
+    This returns a list of (`chunk_slice`, `out_slice`) pairs indicating
+    that the elements `chunk_slice` of the array end up in `out_slice` of
+    the selection, or None if the selection is not made up of whole chunks.
+    """
+    bounds = np.cumsum((0,) + tuple(chunks))
+    runs = []
+    i = 0
+    while i < len(positions):
+        start = positions[i]
+        n = int(np.searchsorted(bounds, start, side='right')) - 1
+        stop = bounds[n + 1]
+        size = stop - start
+        if bounds[n] != start or not np.array_equal(positions[i:i + size],
+                                                    np.arange(start, stop)):
+            return None
+        runs.append((slice(int(start), int(stop)), slice(i, i + size)))
+        i += size
+    return runs
+
+
+def _read_chunk_into(getter, chunk_slices, dest):
+    """Get chunk at `chunk_slices` into `dest` via `getter`, staging it if needed.
+
+    Chunk stores can only read chunk data in place if the destination is
+    C-contiguous. The slot of a chunk in the output array is contiguous if
+    the chunk covers the whole output along every axis after its first axis
+    longer than one element. For (time, freq, baseline) visibilities this
+    holds for single-dump chunks that span all selected baselines (whatever
+    their frequency range), and for multi-dump chunks that span all selected
+    channels and baselines. Only other chunks (e.g. several dumps by a range
+    of channels) are read into a contiguous staging buffer and then copied.
+    """
+    if dest.flags.c_contiguous:
+        getter.get_chunk_into(chunk_slices, dest)
+    else:
+        dest[()] = getter.get_chunk_into(chunk_slices, np.empty(dest.shape, getter.dtype))
+    return dest
+
+
+def _compute(arrays, keep, out=None):
+    """Index dask arrays underlying `arrays` by `keep` and compute the result.
+
+    Arrays that come straight from a chunk store and are selected along
+    chunk boundaries bypass dask, reading their chunks straight into `out`
+    where the layout allows it (see :func:`_read_chunk_into`).
+    """
+    reads = [array._direct_reads(keep) for array in arrays]
+    kept = [dask_getitem(array.dataset, keep) if plan is None else None
+            for array, plan in zip(arrays, reads)]
+    if out is None:
+        out = [np.empty(plan[0], array.dtype) if plan is not None else
+               np.empty(dask_array.shape, dask_array.dtype)
+               for array, dask_array, plan in zip(arrays, kept, reads)]
+    # Workaround for https://github.com/dask/dask/issues/3595
+    # This is equivalent to da.compute(kept), but does not allocate
+    # excessive memory.
+    sources = [k for k in kept if k is not None]
+    targets = [dest for k, dest in zip(kept, out) if k is not None]
+    if len(sources) == len(arrays):
+        da.store(sources, targets, lock=False)
+        return out
+    tasks = []
+    for array, plan, dest in zip(arrays, reads, out):
+        if plan is not None:
+            read_chunk_into = dask.delayed(_read_chunk_into, pure=False)
+            tasks.extend(read_chunk_into(array._getter, chunk_slices, dest[out_index])
+                         for chunk_slices, out_index in plan[1])
+    if sources:
+        tasks.append(da.store(sources, targets, lock=False, compute=False))
+    dask.compute(*tasks)
+    return out
+
+
+def _block_index(keep, length):
+    """Split index into range along first axis and a hashable rest.
+
+    This returns (`start`, `stop`, `rest`) if `keep` selects a contiguous
+    non-empty range along the first axis of an array of length `length` and
+    only uses slices, integers or ellipses on the remaining axes, else None.
+    """
+    keep = keep if isinstance(keep, tuple) else (keep,)
+    if not keep or not isinstance(keep[0], slice):
+        return None
+    start, stop, step = keep[0].indices(length)
+    if step != 1 or stop <= start:
+        return None
+    rest = []
+    for index in keep[1:]:
+        if isinstance(index, slice):
+            rest.append((index.start, index.stop, index.step))
+        elif isinstance(index, Integral):
+            rest.append(int(index))
+        elif index is Ellipsis:
+            rest.append(Ellipsis)
+        else:
+            return None
+    return start, stop, tuple(rest)
+
+
+class _ReadAheadBlock(object):
+    """Block of data computed in a background thread by :class:`Prefetcher`.
+
+    The computation waits for the `previous` block (if any) to finish first,
+    so that blocks are read in order and one at a time.
+    """
+
+    def __init__(self, arrays, keep, nbytes, previous=None):
+        self.nbytes = nbytes
+        self.out = None
+        self.cancelled = False
+        self.done = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(arrays, keep, previous))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, arrays, keep, previous):
+        if previous is not None:
+            previous.done.wait()
+        try:
+            if not self.cancelled:
+                self.out = _compute(arrays, keep)
+        except Exception:
+            # Leave it to the consumer to recompute the block and see the error
+            pass
+        finally:
+            self.done.set()
+
+
+class Prefetcher(object):
+    """Read ahead on arrays that are accessed sequentially along first axis.
+
+    This detects when the same :class:`DaskLazyIndexer` objects are indexed
+    with consecutive ranges along their first (time) axis, as in the loop::
+
+        for start in range(0, len(vis), step):
+            vis_block = vis[start:start + step]
+
+    and then computes the next `depth` blocks of the same size in a
+    background thread. Each array (or set of arrays read jointly) is tracked
+    separately, so that loops reading ``vis``, ``weights`` and ``flags`` one
+    after the other are also recognised as sequential. The I/O of the next block therefore overlaps with the
+    processing of the current one. The remaining dimensions have to be
+    indexed in the same way each time, using slices or integers.
+
+    Assign the prefetcher to the `prefetcher` attribute of the indexers, and
+    use :meth:`DaskLazyIndexer.get` to read several indexers jointly.
+
+    Parameters
+    ----------
+    depth : int, optional
+        Number of blocks to read ahead
+    max_bytes : int or float, optional
+        Upper limit on the total size of blocks read ahead, in bytes
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of blocks that were / were not read ahead
+    """
+
+    def __init__(self, depth=2, max_bytes=1e9):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        # Maps (names, start, stop, rest) key to _ReadAheadBlock, in read order
+        self._blocks = OrderedDict()
+        self._nbytes = 0
+        # Maps names of arrays to (stop, rest) of their previous request
+        self._last = {}
+
+    @property
+    def nbytes(self):
+        """Total size of blocks that are read ahead, in bytes."""
+        return self._nbytes
+
+    def _pop(self, key):
+        """Remove block from read-ahead queue and return it (or None)."""
+        block = self._blocks.pop(key, None)
+        if block is not None:
+            self._nbytes -= block.nbytes
+        return block
+
+    def clear(self):
+        """Cancel and discard all blocks that are read ahead."""
+        with self._lock:
+            for key in list(self._blocks):
+                self._pop(key).cancelled = True
+            self._last = {}
+
+    def get(self, arrays, keep, out=None):
+        """Extract arrays jointly like :meth:`DaskLazyIndexer.get`, reading ahead."""
+        length = arrays[0].shape[0] if arrays and arrays[0].shape else 0
+        block_index = _block_index(keep, length)
+        if block_index is None:
+            return _compute(arrays, keep, out)
+        start, stop, rest = block_index
+        names = tuple(array.dataset.name for array in arrays)
+        with self._lock:
+            block = self._pop((names, start, stop, rest))
+            # Blocks of these arrays that precede this one or have another
+            # selection are stale (other arrays may be read in the same loop)
+            for key in list(self._blocks):
+                if key[0] == names and (key[3] != rest or key[1] < stop):
+                    self._pop(key).cancelled = True
+            sequential = block is not None or self._last.get(names) == (start, rest)
+            self._last[names] = (stop, rest)
+        result = None
+        if block is not None:
+            block.done.wait()
+            result = block.out
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if result is None:
+            result = _compute(arrays, keep, out)
+        elif out is not None:
+            for dest, src in zip(out, result):
+                dest[()] = src
+            result = out
+        if sequential:
+            self._read_ahead(arrays, names, start, stop, rest, keep, length)
+        return result
+
+    def _read_ahead(self, arrays, names, start, stop, rest, keep, length):
+        """Schedule the `depth` blocks following the range `start:stop`."""
+        keep = keep if isinstance(keep, tuple) else (keep,)
+        size = stop - start
+        with self._lock:
+            previous = next(reversed(self._blocks.values()), None)
+            for n in range(self.depth):
+                block_start = stop + n * size
+                if block_start >= length:
+                    break
+                block_stop = min(block_start + size, length)
+                key = (names, block_start, block_stop, rest)
+                if key in self._blocks:
+                    continue
+                block_keep = (slice(block_start, block_stop),) + keep[1:]
+                kept = [dask_getitem(array.dataset, block_keep) for array in arrays]
+                nbytes = sum(array.dtype.itemsize * int(np.prod(array.shape))
+                             for array in kept)
+                if self._nbytes + nbytes > self.max_bytes:
+                    break
+                previous = self._blocks[key] = _ReadAheadBlock(arrays, block_keep,
+                                                               nbytes, previous)
+                self._nbytes += nbytes
+
+
+def _block_bounds(length, boundaries, block):
+    """Split an axis into consecutive blocks, ending on `boundaries` where possible.
+
+    Each block has at most `block` elements and ends on the furthest of the
+    `boundaries` that keeps it within this limit. Stretches between
+    boundaries that are longer than `block` are split into pieces of `block`
+    elements. This returns the list of block bounds, starting with 0 and
+    ending with `length`.
+    """
+    bounds = [0]
+    end = 0
+    for boundary in sorted(set(boundaries) | {length}):
+        if boundary <= bounds[-1]:
+            continue
+        if boundary - bounds[-1] <= block:
+            end = boundary
+            continue
+        if end > bounds[-1]:
+            bounds.append(end)
+        while boundary - bounds[-1] > block:
+            bounds.append(bounds[-1] + block)
+        end = boundary
+    if end > bounds[-1]:
+        bounds.append(end)
+    return bounds
+
+
+class _BlockReader(object):
+    """Compute a block of arrays into existing buffers in a background thread."""
+
+    def __init__(self, arrays, keep, out):
+        self.out = out
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(arrays, keep))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, arrays, keep):
+        try:
+            _compute(arrays, keep, self.out)
+        except BaseException:
+            self._error = sys.exc_info()
+
+    def wait(self):
+        """Wait for the computation to finish, without raising any errors."""
+        self._thread.join()
+
+    def result(self):
+        """The computed block (re-raising any error that occurred)."""
+        self.wait()
+        if self._error is not None:
+            raise_(*self._error)
+        return self.out
+
+
 class DaskLazyIndexer(object):
     """Turn a dask Array into a LazyIndexer by computing it upon indexing.
 
@@ -488,6 +841,9 @@ class DaskLazyIndexer(object):
         Transformations that are applied after indexing by `keep` but
         before indexing on this object. Each transformation is a callable
         that takes a dask array and returns another dask array.
+    prefetcher : :class:`Prefetcher` object, optional
+        Read ahead on sequential access along the first axis (may be shared
+        by indexers that are read jointly via :meth:`get`)
 
     Attributes
     ----------
@@ -496,9 +852,12 @@ class DaskLazyIndexer(object):
     dataset : :class:`dask.Array`
         The dask array that is accessed by indexing (after applying `keep` and
         `transforms`). It can be used directly to perform dask computations.
+    prefetcher : :class:`Prefetcher` object or None
+        Object that reads ahead on sequential access, if any
     """
-    def __init__(self, dataset, keep=(), transforms=()):
+    def __init__(self, dataset, keep=(), transforms=(), prefetcher=None):
         self.name = getattr(dataset, 'name', '')
+        self.prefetcher = prefetcher
         # Fancy indices can be mutable arrays, so take a copy to protect
         # against the caller mutating the array before we apply it.
         self.keep = copy.deepcopy(keep)
@@ -506,6 +865,10 @@ class DaskLazyIndexer(object):
         self._orig_dataset = dataset
         self._dataset = None
         self._lock = threading.Lock()
+        # Chunks of an untransformed chunk store array can be read directly
+        self._getter = None if self._transforms else _chunk_getter(dataset)
+        self._orig_shape = dataset.shape
+        self._orig_chunks = dataset.chunks
 
     @property
     def transforms(self):
@@ -534,6 +897,38 @@ class DaskLazyIndexer(object):
             if self._dataset is not None:
                 self._dataset = transform(self._dataset)
             self._transforms.append(transform)
+            self._getter = None
+
+    def _direct_reads(self, keep):
+        """Plan to read the selection `keep` straight from the chunk store.
+
+        This is possible if the underlying dataset comes directly from a
+        chunk store without any transforms, and the first- and second-stage
+        selections combined consist of whole chunks along each axis (in
+        order, without dropping any axes).
+
+        Returns
+        -------
+        plan : None or tuple of (shape, reads)
+            None if direct reads are not possible, otherwise the shape of
+            the selection and a list of (`chunk_slices`, `out_index`) pairs
+            to get each chunk into the part `out_index` of the output
+        """
+        if self._getter is None:
+            return None
+        stage1 = _oindex_positions(self.keep, self._orig_shape)
+        if stage1 is None:
+            return None
+        stage2 = _oindex_positions(keep, tuple(len(p) for p in stage1))
+        if stage2 is None:
+            return None
+        positions = [p1[p2] for p1, p2 in zip(stage1, stage2)]
+        runs = [_chunk_runs(p, c) for p, c in zip(positions, self._orig_chunks)]
+        if any(r is None for r in runs):
+            return None
+        shape = tuple(len(p) for p in positions)
+        reads = [tuple(zip(*combination)) for combination in itertools.product(*runs)]
+        return shape, reads
 
     def __getitem__(self, keep):
         """Extract a selected array from the underlying dataset.
@@ -584,15 +979,118 @@ class DaskLazyIndexer(object):
         -------
         out : sequence of :class:`numpy.ndarray`
             Extracted output array (computed from the final dask version)
+
+        Notes
+        -----
+        If all `arrays` share the same :class:`Prefetcher`, it is used to read
+        ahead when successive calls select consecutive ranges of the first axis.
         """
-        kept = [dask_getitem(array.dataset, keep) for array in arrays]
-        # Workaround for https://github.com/dask/dask/issues/3595
-        # This is equivalent to da.compute(kept), but does not allocate
-        # excessive memory.
-        if out is None:
-            out = [np.empty(array.shape, array.dtype) for array in kept]
-        da.store(kept, out, lock=False)
-        return out
+        prefetcher = arrays[0].prefetcher if arrays else None
+        if prefetcher is not None and all(array.prefetcher is prefetcher
+                                          for array in arrays):
+            return prefetcher.get(arrays, keep, out)
+        return _compute(arrays, keep, out)
+
+    @classmethod
+    def iter_blocks(cls, arrays, axis=0, block=None, max_bytes=None, align=True):
+        """Iterate over several arrays jointly in blocks along an axis.
+
+        This replaces the typical loop::
+
+            for start in range(0, len(vis), step):
+                vis, weights, flags = DaskLazyIndexer.get(
+                    [vis, weights, flags], np.s_[start:start + step])
+
+        The next block is computed in a background thread while the current
+        one is processed, and it is written into a second set of output
+        buffers. The two sets of buffers are reused for all blocks, which
+        keeps memory use constant. By default the blocks end on chunk
+        boundaries of the arrays, so that no chunk is read more than once.
+
+        Parameters
+        ----------
+        arrays : list of :class:`DaskLazyIndexer`
+            Arrays to iterate over, with the same length along `axis`
+        axis : int, optional
+            Axis along which to split the arrays into blocks
+        block : int, optional
+            Maximum number of elements along `axis` per block (the default
+            is the largest stretch between consecutive chunk boundaries)
+        max_bytes : int or float, optional
+            Upper limit on the total size of both sets of buffers, in bytes,
+            which shrinks the blocks if necessary
+        align : bool, optional
+            End blocks on chunk boundaries shared by all `arrays` (otherwise
+            all blocks except the last have `block` elements)
+
+        Yields
+        ------
+        index : slice
+            Range of `axis` covered by the block
+        blocks : list of :class:`numpy.ndarray`
+            Block of each array, i.e. ``array[..., index, ...]`` with
+            `index` on `axis`. The blocks are views on the reused buffers,
+            so they are only valid until the next iteration (copy them if
+            they are needed for longer).
+
+        Raises
+        ------
+        ValueError
+            If the arrays have different lengths along `axis`, or if neither
+            `block` nor alignment determines the block size
+        """
+        arrays = list(arrays)
+        if not arrays:
+            return
+        datasets = [array.dataset for array in arrays]
+        length = datasets[0].shape[axis]
+        if any(dataset.shape[axis] != length for dataset in datasets):
+            raise ValueError('Arrays have different lengths along axis {}: {}'
+                             .format(axis, [dataset.shape[axis] for dataset in datasets]))
+        if length == 0:
+            return
+        if align:
+            # Only boundaries shared by all arrays avoid reading any chunk twice
+            boundaries = reduce(set.intersection,
+                                [set(np.cumsum((0,) + dataset.chunks[axis]).tolist())
+                                 for dataset in datasets])
+            boundaries = sorted(boundaries | {0, length})
+            if block is None:
+                block = int(np.max(np.diff(boundaries)))
+        else:
+            if block is None:
+                raise ValueError('Please specify the block size if blocks are not aligned')
+            boundaries = []
+        if max_bytes is not None:
+            # Two sets of buffers with the size of one element along the axis
+            element_bytes = 2 * sum(dataset.dtype.itemsize * int(np.prod(dataset.shape)) // length
+                                    for dataset in datasets)
+            block = min(block, max(int(max_bytes // element_bytes), 1))
+        bounds = _block_bounds(length, boundaries, max(int(block), 1))
+        max_block = int(np.max(np.diff(bounds)))
+        shapes = [dataset.shape[:axis] + (max_block,) + dataset.shape[axis + 1:]
+                  for dataset in datasets]
+        buffers = [[np.empty(shape, dataset.dtype) for shape, dataset in zip(shapes, datasets)]
+                   for n in range(2)]
+
+        def read(n):
+            """Start reading block `n` into its set of buffers."""
+            size = bounds[n + 1] - bounds[n]
+            keep = (slice(None),) * axis + (slice(bounds[n], bounds[n + 1]),)
+            out = [buf[keep[:axis] + (slice(0, size),)] for buf in buffers[n % 2]]
+            return _BlockReader(arrays, keep, out)
+
+        n_blocks = len(bounds) - 1
+        pending = read(0)
+        try:
+            for n in range(n_blocks):
+                blocks = pending.result()
+                pending = read(n + 1) if n + 1 < n_blocks else None
+                yield slice(bounds[n], bounds[n + 1]), blocks
+        finally:
+            # Don't leave a block computing in the background if iteration stops early
+            if pending is not None:
+                pending.wait()
 
     def __len__(self):
         """Length operator."""
@@ -18,21 +18,27 @@
 from __future__ import print_function, division, absolute_import
 from builtins import object, range
 
+import os
+import shutil
+import tempfile
+
 import numpy as np
+import mock
 from numpy.testing import assert_array_equal, assert_allclose
-from nose.tools import assert_raises, assert_equal
+from nose.tools import assert_raises, assert_equal, assert_not_equal
 import dask.array as da
 
 from katdal.spectral_window import SpectralWindow
 from katdal.sensordata import SensorCache
 from katdal.categorical import ComparableArrayWrapper, CategoricalData
-from katdal.applycal import (complex_interp,
+from katdal.applycal import (complex_interp, InterpolationPlan,
                              has_cal_product, get_cal_product, INVALID_GAIN,
                              calc_delay_correction, calc_bandpass_correction,
                              calc_gain_correction, apply_vis_correction,
                              apply_weights_correction, apply_flags_correction,
-                             add_applycal_sensors, calc_correction)
+                             add_applycal_sensors, calc_correction, CorrectionParams)
 from katdal.flags import POSTPROC
+from katdal.chunkstore import ChunkCache
 
 
 POLS = ['v', 'h']
@@ -237,6 +243,43 @@ class TestComplexInterp(object):
         assert_allclose(y[-1], 1j, rtol=1e-14)
 
 
+class TestInterpolationPlan(object):
+    """Test the :class:`~katdal.applycal.InterpolationPlan` class."""
+    def setup(self):
+        rs = np.random.RandomState(1234)
+        self.xi = np.sort(10 * rs.rand(20))
+        self.x = np.r_[20 * rs.rand(200) - 5, self.xi, np.nan, -np.inf, np.inf]
+        self.yi = rs.rand(len(self.xi), 3)
+        self.plan = InterpolationPlan(self.x, self.xi)
+
+    def test_interp_matches_numpy(self):
+        left, right = np.array([-1., -2., -3.]), np.array([1., 2., 3.])
+        y = self.plan.interp(self.yi, left, right)
+        assert_equal(y.shape, (len(self.x), 3))
+        for n in range(self.yi.shape[1]):
+            assert_array_equal(y[:, n], np.interp(self.x, self.xi, self.yi[:, n], left[n], right[n]))
+            assert_array_equal(self.plan.interp(self.yi[:, n]),
+                               np.interp(self.x, self.xi, self.yi[:, n]))
+            assert_array_equal(self.plan.interp(self.yi[:, n], left[n], right[n]),
+                               np.interp(self.x, self.xi, self.yi[:, n], left[n], right[n]))
+        with assert_raises(ValueError):
+            self.plan.interp(self.yi[1:])
+
+    def test_complex_interp_per_column(self):
+        yi = np.exp(2j * np.pi * self.yi) * self.yi
+        y = self.plan.complex_interp(yi, left=0, right=1j)
+        for n in range(yi.shape[1]):
+            assert_array_equal(y[:, n], complex_interp(self.x, self.xi, yi[:, n], 0, 1j))
+
+    def test_complex_reciprocal(self):
+        yi = (np.exp(2j * np.pi * self.yi) * self.yi).astype(np.complex64)
+        y = self.plan.complex_reciprocal(yi, left=INVALID_GAIN, right=1j)
+        assert_equal(y.dtype, yi.dtype)
+        assert_allclose(y, np.reciprocal(self.plan.complex_interp(yi, INVALID_GAIN, 1j)), rtol=1e-6)
+        assert_allclose(self.plan.complex_reciprocal(yi[:, 0]),
+                        np.reciprocal(complex_interp(self.x, self.xi, yi[:, 0])), rtol=1e-6)
+
+
 class TestCalProductAccess(object):
     """Test the :func:`~katdal.applycal.*_cal_product` functions."""
     def setup(self):
@@ -322,7 +365,12 @@ class TestCorrectionPerInput(object):
                 sensor = calc_bandpass_correction(product_sensor, (m, n),
                                                   FREQS, CAL_FREQS)
                 assert_array_equal(sensor[n], constant_bandpass)
-                assert_array_equal(sensor[12 + n], bandpass_corrections(m, n))
+                assert_allclose(sensor[12 + n], bandpass_corrections(m, n), rtol=1e-6)
+        # All inputs at once
+        sensor = calc_bandpass_correction(product_sensor, None, FREQS, CAL_FREQS)
+        for n in range(len(ANTS)):
+            for m in range(len(POLS)):
+                assert_allclose(sensor[12 + n][:, m, n], bandpass_corrections(m, n), rtol=1e-6)
 
     def test_calc_gain_correction(self):
         product_sensor = get_cal_product(self.cache, ATTRS, 'G')
@@ -362,14 +410,48 @@ class TestVirtualCorrectionSensors(object):
             for m, pol in enumerate(POLS):
                 sensor_name = 'Calibration/{}{}_correction_B'.format(ant, pol)
                 sensor = self.cache.get(sensor_name)
-                assert_array_equal(sensor[12 + n], bandpass_corrections(m, n))
+                assert_allclose(sensor[12 + n], bandpass_corrections(m, n), rtol=1e-6)
 
     def test_gain_sensors(self):
         for n, ant in enumerate(ANTS):
             for m, pol in enumerate(POLS):
                 sensor_name = 'Calibration/{}{}_correction_G'.format(ant, pol)
                 sensor = self.cache.get(sensor_name)
-                assert_array_equal(sensor[:], gain_corrections(m, n))
+                assert_allclose(sensor[:], gain_corrections(m, n), rtol=1e-6)
+
+    def test_persistent_corrections(self):
+        tempdir = tempfile.mkdtemp()
+        sensor_names = ['Calibration/{}{}_correction_{}'.format(ant, pol, product)
+                        for product in CAL_PRODUCTS for ant in ANTS for pol in POLS]
+        try:
+            cache = create_sensor_cache()
+            add_applycal_sensors(cache, ATTRS, FREQS, tempdir, 'cbid_l0')
+            for name in sensor_names:
+                assert_array_equal(cache.get(name)[:], self.cache.get(name)[:])
+            filenames = sorted(os.listdir(tempdir))
+            assert_equal([fn.split('_')[2] for fn in filenames], sorted(CAL_PRODUCTS))
+            # A new session loads the corrections instead of calculating them
+            for fn in filenames:
+                filename = os.path.join(tempdir, fn)
+                with np.load(filename) as data:
+                    arrays = {key: data[key] for key in data.files}
+                arrays['values'] *= 2
+                np.savez(filename, **arrays)
+            cache = create_sensor_cache()
+            add_applycal_sensors(cache, ATTRS, FREQS, tempdir, 'cbid_l0')
+            for name in sensor_names:
+                assert_array_equal(cache.get(name)[:], 2 * self.cache.get(name)[:])
+            # Changed solutions replace the stale file
+            cache = create_sensor_cache()
+            gains = cache.get('cal_product_G')
+            cache['cal_product_G'] = CategoricalData(gains[GAIN_EVENTS], GAIN_EVENTS + [N_DUMPS - 1])
+            add_applycal_sensors(cache, ATTRS, FREQS, tempdir, 'cbid_l0')
+            cache.get(sensor_names[-1])
+            new_filenames = sorted(os.listdir(tempdir))
+            assert_equal(len(new_filenames), len(filenames))
+            assert_not_equal(new_filenames[1], filenames[1])
+        finally:
+            shutil.rmtree(tempdir)
 
     def test_unknown_inputs_and_products(self):
         known_input = 'Calibration/{}{}'.format(ANTS[0], POLS[0])
@@ -395,7 +477,66 @@ class TestCalcCorrection(object):
         corrections = calc_correction(chunks, self.cache, CORRPRODS, CAL_PRODUCTS)
         corrections = corrections[dump:dump+1, channels].compute()
         expected_corrections = corrections_per_corrprod([dump], channels)
-        assert_array_equal(corrections, expected_corrections)
+        assert_allclose(corrections, expected_corrections, rtol=1e-6)
+
+    def test_calc_correction_all_dumps(self):
+        shape = (N_DUMPS, N_CHANS, N_CORRPRODS)
+        # Skip the first few dumps, which precede the first K and B solutions
+        dumps = np.arange(12, N_DUMPS)
+        expected_corrections = corrections_per_corrprod(dumps, np.s_[:])
+        # Chunks with several dumps that don't line up with the sensor events,
+        # with and without splitting the baseline axis
+        for chunks in [(7, 50, -1), (7, 50, 13)]:
+            chunks = da.core.normalize_chunks(chunks, shape)
+            corrections = calc_correction(chunks, self.cache, CORRPRODS, CAL_PRODUCTS)
+            assert_equal(corrections.chunks, chunks)
+            assert_allclose(corrections[dumps].compute(), expected_corrections, rtol=1e-6)
+
+    def test_solution_ids(self):
+        products = {product: [self.cache.get('Calibration/{}_correction_{}'.format(inp, product))
+                              for inp in INPUTS]
+                    for product in ['K', 'B']}
+        params = CorrectionParams(INPUTS, INDEX1, INDEX2, products)
+        ids = params.solution_ids(np.array([0, 5, 11, 12, 50, 99]))
+        # Delays change at dump 10 and bandpasses at dump 12
+        assert_equal(len(set(ids)), 3)
+        assert_array_equal(ids[[0, 2, 3]], ids[[1, 2, 4]])
+        assert_equal(ids[4], ids[5])
+        # Gains interpolated per dump are applied separately and don't split solutions
+        products['G'] = [self.cache.get('Calibration/{}_correction_G'.format(inp)) for inp in INPUTS]
+        params = CorrectionParams(INPUTS, INDEX1, INDEX2, products)
+        ids = params.solution_ids(np.array([50, 51]))
+        assert_equal(ids[0], ids[1])
+
+    def test_correction_cache(self):
+        shape = (N_DUMPS, N_CHANS, N_CORRPRODS)
+        for chunks in [(1, 64, -1), (4, 32, -1), (4, 32, 20)]:
+            chunks = da.core.normalize_chunks(chunks, shape)
+            for cal_products in [['K', 'B'], CAL_PRODUCTS]:
+                cached = calc_correction(chunks, self.cache, CORRPRODS, cal_products)
+                uncached = calc_correction(chunks, self.cache, CORRPRODS, cal_products,
+                                           max_cache_size=0)
+                assert_array_equal(cached.compute(), uncached.compute())
+
+    def test_correction_cache_hits_with_gains(self):
+        shape = (N_DUMPS, N_CHANS, N_CORRPRODS)
+        chunks = da.core.normalize_chunks((1, 64, -1), shape)
+        caches = []
+
+        def make_cache(max_bytes):
+            caches.append(ChunkCache(max_bytes))
+            return caches[-1]
+
+        with mock.patch('katdal.applycal.ChunkCache', side_effect=make_cache):
+            corrections = calc_correction(chunks, self.cache, CORRPRODS, CAL_PRODUCTS)
+        assert_equal(len(caches), 1)
+        corrections = corrections.compute(scheduler='sync')
+        # Only the 3 combinations of K and B solutions per channel chunk are computed
+        assert_equal(caches[0].misses, 3 * 2)
+        assert_equal(caches[0].hits, N_DUMPS * 2 - 3 * 2)
+        # Skip the first few dumps, which precede the first K and B solutions
+        expected_corrections = corrections_per_corrprod(np.arange(12, N_DUMPS), np.s_[:])
+        assert_allclose(corrections[12:], expected_corrections, rtol=1e-6)
 
 
 class TestApplyCal(object):
@@ -0,0 +1,99 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunk_advisor`."""
+from __future__ import print_function, division, absolute_import
+
+import os
+import tempfile
+import shutil
+
+import numpy as np
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from katdal.chunk_advisor import (estimate_reads, workload_accesses,
+                                  load_access_log, advise_chunks)
+
+
+class TestEstimateReads(object):
+    def test_whole_and_partial_chunks(self):
+        chunks = ((4, 4, 2), (5, 5))
+        # Selection aligned with a single chunk
+        assert_equal(estimate_reads(chunks, [np.s_[0:4, 5:10]], 2), (40, 1, 40))
+        # Selection straddling chunk boundaries reads 4 whole chunks
+        assert_equal(estimate_reads(chunks, [np.s_[3:5, 4:6]]), (80, 4, 4))
+        # Missing dimensions are selected in full and empty selections are free
+        assert_equal(estimate_reads(chunks, [np.s_[8:10], np.s_[2:2, :]]), (20, 2, 20))
+
+    def test_bad_accesses(self):
+        chunks = ((4, 4), (5, 5))
+        assert_raises(ValueError, estimate_reads, chunks, [np.s_[0:8:2]])
+        assert_raises(ValueError, estimate_reads, chunks, [np.s_[0:1, 0:1, 0:1]])
+
+
+class TestWorkloads(object):
+    def test_workload_accesses(self):
+        shape = (10, 8, 6)
+        accesses = workload_accesses(shape, 'per-dump-streaming', block=4)
+        assert_equal(accesses, [np.s_[0:4, :, :], np.s_[4:8, :, :], np.s_[8:10, :, :]])
+        accesses = workload_accesses(shape, 'per-channel-imaging')
+        assert_equal(len(accesses), 8)
+        accesses = workload_accesses(shape, 'per-baseline-calibration', block=3)
+        assert_equal(accesses, [np.s_[:, :, 0:3], np.s_[:, :, 3:6]])
+        assert_raises(ValueError, workload_accesses, shape, 'bogus')
+
+    def test_advice_follows_workload(self):
+        shape = (64, 1024, 40)
+        kwargs = dict(min_chunk_size=0, max_chunk_size=1e6, latency=0.01, bandwidth=1e8)
+        # Time-ordered reads prefer chunks with few dumps and many channels
+        advice = advise_chunks(shape, 8, workload_accesses(shape, 'per-dump-streaming'), **kwargs)
+        assert_equal(advice[0].chunks, (1, 1024, 40))
+        assert_equal(advice[0].efficiency, 1.0)
+        # Spectral-line imaging prefers the opposite
+        advice = advise_chunks(shape, 8, workload_accesses(shape, 'per-channel-imaging'), **kwargs)
+        assert_equal(advice[0].chunks, (64, 1, 40))
+        # Candidates are ordered by cost and respect the size limits
+        costs = [a.cost for a in advice]
+        assert_equal(costs, sorted(costs))
+        assert_true(all(a.chunk_bytes <= 1e6 for a in advice))
+        # Explicit candidates are also supported
+        advice = advise_chunks(shape, 8, [np.s_[0:1]], candidates=[(2, 1024, 40)], n_arrays=3)
+        assert_equal(advice[0].requests, 3)
+        assert_equal(advice[0].bytes_read, 2 * 1024 * 40 * 8)
+
+
+class TestAccessLog(object):
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'access.log')
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_load(self):
+        with open(self.filename, 'w') as f:
+            f.write('# Recorded accesses\n'
+                    '{"dumps": [0, 10], "channels": [100, 200]}\n'
+                    '\n'
+                    '{"freq": [5, 6], "baseline": [0, 4]}\n')
+        accesses = load_access_log(self.filename)
+        assert_equal(accesses, [np.s_[0:10, 100:200, :], np.s_[:, 5:6, 0:4]])
+
+    def test_bad_lines(self):
+        for line in ['{"dumps": [0]}', '{"bogus": [0, 1]}', '[0, 1]', 'not json']:
+            with open(self.filename, 'w') as f:
+                f.write(line + '\n')
+            assert_raises(ValueError, load_access_log, self.filename)
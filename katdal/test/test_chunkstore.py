@@ -18,14 +18,21 @@
 from __future__ import print_function, division, absolute_import
 from builtins import object
 
+
 import numpy as np
 from numpy.testing import assert_array_equal
 from nose.tools import (assert_raises, assert_equal, assert_true, assert_false,
-                        assert_is_instance)
+                        assert_is_instance, assert_is_none)
 import dask.array as da
+import mock
 
-from katdal.chunkstore import (ChunkStore, generate_chunks,
-                               StoreUnavailable, ChunkNotFound, BadChunk)
+from katdal.chunkstore import (ChunkStore, ChunkCache, ChunkManifest, generate_chunks,
+                               ChunkStoreStats, OperationStats,
+                               StoreUnavailable, ChunkNotFound, BadChunk,
+                               available_codecs, check_codec, encode_chunk,
+                               decode_chunk, is_encoded)
+from katdal.chunkstore_dict import DictChunkStore
+from katdal.lazy_indexer import DaskLazyIndexer
 
 
 class TestGenerateChunks(object):
@@ -119,6 +126,22 @@ class TestChunkStore(object):
         assert_raises(BadChunk, store.chunk_metadata, "x", [slice(0, 2)],
                       dtype=np.dtype(np.object))
 
+    def test_many_chunk_dask_graph(self):
+        x = np.arange(500 * 100 * 10.).reshape(500, 100, 10)
+        store = DictChunkStore(x=x)
+        chunks = ((1,) * 500, (1,) * 100, (10,))
+        for batch_size in (1, 4):
+            store.batch_size = batch_size
+            darray = store.get_dask_array('x', chunks, x.dtype)
+            with mock.patch.object(store, 'get_chunk', wraps=store.get_chunk) as get_chunk:
+                # Small selections only read the relevant chunks (or batches)
+                assert_array_equal(darray[5:7, 3:4].compute(), x[5:7, 3:4])
+                assert_equal(get_chunk.call_count, 2 * batch_size)
+                get_chunk.reset_mock()
+                indexer = DaskLazyIndexer(darray, np.s_[:10])
+                assert_array_equal(indexer.dataset.compute(), x[:10])
+                assert_equal(get_chunk.call_count, 10 * 100)
+
     def test_standard_errors(self):
         error_map = {ZeroDivisionError: StoreUnavailable,
                      LookupError: ChunkNotFound}
@@ -131,6 +154,176 @@ class TestChunkStore(object):
                 {}['ha']
 
 
+class TestChunkCache(object):
+    """Test the in-memory chunk cache."""
+
+    def setup(self):
+        self.cache = ChunkCache(250)
+        self.chunks = [np.full(10, n, np.float64) for n in range(4)]
+        self.keys = [ChunkCache.key('x', (slice(10 * n, 10 * n + 10),), np.float64)
+                     for n in range(4)]
+
+    def test_get_put(self):
+        assert_is_none(self.cache.get(self.keys[0]))
+        cached = self.cache.put(self.keys[0], self.chunks[0])
+        assert_array_equal(self.cache.get(self.keys[0]), self.chunks[0])
+        assert_equal((self.cache.hits, self.cache.misses), (1, 1))
+        assert_equal(self.cache.nbytes, 80)
+        # Cached chunks are shared, so they should not be modified...
+        assert_false(cached.flags.writeable)
+        assert_false(self.cache.get(self.keys[0]).flags.writeable)
+        # ... but the caller's array is left alone
+        assert_true(self.chunks[0].flags.writeable)
+        # Same array and slices but different dtype is a different chunk
+        assert_is_none(self.cache.get(ChunkCache.key('x', (slice(0, 10),), np.int64)))
+
+    def test_lru_eviction(self):
+        for n in range(3):
+            self.cache.put(self.keys[n], self.chunks[n])
+        # Touch chunk 0 so that chunk 1 becomes the least recently used one
+        self.cache.get(self.keys[0])
+        self.cache.put(self.keys[3], self.chunks[3])
+        assert_equal(len(self.cache), 3)
+        assert_true(self.cache.nbytes <= self.cache.max_bytes)
+        assert_is_none(self.cache.get(self.keys[1]))
+        assert_array_equal(self.cache.get(self.keys[0]), self.chunks[0])
+        # Chunks that are too big are not cached at all
+        self.cache.put('big', np.zeros(100))
+        assert_is_none(self.cache.get('big'))
+        self.cache.clear()
+        assert_equal((len(self.cache), self.cache.nbytes, self.cache.hits), (0, 0, 0))
+
+    def test_store_with_cache(self):
+        x = np.arange(40.)
+        store = DictChunkStore(x=x)
+        store.chunk_cache = self.cache
+        with mock.patch.object(store, 'get_chunk', wraps=store.get_chunk) as get_chunk:
+            darray = store.get_dask_array('x', ((10, 10, 10, 10),), x.dtype)
+            assert_array_equal(darray.compute(), x)
+            # Only 3 chunks fit in the cache, so the first one was evicted
+            assert_array_equal(darray[15:35].compute(), x[15:35])
+            assert_equal(get_chunk.call_count, 4)
+            assert_array_equal(darray[:10].compute(), x[:10])
+            assert_equal(get_chunk.call_count, 5)
+        assert_equal(self.cache.hits, 3)
+        # Missing chunks are replaced by zeros but not cached
+        self.cache.clear()
+        darray = store.get_dask_array('y', ((10,),), x.dtype)
+        assert_array_equal(darray.compute(), np.zeros(10))
+        assert_equal(len(self.cache), 0)
+
+
+class TestChunkStoreStats(object):
+    """Test the chunk store statistics."""
+
+    def setup(self):
+        self.stats = ChunkStoreStats()
+
+    def test_record(self):
+        self.stats.record('x', 'get', 0.003, 100)
+        self.stats.record('x', 'get', 0.03, 200, retries=2)
+        self.stats.record('x', 'get', 0.3, missing=True)
+        self.stats.record('y', 'get', 3.0, error=True)
+        self.stats.record('x', 'put', 0.01, 300)
+        assert_equal(self.stats.keys(), [('x', 'get'), ('x', 'put'), ('y', 'get')])
+        x_get = self.stats['x', 'get']
+        assert_equal((x_get.requests, x_get.bytes, x_get.errors, x_get.missing, x_get.retries),
+                     (3, 300, 0, 1, 2))
+        assert_equal(x_get.latency_histogram.sum(), 3)
+        assert_equal(x_get.latency_percentile(50), 0.05)
+        assert_equal(x_get.latency_percentile(100), 0.5)
+        total = self.stats.total('get')
+        assert_equal((total.requests, total.errors), (4, 1))
+        assert_equal(total.latency_percentile(100), 5.0)
+        # Snapshots are not affected by later operations
+        self.stats.record('x', 'get', 0.003, 100)
+        assert_equal(x_get.requests, 3)
+        assert_raises(KeyError, self.stats.__getitem__, ('z', 'get'))
+        assert_true(np.isnan(OperationStats().latency_percentile(50)))
+        self.stats.reset()
+        assert_equal(self.stats.keys(), [])
+
+    def test_measure(self):
+        with self.stats.measure('x', 'get') as measurement:
+            measurement.nbytes = 10
+        with assert_raises(ChunkNotFound):
+            with self.stats.measure('x', 'get'):
+                raise ChunkNotFound('gone')
+        with assert_raises(BadChunk):
+            with self.stats.measure('x', 'get'):
+                raise BadChunk('corrupted')
+        with self.stats.measure('x', 'get') as measurement:
+            measurement.discard = True
+        x_get = self.stats['x', 'get']
+        assert_equal((x_get.requests, x_get.bytes, x_get.errors, x_get.missing), (3, 10, 1, 1))
+
+    def test_periodic_log(self):
+        stats = ChunkStoreStats(log_interval=0)
+        with mock.patch('katdal.chunkstore.logger') as logger:
+            stats.record('x', 'get', 0.01, 100)
+            stats.record('x', 'put', 0.01, 100)
+        assert_equal(logger.info.call_count, 3)
+        with mock.patch('katdal.chunkstore.logger') as logger:
+            self.stats.record('x', 'get', 0.01, 100)
+        logger.info.assert_not_called()
+
+
+class TestCodecs(object):
+    """Test encoding and decoding of compressed chunks."""
+
+    def _encode(self, chunk, codec):
+        return b''.join(bytes(memoryview(piece)) for piece in encode_chunk(chunk, codec))
+
+    def test_round_trip(self):
+        x = np.arange(600, dtype=np.float32).reshape(20, 30)
+        flags = np.zeros((200, 30), np.uint8)
+        assert_true('zlib' in available_codecs())
+        for codec in available_codecs():
+            for chunk in (x, flags, x[:, 3:7], np.array(2.), np.zeros((4, 0))):
+                data = self._encode(chunk, codec)
+                assert_true(is_encoded(data))
+                decoded = decode_chunk(data)
+                assert_equal(decoded.dtype, chunk.dtype)
+                assert_array_equal(decoded, chunk)
+            assert_true(len(self._encode(flags, codec)) < flags.nbytes / 4)
+        # Without a codec the chunk is encoded as a normal NPY file
+        assert_false(is_encoded(self._encode(x, None)))
+
+    def test_bad_codec(self):
+        assert_raises(ValueError, check_codec, 'bogus')
+        data = self._encode(np.arange(10), 'zlib')
+        assert_raises(BadChunk, decode_chunk, data[:-3])
+        assert_raises(BadChunk, decode_chunk, data.replace(b'zlib', b'zlob'))
+        assert_raises(BadChunk, decode_chunk, b'not a chunk')
+
+
+class TestChunkManifest(object):
+    """Test the chunk manifest and its serialisation."""
+
+    def test_from_chunk_ids(self):
+        manifest = ChunkManifest.from_chunk_ids(['00000_00010', '00004_00000', '00000_00000'])
+        assert_equal(manifest.starts, [[0, 4], [0, 10]])
+        assert_array_equal(manifest.present, [[True, True], [True, False]])
+        assert_equal(len(manifest), 3)
+        assert_true(manifest.has_chunk(np.index_exp[4:8, 0:10]))
+        assert_false(manifest.has_chunk(np.index_exp[4:8, 10:20]))
+        assert_false(manifest.has_chunk(np.index_exp[2:4, 0:10]))
+        assert_false(manifest.has_chunk(np.index_exp[0:4]))
+        assert_raises(ValueError, ChunkManifest.from_chunk_ids, ['00000', '00000_00000'])
+
+    def test_serialisation(self):
+        for chunk_ids in (['00000_00010', '00004_00000'], [], ['']):
+            manifest = ChunkManifest.from_chunk_ids(chunk_ids)
+            manifest2 = ChunkManifest.from_bytes(manifest.to_bytes())
+            assert_equal(manifest2.starts, manifest.starts)
+            assert_array_equal(manifest2.present, manifest.present)
+        assert_true(ChunkManifest.from_chunk_ids(['']).has_chunk(()))
+        data = manifest.to_bytes()
+        assert_raises(ValueError, ChunkManifest.from_bytes, b'garbage')
+        assert_raises(ValueError, ChunkManifest.from_bytes, data.replace(b'"version":1', b'"version":2'))
+        assert_raises(ValueError, ChunkManifest.from_bytes, b'{"version":1,"starts":[[0,1]],"bitmap":""}')
+
+
 class ChunkStoreTestBase(object):
     """Standard tests performed on all types of ChunkStore."""
 
@@ -197,6 +390,28 @@ class ChunkStoreTestBase(object):
         divisions_per_dim = [len(c) for c in dask_array.chunks]
         assert_array_equal(results, np.full(divisions_per_dim, True))
 
+    def check_stats(self):
+        """Check the statistics of a store that keeps them."""
+        name = self.array_name('stats')
+        s = (slice(3, 7), slice(2, 5), slice(1, 2))
+        self.store.stats = ChunkStoreStats()
+        try:
+            self.store.create_array(name)
+            self.store.put_chunk(name, s, self.y[s])
+            self.store.get_chunk(name, s, self.y.dtype)
+            self.store.get_chunk_into(name, s, self.y.dtype, np.empty((4, 3, 1)))
+            self.store.get_chunk_or_zeros(name, (slice(0, 1),), self.y.dtype)
+            assert_raises(BadChunk, self.store.get_chunk, name, s, self.x.dtype)
+            put = self.store.stats[name, 'put']
+            get = self.store.stats[name, 'get']
+        finally:
+            self.store.stats = None
+        assert_equal((put.requests, put.errors, put.missing), (1, 0, 0))
+        assert_true(put.bytes >= self.y[s].nbytes or self.store.codec)
+        assert_equal((get.requests, get.errors, get.missing), (4, 1, 1))
+        assert_true(get.bytes > 0)
+        assert_equal(get.latency_histogram.sum(), 4)
+
     def test_chunk_non_existent(self):
         slices = (slice(0, 1),)
         dtype = np.dtype(np.float)
@@ -230,6 +445,28 @@ class ChunkStoreTestBase(object):
         # Try an empty slice on a zero-dimensional array (but why?)
         self.put_has_get_chunk('z', ())
 
+    def test_get_chunk_into(self):
+        name = self.array_name('y')
+        s = (slice(3, 7), slice(2, 5), slice(1, 2))
+        self.put_has_get_chunk('y', s)
+        out = np.empty((4, 3, 1), self.y.dtype)
+        assert_true(self.store.get_chunk_into(name, s, self.y.dtype, out) is out)
+        assert_array_equal(out, self.y[s])
+        # Non-contiguous destination
+        out = np.zeros((4, 6, 1), self.y.dtype)
+        self.store.get_chunk_into(name, s, self.y.dtype, out[:, ::2])
+        assert_array_equal(out[:, ::2], self.y[s])
+        assert_array_equal(out[:, 1::2], 0)
+        assert_raises(BadChunk, self.store.get_chunk_into, name, s, self.y.dtype,
+                      np.empty((4, 3), self.y.dtype))
+        # Missing chunks become zeros
+        missing = (slice(0, 1), slice(0, 3), slice(0, 1))
+        out = np.ones((1, 3, 1), self.y.dtype)
+        assert_raises(ChunkNotFound, self.store.get_chunk_into,
+                      self.array_name('haha'), missing, self.y.dtype, out)
+        self.store.get_chunk_into_or_zeros(self.array_name('haha'), missing, self.y.dtype, out)
+        assert_array_equal(out, 0)
+
     def test_put_chunk_noraise(self):
         name = self.array_name('x')
         self.store.create_array(name)
@@ -274,6 +511,30 @@ class ChunkStoreTestBase(object):
             ref_chunk_ids = [self.store.chunk_id_str(s) for s in slices]
             assert_equal(set(chunk_ids), set(ref_chunk_ids))
 
+    def test_manifest(self):
+        array_name = self.array_name('manifest')
+        chunks = ((2, 2), (6,), (1, 1))
+        slices = da.core.slices_from_chunks(chunks)
+        try:
+            assert_is_none(self.store.get_manifest(array_name))
+        except NotImplementedError:
+            return
+        self.store.create_array(array_name)
+        for s in slices[:3]:
+            self.store.put_chunk(array_name, s, self.y[s])
+        manifests = self.store.write_manifest(array_name)
+        assert_equal(list(manifests), [array_name])
+        assert_equal(len(self.store.get_manifest(array_name)), 3)
+        assert_is_none(self.store.get_manifest(self.array_name('no_manifest')))
+        # The manifest takes the place of listing the store, so newer chunks are ignored
+        self.store.put_chunk(array_name, slices[3], self.y[slices[3]])
+        has_array = self.store.has_array(array_name, chunks, self.y.dtype)
+        assert_array_equal(has_array, [[[True, True]], [[True, False]]])
+        # Updating the manifest picks up the new chunk
+        self.store.write_manifest(array_name)
+        has_array = self.store.has_array(array_name, chunks, self.y.dtype)
+        assert_array_equal(has_array, np.ones((2, 1, 2), bool))
+
     def test_mark_complete(self):
         name = self.array_name('completetest')
         try:
@@ -0,0 +1,130 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunkstore_cache`."""
+from __future__ import print_function, division, absolute_import
+from builtins import object
+
+import os
+import tempfile
+import shutil
+
+import mock
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_true, assert_false
+
+from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.chunkstore_dict import DictChunkStore
+from katdal.chunkstore_cache import CachingChunkStore
+from katdal.test.test_chunkstore import ChunkStoreTestBase
+
+
+class TestCachingChunkStore(ChunkStoreTestBase):
+    """Test caching store functionality on top of an NPY file store."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dirs for store and cache, and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.cachedir = tempfile.mkdtemp()
+        cls.store = CachingChunkStore(NpyFileChunkStore(cls.tempdir), cls.cachedir)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tempdir)
+        shutil.rmtree(cls.cachedir)
+
+
+class TestCachingChunkStoreEviction(object):
+    """Test the LRU cache behaviour on top of a dict-based store."""
+
+    def setup(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.x = np.arange(1000.)
+        self.base = DictChunkStore(x=self.x)
+        # Every stored chunk has 100 floats, which takes a bit more than 800 bytes
+        self.store = CachingChunkStore(self.base, self.cachedir, max_bytes=2000)
+
+    def teardown(self):
+        shutil.rmtree(self.cachedir)
+
+    def get(self, n):
+        slices = (slice(100 * n, 100 * (n + 1)),)
+        chunk = self.store.get_chunk('x', slices, self.x.dtype)
+        assert_array_equal(chunk, self.x[slices])
+
+    def test_hits_and_misses(self):
+        self.get(0)
+        self.get(0)
+        self.get(1)
+        self.get(0)
+        assert_equal(self.store.hits, 2)
+        assert_equal(self.store.misses, 2)
+        assert_true(os.path.exists(os.path.join(self.cachedir, 'x', '00000.npy')))
+
+    def test_lru_eviction(self):
+        self.get(0)
+        self.get(1)
+        # Touch chunk 0 so that chunk 1 becomes the least recently used one
+        self.get(0)
+        self.get(2)
+        assert_true(self.store.nbytes <= self.store.max_bytes)
+        assert_true(os.path.exists(os.path.join(self.cachedir, 'x', '00000.npy')))
+        assert_false(os.path.exists(os.path.join(self.cachedir, 'x', '00100.npy')))
+        assert_true(os.path.exists(os.path.join(self.cachedir, 'x', '00200.npy')))
+        # Chunk 1 has to come from the underlying store again
+        self.get(1)
+        assert_equal(self.store.misses, 4)
+
+    def test_reuse_cache_dir(self):
+        self.get(0)
+        self.get(1)
+        # Cache contents survive in the directory even if the source disappears
+        store = CachingChunkStore(DictChunkStore(), self.cachedir, max_bytes=2000)
+        assert_equal(store.nbytes, self.store.nbytes)
+        chunk = store.get_chunk('x', (slice(100, 200),), self.x.dtype)
+        assert_array_equal(chunk, self.x[100:200])
+        assert_equal(store.hits, 1)
+
+    def test_put_invalidates(self):
+        self.get(0)
+        new_chunk = np.zeros(100)
+        self.store.put_chunk('x', (slice(0, 100),), new_chunk)
+        chunk = self.store.get_chunk('x', (slice(0, 100),), self.x.dtype)
+        assert_array_equal(chunk, new_chunk)
+        assert_equal(self.store.misses, 2)
+
+    def test_underlying_reading_strategy(self):
+        base = DictChunkStore(x=self.x)
+        base.batch_size = 4
+        base.partial_reads = True
+        base._map = mock.Mock(side_effect=lambda func, items: [func(item) for item in items])
+        store = CachingChunkStore(base, self.cachedir, max_bytes=2000)
+        assert_equal(store.batch_size, 4)
+        assert_true(store.partial_reads)
+        slices_list = [(slice(100 * n, 100 * (n + 1)),) for n in range(2)]
+        store.get_chunks('x', slices_list, self.x.dtype)
+        assert_equal(base._map.call_count, 1)
+        # Cached chunks are indexed locally, while others are partially read
+        index = np.index_exp[10:20]
+        assert_array_equal(store.get_partial_chunk('x', slices_list[1], self.x.dtype, index),
+                           self.x[110:120])
+        assert_array_equal(store.get_partial_chunk('x', (slice(200, 300),), self.x.dtype, index),
+                           self.x[210:220])
+        assert_equal(store.hits, 1)
+        assert_equal(store.misses, 3)
+        assert_false(os.path.exists(os.path.join(self.cachedir, 'x', '00200.npy')))
@@ -17,14 +17,18 @@
 """Tests for :py:mod:`katdal.chunkstore_npy`."""
 from __future__ import print_function, division, absolute_import
 
+import os
 import tempfile
 import shutil
 
+import mock
+import numpy as np
+from numpy.testing import assert_array_equal
 from nose import SkipTest
-from nose.tools import assert_raises
+from nose.tools import assert_raises, assert_equal, assert_false, assert_true
 
 from katdal.chunkstore_npy import NpyFileChunkStore
-from katdal.chunkstore import StoreUnavailable
+from katdal.chunkstore import StoreUnavailable, BadChunk
 from katdal.test.test_chunkstore import ChunkStoreTestBase
 
 
@@ -44,6 +48,23 @@ class TestNpyFileChunkStore(ChunkStoreTestBase):
     def test_store_unavailable(self):
         assert_raises(StoreUnavailable, NpyFileChunkStore, 'hahahahahaha')
 
+    def test_stats(self):
+        self.check_stats()
+
+    def test_corrupt_manifest(self):
+        array_name = self.array_name('corrupt_manifest')
+        x = np.arange(10.)
+        self.store.create_array(array_name)
+        self.store.put_chunk(array_name, np.index_exp[0:5], x[0:5])
+        with open(os.path.join(self.tempdir, array_name, 'manifest.json'), 'wb') as f:
+            f.write(b'garbage')
+        assert_raises(BadChunk, self.store.get_manifest, array_name)
+        # The dataset still opens, as the chunks are found by listing the store instead
+        with mock.patch('katdal.chunkstore.logger') as logger:
+            has_array = self.store.has_array(array_name, ((5, 5),), x.dtype)
+        assert_array_equal(has_array, [True, False])
+        assert_equal(logger.warning.call_count, 1)
+
 
 class TestNpyFileChunkStoreDirectWrite(TestNpyFileChunkStore):
     """Test NPY file functionality with O_DIRECT writes."""
@@ -58,3 +79,48 @@ class TestNpyFileChunkStoreDirectWrite(TestNpyFileChunkStore):
             if 'not supported' in str(e):
                 raise SkipTest(str(e))
             raise
+
+
+class TestNpyFileChunkStoreMmap(TestNpyFileChunkStore):
+    """Test NPY file functionality with memory-mapped reads."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store NPY files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = NpyFileChunkStore(cls.tempdir, mmap=True, prefetch=True)
+
+    def test_chunk_is_mapped(self):
+        x = np.arange(100.)
+        slices = np.index_exp[0:100]
+        self.store.create_array('mapped')
+        self.store.put_chunk('mapped', slices, x)
+        chunk = self.store.get_chunk('mapped', slices, x.dtype)
+        assert_array_equal(chunk, x)
+        assert_equal(type(chunk), np.ndarray)
+        assert_false(chunk.flags.writeable)
+        assert_false(chunk.flags.owndata)
+
+
+class TestNpyFileChunkStoreCodec(TestNpyFileChunkStore):
+    """Test NPY file functionality with compressed chunks."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store NPY files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = NpyFileChunkStore(cls.tempdir, codec='zlib')
+
+    def test_compressed_file(self):
+        x = np.zeros(10000, np.uint8)
+        slices = np.index_exp[0:10000]
+        self.store.create_array('compressed')
+        self.store.put_chunk('compressed', slices, x)
+        filename = os.path.join(self.tempdir, 'compressed', '00000.npy')
+        assert_true(os.path.getsize(filename) < 1000)
+        # Compressed chunks are detected by readers that don't know the codec
+        reader = NpyFileChunkStore(self.tempdir, mmap=True)
+        assert_array_equal(reader.get_chunk('compressed', slices, x.dtype), x)
+
+    def test_unknown_codec(self):
+        assert_raises(ValueError, NpyFileChunkStore, self.tempdir, codec='bogus')
@@ -0,0 +1,170 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunkstore_pack`."""
+from __future__ import print_function, division, absolute_import
+
+import os
+import tempfile
+import shutil
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose import SkipTest
+from nose.tools import assert_raises, assert_equal, assert_true, assert_false
+
+from katdal.chunkstore import StoreUnavailable, ChunkNotFound, BadChunk
+from katdal.chunkstore_pack import PackFileChunkStore, contains_packs
+from katdal.test.test_chunkstore import ChunkStoreTestBase
+
+
+def _make_store(path, **kwargs):
+    try:
+        return PackFileChunkStore(path, **kwargs)
+    except StoreUnavailable as e:
+        if 'pread' in str(e):
+            raise SkipTest(str(e))
+        raise
+
+
+class TestPackFileChunkStore(ChunkStoreTestBase):
+    """Test pack file functionality using a temporary directory."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store pack files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = _make_store(cls.tempdir)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.store.close()
+        shutil.rmtree(cls.tempdir)
+
+    def test_store_unavailable(self):
+        assert_raises(StoreUnavailable, PackFileChunkStore, 'hahahahahaha')
+
+    def test_stats(self):
+        self.check_stats()
+
+    def test_few_files(self):
+        self.store.create_array('packed')
+        for n in range(20):
+            self.store.put_chunk('packed', np.index_exp[n:n + 1, 0:5], np.full((1, 5), n))
+        array_dir = os.path.join(self.tempdir, 'packed')
+        assert_equal(sorted(os.path.splitext(fn)[1] for fn in os.listdir(array_dir)),
+                     ['.index', '.pack'])
+        assert_true(contains_packs(array_dir))
+        assert_false(contains_packs(self.tempdir))
+        assert_equal(len(self.store.list_chunk_ids('packed')), 20)
+
+    def test_reopen(self):
+        x = np.arange(60).reshape(6, 10)
+        self.store.create_array('reopen')
+        self.store.put_chunk('reopen', np.index_exp[0:3, 0:10], x[:3])
+        self.store.put_chunk('reopen', np.index_exp[3:6, 0:10], x[3:])
+        # Overwritten chunks are replaced by the last write
+        self.store.put_chunk('reopen', np.index_exp[0:3, 0:10], -x[:3])
+        reader = _make_store(self.tempdir)
+        assert_array_equal(reader.get_chunk('reopen', np.index_exp[0:3, 0:10], x.dtype), -x[:3])
+        assert_array_equal(reader.get_chunk('reopen', np.index_exp[3:6, 0:10], x.dtype), x[3:])
+        assert_raises(ChunkNotFound, reader.get_chunk, 'reopen', np.index_exp[6:9, 0:10], x.dtype)
+        # Chunks written after the reader indexed the array are also found
+        self.store.put_chunk('reopen', np.index_exp[6:9, 0:10], x[:3])
+        assert_array_equal(reader.get_chunk('reopen', np.index_exp[6:9, 0:10], x.dtype), x[:3])
+        out = np.empty((3, 10), x.dtype)
+        reader.get_chunk_into('reopen', np.index_exp[6:9, 0:10], x.dtype, out)
+        assert_array_equal(out, x[:3])
+        reader.close()
+
+    def test_rollover(self):
+        store = _make_store(self.tempdir, max_pack_size=500)
+        x = np.arange(100.)
+        store.create_array('rollover')
+        for n in range(4):
+            store.put_chunk('rollover', np.index_exp[100 * n:100 * (n + 1)], x + n)
+        array_dir = os.path.join(self.tempdir, 'rollover')
+        packs = [fn for fn in os.listdir(array_dir) if fn.endswith('.pack')]
+        assert_equal(len(packs), 4)
+        for n in range(4):
+            chunk = store.get_chunk('rollover', np.index_exp[100 * n:100 * (n + 1)], x.dtype)
+            assert_array_equal(chunk, x + n)
+        store.close()
+
+    def test_threaded_rollover(self):
+        store = _make_store(self.tempdir, max_pack_size=2000)
+        x = np.arange(100.)
+        store.create_array('threaded')
+
+        def put(n):
+            store.put_chunk('threaded', np.index_exp[100 * n:100 * (n + 1)], x + n)
+
+        pool = ThreadPool(8)
+        pool.map(put, range(200))
+        pool.close()
+        store.close()
+        array_dir = os.path.join(self.tempdir, 'threaded')
+        packs = [fn for fn in os.listdir(array_dir) if fn.endswith('.pack')]
+        assert_true(len(packs) > 5)
+        # Every chunk ends up intact in some pack, as seen by a fresh reader
+        reader = _make_store(self.tempdir)
+        for n in range(200):
+            chunk = reader.get_chunk('threaded', np.index_exp[100 * n:100 * (n + 1)], x.dtype)
+            assert_array_equal(chunk, x + n)
+        reader.close()
+
+    def test_truncated_pack(self):
+        store = _make_store(self.tempdir)
+        x = np.arange(100.)
+        slices = np.index_exp[0:100]
+        store.create_array('truncated')
+        store.put_chunk('truncated', slices, x)
+        store.close()
+        array_dir = os.path.join(self.tempdir, 'truncated')
+        pack = [fn for fn in os.listdir(array_dir) if fn.endswith('.pack')][0]
+        with open(os.path.join(array_dir, pack), 'r+b') as f:
+            f.truncate(100)
+        reader = _make_store(self.tempdir)
+        assert_raises(BadChunk, reader.get_chunk, 'truncated', slices, x.dtype)
+        reader.close()
+
+
+class TestPackFileChunkStoreCodec(TestPackFileChunkStore):
+    """Test pack file functionality with compressed chunks."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dir to store pack files and build ChunkStore on that."""
+        cls.tempdir = tempfile.mkdtemp()
+        cls.store = _make_store(cls.tempdir, codec='zlib')
+
+    def test_compressed_chunk(self):
+        x = np.zeros(10000, np.uint8)
+        slices = np.index_exp[0:10000]
+        self.store.create_array('compressed')
+        self.store.put_chunk('compressed', slices, x)
+        array_dir = os.path.join(self.tempdir, 'compressed')
+        sizes = [os.path.getsize(os.path.join(array_dir, fn))
+                 for fn in os.listdir(array_dir) if fn.endswith('.pack')]
+        assert_true(sum(sizes) < 1000)
+        # Compressed chunks are detected by readers that don't know the codec
+        reader = _make_store(self.tempdir)
+        assert_array_equal(reader.get_chunk('compressed', slices, x.dtype), x)
+        out = np.ones_like(x)
+        reader.get_chunk_into('compressed', slices, x.dtype, out)
+        assert_array_equal(out, x)
+        reader.close()
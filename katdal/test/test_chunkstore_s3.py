@@ -46,14 +46,16 @@ import contextlib
 import io
 
 import numpy as np
+import dask.array as da
 from nose import SkipTest
-from nose.tools import assert_raises, assert_equal, timed
+from nose.tools import assert_raises, assert_equal, assert_true, timed
 import mock
 import requests
 
-from katdal.chunkstore_s3 import S3ChunkStore, _AWSAuth, read_array
-from katdal.chunkstore import StoreUnavailable
+from katdal.chunkstore_s3 import S3ChunkStore, _AWSAuth, _Pool, _Executor, _byte_spans, read_array
+from katdal.chunkstore import StoreUnavailable, ChunkNotFound, BadChunk, ChunkStoreStats
 from katdal.test.test_chunkstore import ChunkStoreTestBase
+from katdal.fake_s3 import FakeS3Server
 
 
 def gethostbyname_slow(host):
@@ -98,6 +100,21 @@ class TestReadArray(object):
     def testFortran(self):
         self._test(np.arange(20).reshape(4, 5, 1).T)
 
+    def testOut(self):
+        array = np.arange(20).reshape(4, 5, 1)
+        fp = io.BytesIO()
+        np.save(fp, array)
+        fp.seek(0)
+        out = np.empty_like(array)
+        assert_true(read_array(fp, out) is out)
+        np.testing.assert_equal(array, out)
+        # Unsuitable destination arrays are ignored
+        fp.seek(0)
+        out = np.empty((4, 5, 2), array.dtype)[..., :1]
+        result = read_array(fp, out)
+        assert_true(result is not out)
+        np.testing.assert_equal(array, result)
+
     def testV2(self):
         # Make dtype that needs more than 64K to store, forcing .npy version 2.0
         dtype = np.dtype([('a' * 70000, np.float32), ('b', np.float32)])
@@ -118,6 +135,434 @@ class TestReadArray(object):
             read_array(fp)
 
 
+class TestPool(object):
+    def test_limit(self):
+        pool = _Pool(object, limit=2)
+        a = pool.get()
+        pool.get()
+        # A third item has to wait until one is returned to the pool
+        thread = threading.Thread(target=pool.get)
+        thread.start()
+        thread.join(0.05)
+        assert_true(thread.is_alive())
+        pool.put(a)
+        thread.join()
+
+    def test_discard_on_error(self):
+        pool = _Pool(object, limit=1)
+        with assert_raises(ValueError):
+            with pool():
+                raise ValueError('broken')
+        # The slot of the discarded item is available again
+        with pool() as item:
+            assert_true(item is not None)
+
+
+class TestS3ChunkStoreFake(ChunkStoreTestBase):
+    """Test S3 functionality against an in-process fake S3 service."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server()
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10, batch_size='4')
+        # Ensure that pagination is tested
+        cls.store.list_max_keys = 3
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.close()
+
+    def array_name(self, path):
+        bucket = 'katdal-unittest'
+        return self.store.join(bucket, path)
+
+    def test_stats(self):
+        self.check_stats()
+
+    def test_mark_complete_bucket(self):
+        bucket = 'katdal-manifest'
+        x = np.arange(10)
+        for array in ('a', 'b'):
+            self.store.create_array(self.store.join(bucket, array))
+            for start in (0, 5):
+                self.store.put_chunk(self.store.join(bucket, array), np.index_exp[start:start + 5],
+                                     x[start:start + 5])
+        self.store.mark_complete(bucket)
+        assert_true(self.store.is_complete(bucket))
+        for array in ('a', 'b'):
+            manifest = self.store.get_manifest(self.store.join(bucket, array))
+            assert_equal(manifest.starts, [[0, 5]])
+
+
+class TestS3ChunkStoreFakeRangeReads(TestS3ChunkStoreFake):
+    """Test S3 functionality with range reads against a fake S3 service."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server()
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10, range_reads=True)
+        cls.store.list_max_keys = 3
+
+
+class TestS3ChunkStoreFakeCodec(TestS3ChunkStoreFake):
+    """Test S3 functionality with compressed chunks against a fake S3 service."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server()
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10, codec='zlib')
+        cls.store.list_max_keys = 3
+
+    def test_range_reads_fall_back(self):
+        x = np.zeros((8, 100), np.float32)
+        slices = np.index_exp[0:8, 0:100]
+        self.store.create_array(self.array_name('compressed'))
+        self.store.put_chunk(self.array_name('compressed'), slices, x)
+        reader = S3ChunkStore.from_url(self.server.url, timeout=10, range_reads=True)
+        chunk = reader.get_partial_chunk(self.array_name('compressed'), slices,
+                                         x.dtype, np.index_exp[2:3, 10:20])
+        np.testing.assert_array_equal(chunk, x[2:3, 10:20])
+
+
+class TestS3ChunkStoreBatches(object):
+    """Test concurrent retrieval of batches of chunks."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server(latency=0.05)
+        cls.x = np.arange(64.)
+        store = S3ChunkStore.from_url(cls.server.url, timeout=10)
+        store.create_array('bucket/x')
+        for n in range(0, 64, 4):
+            store.put_chunk('bucket/x', np.index_exp[n:n + 4], cls.x[n:n + 4])
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.close()
+
+    def setup(self):
+        self.server.reset_counters()
+        # Hold the first request until another one joins it to prove overlap
+        self.server.hold_until = 2
+
+    def teardown(self):
+        self.server.hold_until = 0
+
+    def test_get_chunks(self):
+        store = S3ChunkStore.from_url(self.server.url, timeout=10, max_connections=16)
+        slices_list = [np.index_exp[n:n + 4] for n in range(0, 64, 4)]
+        chunks = store.get_chunks('bucket/x', slices_list, self.x.dtype)
+        np.testing.assert_array_equal(np.concatenate(chunks), self.x)
+        # The 16 requests were issued concurrently, without exceeding the pool
+        assert_equal(self.server.requests, 16)
+        assert_true(1 < self.server.max_in_flight <= 16)
+        slices_list.append(np.index_exp[64:68])
+        assert_raises(ChunkNotFound, store.get_chunks, 'bucket/x', slices_list, self.x.dtype)
+
+    def test_max_connections(self):
+        self.server.hold_until = 0
+        store = S3ChunkStore.from_url(self.server.url, timeout=10, max_connections=3)
+        slices_list = [np.index_exp[n:n + 4] for n in range(0, 64, 4)]
+        store.get_chunks('bucket/x', slices_list, self.x.dtype)
+        assert_true(self.server.max_in_flight <= 3)
+
+    def test_dask_array(self):
+        store = S3ChunkStore.from_url(self.server.url, timeout=10, batch_size=8)
+        # Include a missing chunk at the end to check that it becomes zeros
+        chunks = ((4,) * 17,)
+        darray = store.get_dask_array('bucket/x', chunks, self.x.dtype)
+        # One batch per dask task: 8 + 8 + 1 chunks
+        assert_equal(len([k for k in darray.dask if k[0].startswith('batch-')]), 3)
+        # Run with a single thread to show that concurrency comes from batches
+        out = darray.compute(scheduler='single-threaded')
+        np.testing.assert_array_equal(out, np.r_[self.x, np.zeros(4)])
+        assert_true(1 < self.server.max_in_flight <= 8)
+        # A partial selection only retrieves the relevant batches
+        self.server.reset_counters()
+        np.testing.assert_array_equal(darray[:8].compute(), self.x[:8])
+        assert_equal(self.server.requests, 8)
+
+
+class TestFakeS3Server(object):
+    """Test that the fake S3 service adds no latency of its own."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server()
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10)
+        cls.store.create_array('bucket/x')
+        cls.store.put_chunk('bucket/x', np.index_exp[0:10], np.arange(10.))
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.close()
+
+    def test_zero_latency(self):
+        durations = []
+        for n in range(20):
+            start = time.time()
+            self.store.get_chunk('bucket/x', np.index_exp[0:10], np.float64)
+            durations.append(time.time() - start)
+        # Delayed ACKs on keep-alive connections used to add about 40 ms to each request
+        assert_true(np.median(durations) < 0.01)
+
+
+class TestS3Listing(object):
+    """Test concurrent listing of chunks in key ranges against a fake S3 service."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server()
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10)
+        cls.store.list_max_keys = 7
+        cls.store.list_partitions = 4
+        cls.store.create_array('katdal-listing/x')
+        # Put the object keys straight into the fake bucket (they are not checked)
+        objects = cls.server.buckets['katdal-listing']
+        cls.x_ids = ['{:05d}_{:05d}'.format(t, f) for t in range(0, 300, 2) for f in (0, 16)]
+        # Indices too large for the usual index width should also be found
+        cls.x_ids += ['123456_00000']
+        for chunk_id in cls.x_ids:
+            objects['x/' + chunk_id + '.npy'] = b''
+        objects['x/complete'] = b''
+        objects['x-y/00000.npy'] = b''
+        objects['w/00000.npy'] = b''
+        objects['w/00001.npy'] = b''
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.close()
+
+    def setup(self):
+        self.server.reset_counters()
+
+    def test_partitioned(self):
+        chunk_ids = self.store.list_chunk_ids('katdal-listing/x')
+        assert_equal(sorted(chunk_ids), sorted(self.x_ids))
+        # One request for the first page, probes and at least one page per range
+        n_pages = len(self.x_ids) // self.store.list_max_keys
+        assert_true(self.server.list_requests > n_pages)
+        assert_true(self.server.list_requests < n_pages + 30)
+
+    def test_small(self):
+        assert_equal(sorted(self.store.list_chunk_ids('katdal-listing/w')), ['00000', '00001'])
+        assert_equal(self.server.list_requests, 1)
+
+    def test_bucket(self):
+        chunk_ids = self.store.list_chunk_ids('katdal-listing')
+        expected = ['x/' + chunk_id for chunk_id in self.x_ids]
+        expected += ['x-y/00000', 'w/00000', 'w/00001']
+        assert_equal(sorted(chunk_ids), sorted(expected))
+
+
+class TestS3HedgedRequests(object):
+    """Test hedged requests against a fake S3 service with occasional slow responses."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.slow_next = False
+        cls.server = FakeS3Server(latency=cls._latency)
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10, hedge_percentile='90')
+        cls.array_name = 'katdal-hedge/x'
+        cls.x = np.arange(100.)
+        cls.store.create_array(cls.array_name)
+        cls.store.put_chunk(cls.array_name, np.index_exp[0:100], cls.x)
+
+    @classmethod
+    def _latency(cls):
+        """Make the next request slow if requested (but not the ones after it)."""
+        if cls.slow_next:
+            cls.slow_next = False
+            return 2.0
+        return 0.005
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.close()
+
+    def setup(self):
+        # Start each test without latency history, so that nothing is hedged yet
+        self.store._latencies.clear()
+        self.store.hedges_fired = self.store.hedges_won = 0
+
+    def get(self):
+        chunk = self.store.get_chunk(self.array_name, np.index_exp[0:100], self.x.dtype)
+        np.testing.assert_array_equal(chunk, self.x)
+
+    def test_hedge_slow_request(self):
+        for n in range(self.store.hedge_min_samples):
+            self.get()
+        assert_equal(self.store.hedges_fired, 0)
+        # The next request is slow but its hedged duplicate is not
+        TestS3HedgedRequests.slow_next = True
+        start = time.time()
+        self.get()
+        assert_true(time.time() - start < 1.0)
+        assert_equal(self.store.hedges_fired, 1)
+        assert_equal(self.store.hedges_won, 1)
+
+    def test_hedge_measurement(self):
+        self.store.stats = ChunkStoreStats()
+        try:
+            for n in range(self.store.hedge_min_samples):
+                self.get()
+            chunk_bytes = self.store.stats.total('get').bytes // self.store.hedge_min_samples
+            TestS3HedgedRequests.slow_next = True
+            self.get()
+            # Only the winning request of the hedged pair is recorded
+            stats = self.store.stats.total('get')
+            assert_equal(stats.requests, self.store.hedge_min_samples + 1)
+            assert_equal(stats.bytes, (self.store.hedge_min_samples + 1) * chunk_bytes)
+            assert_equal(stats.retries, 0)
+        finally:
+            self.store.stats = None
+
+    def test_missing_chunk(self):
+        assert_raises(ChunkNotFound, self.store.get_chunk, self.array_name,
+                      np.index_exp[100:200], self.x.dtype)
+
+    def test_threads_are_reused(self):
+        for n in range(self.store.hedge_min_samples + 1):
+            self.get()
+        # Requests mostly reuse the thread of the previous request, apart from
+        # the odd hedge or a thread that has not quite finished its last request
+        executor = self.store._executor
+        with mock.patch.object(executor, '_worker', wraps=executor._worker) as worker:
+            for n in range(20):
+                self.get()
+        assert_true(worker.call_count <= 2 + 2 * self.store.hedges_fired)
+
+    def test_session_wait_is_not_latency(self):
+        store = S3ChunkStore.from_url(self.server.url, timeout=10, max_connections=1,
+                                      hedge_percentile=90)
+        session = store._session_pool.get()
+        thread = threading.Thread(target=store.get_chunk,
+                                  args=(self.array_name, np.index_exp[0:100], self.x.dtype))
+        thread.start()
+        # The request waits for the only session, which should not count as latency
+        time.sleep(0.2)
+        store._session_pool.put(session)
+        thread.join()
+        assert_equal(len(store._latencies), 1)
+        assert_true(store._latencies[0] < 0.1)
+
+
+class TestExecutor(object):
+    """Test the pool of reusable threads."""
+
+    def test_nested_submit(self):
+        executor = _Executor()
+        done = threading.Event()
+
+        def outer():
+            # The inner function gets its own thread instead of waiting for this one
+            inner_done = threading.Event()
+            executor.submit(inner_done.set)
+            inner_done.wait(5)
+            done.set()
+
+        executor.submit(outer)
+        assert_true(done.wait(5))
+
+    def test_idle_threads_exit(self):
+        executor = _Executor(idle_timeout=0.05)
+        done = threading.Event()
+        executor.submit(done.set)
+        assert_true(done.wait(5))
+        time.sleep(0.2)
+        assert_equal(executor._idle, 0)
+
+
+class TestByteSpans(object):
+    def _test(self, index, max_spans=64):
+        x = np.arange(4 * 5 * 6).reshape(4, 5, 6)
+        box_shape, spans, run_length, box_index = _byte_spans(index, x.shape, max_spans)
+        flat = x.ravel()
+        box = np.concatenate([flat[span:span + run_length] for span in spans])
+        np.testing.assert_array_equal(box.reshape(box_shape)[box_index], x[index])
+        return box_shape, len(spans)
+
+    def test_trailing_dims(self):
+        assert_equal(self._test(np.s_[1:3, :, :]), ((2, 5, 6), 1))
+        assert_equal(self._test(np.s_[1:3, 2:4, :]), ((2, 2, 6), 2))
+        assert_equal(self._test(np.s_[:, :, 2:3]), ((4, 5, 1), 20))
+        assert_equal(self._test(np.s_[2, 1, 4]), ((1, 1, 1), 1))
+
+    def test_strides_and_reversal(self):
+        assert_equal(self._test(np.s_[:, 3:0:-2, ::2]), ((4, 3, 5), 12))
+        assert_equal(self._test(np.s_[::-1, 4, :]), ((4, 1, 6), 4))
+
+    def test_max_spans(self):
+        # Too many spans: include the whole last dimension
+        assert_equal(self._test(np.s_[:, :, 2:3], max_spans=4), ((4, 5, 6), 1))
+        assert_equal(self._test(np.s_[1:3, 1:2, 2:3], max_spans=1), ((2, 5, 6), 1))
+
+
+class TestS3RangeReads(object):
+    """Test reading parts of chunks via HTTP range requests."""
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeS3Server()
+        cls.x = np.arange(8 * 64 * 6, dtype=np.complex64).reshape(8, 64, 6)
+        cls.store = S3ChunkStore.from_url(cls.server.url, timeout=10, range_reads='true')
+        cls.store.create_array('bucket/x')
+        cls.chunks = ((4, 4), (32, 32), (6,))
+        cls.darray = da.from_array(cls.x, cls.chunks)
+        cls.store.put_dask_array('bucket/x', cls.darray[:, :32]).compute()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.close()
+
+    def setup(self):
+        self.server.reset_counters()
+        self.store._header_lengths.clear()
+
+    def test_partial_chunk(self):
+        index = np.index_exp[1:3, 10:12, :]
+        chunk = self.store.get_partial_chunk('bucket/x', np.index_exp[0:4, 0:32, 0:6],
+                                             self.x.dtype, index)
+        np.testing.assert_array_equal(chunk, self.x[index])
+        # One request for the header and one per dump
+        assert_equal(self.server.requests, 3)
+        assert_equal(self.server.bytes_sent, 4096 + 2 * 2 * 6 * 8)
+
+    def test_dask_array(self):
+        darray = self.store.get_dask_array('bucket/x', self.chunks, self.x.dtype)
+        # The last 32 channels are missing and should become zeros
+        expected = self.x.copy()
+        expected[:, 32:] = 0
+        for index in [np.s_[:, 30:34], np.s_[5, 40:60, 2], np.s_[:, ::7, 1:3]]:
+            np.testing.assert_array_equal(darray[index].compute(), expected[index])
+        # Narrow selection only retrieves a small fraction of the data
+        self.server.reset_counters()
+        np.testing.assert_array_equal(darray[:, 20:22].compute(), expected[:, 20:22])
+        assert_equal(self.server.bytes_sent, 8 * 2 * 6 * 8)
+        # Missing chunks are detected by (small) header requests
+        self.server.reset_counters()
+        np.testing.assert_array_equal(darray[:, 40:42].compute(), expected[:, 40:42])
+        assert_equal(self.server.bytes_sent, 0)
+        # Full selection retrieves whole chunks
+        self.server.reset_counters()
+        np.testing.assert_array_equal(darray.compute(), expected)
+        assert_equal(self.server.requests, 4)
+
+    def test_bad_chunk(self):
+        slices = np.index_exp[4:8, 32:64, 0:6]
+        index = np.index_exp[1:2, :, :]
+        # Chunk with the expected shape but the wrong dtype
+        self.store.put_chunk('bucket/x', slices, self.x[slices].astype(np.complex128))
+        with assert_raises(BadChunk):
+            self.store.get_partial_chunk('bucket/x', slices, self.x.dtype, index)
+        # Once the header of a good chunk is known, the size is checked instead
+        self.store.get_partial_chunk('bucket/x', np.index_exp[0:4, 0:32, 0:6],
+                                     self.x.dtype, index)
+        with assert_raises(BadChunk):
+            self.store.get_partial_chunk('bucket/x', slices, self.x.dtype, index)
+        del self.server.buckets['bucket']['x/00004_00032_00000.npy']
+
+
 class TestS3ChunkStore(ChunkStoreTestBase):
     """Test S3 functionality against an actual (minio) S3 service."""
 
@@ -0,0 +1,115 @@
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for :py:mod:`katdal.chunkstore_tiered`."""
+from __future__ import print_function, division, absolute_import
+from builtins import object
+
+import tempfile
+import shutil
+
+import mock
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises
+
+from katdal.chunkstore import ChunkNotFound
+from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.chunkstore_dict import DictChunkStore
+from katdal.chunkstore_tiered import TieredChunkStore
+from katdal.test.test_chunkstore import ChunkStoreTestBase
+
+
+class TestTieredChunkStore(ChunkStoreTestBase):
+    """Test tiered store functionality on top of two NPY file stores."""
+
+    @classmethod
+    def setup_class(cls):
+        """Create temp dirs for both tiers, and build ChunkStore on that."""
+        cls.fastdir = tempfile.mkdtemp()
+        cls.slowdir = tempfile.mkdtemp()
+        cls.store = TieredChunkStore([NpyFileChunkStore(cls.fastdir),
+                                      NpyFileChunkStore(cls.slowdir)])
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.fastdir)
+        shutil.rmtree(cls.slowdir)
+
+
+class TestTieredChunkStorePromotion(object):
+    """Test local-first reads and promotion from a dict-based slow tier."""
+
+    def setup(self):
+        self.fastdir = tempfile.mkdtemp()
+        self.x = np.arange(1000.)
+        self.fast = NpyFileChunkStore(self.fastdir)
+        self.slow = DictChunkStore(x=self.x)
+        self.store = TieredChunkStore([self.fast, self.slow])
+
+    def teardown(self):
+        shutil.rmtree(self.fastdir)
+
+    def get(self, n):
+        slices = (slice(100 * n, 100 * (n + 1)),)
+        chunk = self.store.get_chunk('x', slices, self.x.dtype)
+        assert_array_equal(chunk, self.x[slices])
+
+    def test_promotion(self):
+        self.get(0)
+        self.get(0)
+        self.get(1)
+        assert_equal(self.store.tier_hits, [1, 2])
+        assert_equal(self.store.promotions, 2)
+        assert_true(self.fast.has_chunk('x', (slice(0, 100),), self.x.dtype))
+        # Promoted chunks are served by the fast tier even if the slow tier loses them
+        self.slow.arrays['x'] = np.zeros_like(self.x)
+        self.get(1)
+        assert_equal(self.store.tier_hits, [2, 2])
+
+    def test_no_promotion(self):
+        self.store.promote = False
+        self.get(0)
+        self.get(0)
+        assert_equal(self.store.tier_hits, [0, 2])
+        assert_false(self.fast.has_chunk('x', (slice(0, 100),), self.x.dtype))
+
+    def test_union(self):
+        self.get(2)
+        chunks = ((100,) * 10,)
+        assert_array_equal(self.store.has_array('x', chunks, self.x.dtype), np.ones(10, bool))
+        assert_true(self.store.has_chunk('x', (slice(0, 100),), self.x.dtype))
+        # The dict store cannot be listed, so only the fast tier is listed
+        assert_equal(self.store.list_chunk_ids('x'), ['00200'])
+        assert_raises(ChunkNotFound, self.store.get_chunk, 'y', (slice(0, 1),), self.x.dtype)
+
+    def test_slowest_tier_reading_strategy(self):
+        self.slow.batch_size = 4
+        self.slow.partial_reads = True
+        self.slow._map = mock.Mock(side_effect=lambda func, items: [func(item) for item in items])
+        store = TieredChunkStore([self.fast, self.slow])
+        assert_equal(store.batch_size, 4)
+        assert_true(store.partial_reads)
+        store.get_chunks('x', [(slice(0, 100),), (slice(100, 200),)], self.x.dtype)
+        assert_equal(self.slow._map.call_count, 1)
+        # Partial chunks come from the first tier that has them and are not promoted
+        index = np.index_exp[10:20]
+        assert_array_equal(store.get_partial_chunk('x', (slice(100, 200),), self.x.dtype, index),
+                           self.x[110:120])
+        assert_array_equal(store.get_partial_chunk('x', (slice(200, 300),), self.x.dtype, index),
+                           self.x[210:220])
+        assert_equal(store.tier_hits, [1, 3])
+        assert_false(self.fast.has_chunk('x', (slice(200, 300),), self.x.dtype))
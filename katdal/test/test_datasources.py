@@ -16,6 +16,8 @@
 
 """Tests for :py:mod:`katdal.datasources`."""
 from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()  # noqa: 402
 from builtins import object
 
 import tempfile
@@ -23,17 +25,25 @@ import shutil
 import os
 import random
 import itertools
+import urllib.parse
 
 import numpy as np
 from numpy.testing import assert_array_equal
-from nose.tools import assert_equal, assert_raises
+from nose.tools import (assert_equal, assert_raises, assert_is_instance, assert_true,
+                        assert_is_none)
 import dask.array as da
 import katsdptelstate
+from katsdptelstate.rdb_writer import RDBWriter
 
 from katdal.chunkstore import generate_chunks
 from katdal.chunkstore_npy import NpyFileChunkStore
-from katdal.datasources import ChunkStoreVisFlagsWeights, TelstateDataSource, view_l0_capture_stream
-from katdal.flags import DATA_LOST
+from katdal.chunkstore_pack import PackFileChunkStore
+from katdal.chunkstore_cache import CachingChunkStore
+from katdal.chunkstore_tiered import TieredChunkStore
+from katdal.datasources import (VisFlagsWeights, ChunkStoreVisFlagsWeights, TelstateDataSource,
+                                view_l0_capture_stream, infer_chunk_store,
+                                corrprod_to_autocorr, weight_power_scale)
+from katdal.flags import DATA_LOST, POSTPROC
 
 
 def ramp(shape, offset=1.0, slope=1.0, dtype=np.float_):
@@ -174,7 +184,7 @@ class TestChunkStoreVisFlagsWeights(object):
         assert_array_equal(vfw.flags.compute(), data['flags'])
         assert_array_equal(vfw.weights.compute(), weights)
 
-    def test_weight_power_scale(self):
+    def test_weight_power_scale(self, chunk_overrides=None):
         ants = 7
         index1, index2 = np.triu_indices(ants)
         inputs = ['m{:03}h'.format(i) for i in range(ants)]
@@ -202,15 +212,23 @@ class TestChunkStoreVisFlagsWeights(object):
         expected_scale[4, 5, index2 == 0] = 2.0**-32
 
         data, chunk_info = put_fake_dataset(
-            store, prefix, shape, array_overrides={'correlator_data': vis})
+            store, prefix, shape, chunk_overrides, array_overrides={'correlator_data': vis})
         vfw = ChunkStoreVisFlagsWeights(store, chunk_info, corrprods)
         weights = data['weights'] * data['weights_channel'][..., np.newaxis] * expected_scale
 
         # Check that data is as expected when accessed via VisFlagsWeights
         assert_equal(vfw.shape, data['correlator_data'].shape)
+        assert_equal(vfw.vis.chunks, chunk_info['correlator_data']['chunks'])
         assert_array_equal(vfw.vis.compute(), data['correlator_data'])
         assert_array_equal(vfw.flags.compute(), data['flags'])
         assert_array_equal(vfw.weights.compute(), weights)
+        # The standalone kernel scales weights in the same way
+        scaled = weight_power_scale(vis, data['weights'], *corrprod_to_autocorr(corrprods))
+        assert_array_equal(scaled, data['weights'] * expected_scale)
+
+    def test_weight_power_scale_baseline_chunks(self):
+        # Vis and weights split differently along the baseline axis are not rechunked
+        self.test_weight_power_scale({'correlator_data': (5, 16, 6), 'weights': (10, 32, 4)})
 
     def _test_missing_chunks(self, shape, chunk_overrides=None):
         # Put fake dataset into chunk store
@@ -261,6 +279,36 @@ class TestChunkStoreVisFlagsWeights(object):
                 'flags': (4, 15, 30)
             })
 
+    def test_fused_corrections(self):
+        ants = 4
+        index1, index2 = np.triu_indices(ants)
+        inputs = ['m{:03}h'.format(i) for i in range(ants)]
+        corrprods = np.array([(inputs[a], inputs[b]) for (a, b) in zip(index1, index2)])
+        store = NpyFileChunkStore(self.tempdir)
+        prefix = 'cb3'
+        shape = (10, 64, len(index1))
+        data, chunk_info = put_fake_dataset(store, prefix, shape, {'weights': (5, 16, 5)})
+        # Lose a chunk of weights to produce some DATA_LOST flags
+        chunk_name, _ = store.chunk_metadata(store.join(prefix, 'weights'), np.s_[5:10, 16:32, 0:5])
+        os.remove(os.path.join(store.path, chunk_name) + '.npy')
+        vfw = ChunkStoreVisFlagsWeights(store, chunk_info, corrprods)
+        # The generic implementation applies each step to the full arrays in turn
+        unfused = VisFlagsWeights(vfw.vis, vfw.flags, vfw.weights)
+        rs = np.random.RandomState(3)
+        correction = (rs.rand(*shape) + 1j * rs.rand(*shape)).astype(np.complex64)
+        correction[rs.rand(*shape) < 0.1] = np.nan
+        correction[0, 0] = 0
+        correction = da.from_array(correction, chunks=(3, 32, shape[2]))
+        for corr in (None, correction):
+            assert_array_equal(vfw.corrected_vis(corr), unfused.corrected_vis(corr))
+            assert_array_equal(vfw.corrected_weights(corr), unfused.corrected_weights(corr))
+            for select in (0xFF, 0, DATA_LOST, POSTPROC, 0x03):
+                flags = vfw.corrected_flags(corr, select)
+                assert_equal(flags.dtype, np.bool_)
+                assert_array_equal(flags, unfused.corrected_flags(corr, select))
+        assert_true(vfw.corrected_flags(None, DATA_LOST)[5:10, 16:32, 0:5].all().compute())
+        assert_true(vfw.corrected_flags(correction, POSTPROC).any().compute())
+
 
 class TestTelstateDataSource(object):
     def setup(self):
@@ -362,3 +410,103 @@ class TestTelstateDataSource(object):
             make_fake_datasource(self.telstate, self.store, self.cbid, l0_shape, l1_flags_shape)
         with assert_raises(ValueError):
             TelstateDataSource(view, cbid, sn, self.store)
+
+    def test_infer_caching_chunk_store(self):
+        shape = (20, 16, 40)
+        view, cbid, sn, l0_data, l1_flags_data = \
+            make_fake_datasource(self.telstate, self.store, self.cbid, shape)
+        cache_dir = os.path.join(self.tempdir, 'cache')
+        # Sizes in dataset URLs are strings
+        store = infer_chunk_store(None, view, npy_store_path=self.tempdir,
+                                  cache_dir=cache_dir, cache_size='1e6')
+        assert_is_instance(store, CachingChunkStore)
+        assert_equal(store.max_bytes, 1e6)
+        data_source = TelstateDataSource(view, cbid, sn, store)
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        assert_equal(store.misses, store.hits)
+
+    def test_infer_tiered_chunk_store(self):
+        shape = (20, 16, 40)
+        view, cbid, sn, l0_data, l1_flags_data = \
+            make_fake_datasource(self.telstate, self.store, self.cbid, shape)
+        local_dir = os.path.join(self.tempdir, 'local')
+        os.mkdir(local_dir)
+        store = infer_chunk_store(None, view, npy_store_path=self.tempdir,
+                                  local_store_path=local_dir)
+        assert_is_instance(store, TieredChunkStore)
+        data_source = TelstateDataSource(view, cbid, sn, store)
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        # The second pass is served entirely by the local store
+        hits = list(store.tier_hits)
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        assert_equal(store.tier_hits[1], hits[1])
+        assert_true(store.tier_hits[0] > hits[0])
+
+    def test_infer_pack_chunk_store(self):
+        shape = (20, 16, 40)
+        pack_dir = os.path.join(self.tempdir, 'packed')
+        os.mkdir(pack_dir)
+        pack_store = PackFileChunkStore(pack_dir)
+        view, cbid, sn, l0_data, l1_flags_data = \
+            make_fake_datasource(self.telstate, pack_store, self.cbid, shape)
+        rdb_path = os.path.join(pack_dir, cbid, cbid + '_sdp_l0.rdb')
+        store = infer_chunk_store(urllib.parse.urlparse('file://' + rdb_path), view)
+        assert_is_instance(store, PackFileChunkStore)
+        data_source = TelstateDataSource(view, cbid, sn, store)
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        pack_store.close()
+        store.close()
+
+    def test_cache_dir_from_url(self):
+        shape = (20, 16, 40)
+        make_fake_datasource(self.telstate, self.store, self.cbid, shape)
+        rdb_path = os.path.join(self.tempdir, 'cb_sdp_l0.rdb')
+        try:
+            writer = RDBWriter(client=self.telstate.backend)
+        except TypeError:
+            # katsdptelstate >= 0.10 binds the writer to the file instead
+            with RDBWriter(rdb_path) as writer:
+                writer.save(self.telstate)
+        else:
+            writer.save(rdb_path)
+        cache_dir = os.path.join(self.tempdir, 'cache')
+        query = 'capture_block_id=cb&stream_name=sdp_l0&npy_store_path={}&cache_dir={}'
+        url = 'file://{}?{}'.format(rdb_path, query.format(self.tempdir, cache_dir))
+        data_source = TelstateDataSource.from_url(url)
+        assert_is_instance(data_source.data.store, CachingChunkStore)
+        # Other local products can be kept next to the chunks in the URL's cache directory
+        assert_equal(data_source.cache_dir, cache_dir)
+        data_source = TelstateDataSource.from_url('file://' + rdb_path, capture_block_id='cb',
+                                                  stream_name='sdp_l0', npy_store_path=self.tempdir)
+        assert_is_none(data_source.cache_dir)
+
+    def test_infer_chunk_store_stats(self):
+        shape = (20, 16, 40)
+        view, cbid, sn, l0_data, l1_flags_data = \
+            make_fake_datasource(self.telstate, self.store, self.cbid, shape)
+        local_dir = os.path.join(self.tempdir, 'local')
+        os.mkdir(local_dir)
+        store = infer_chunk_store(None, view, npy_store_path=self.tempdir,
+                                  local_store_path=local_dir, chunk_stats_interval='60')
+        assert_equal(store.stats.log_interval, 60.0)
+        data_source = TelstateDataSource(view, cbid, sn, store)
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        gets = store.stats.total('get')
+        assert_true(gets.requests > 0)
+        assert_equal(gets.missing, 0)
+        # Only chunks retrieved from the inferred store (not the local one) are counted
+        np.testing.assert_array_equal(data_source.data.vis.compute(), l0_data['correlator_data'])
+        assert_equal(store.stats.total('get').requests, gets.requests)
+        store = infer_chunk_store(None, view, npy_store_path=self.tempdir)
+        assert_is_none(store.stats)
+
+    def test_infer_mmap_chunk_store(self):
+        shape = (20, 16, 40)
+        view, cbid, sn, l0_data, l1_flags_data = \
+            make_fake_datasource(self.telstate, self.store, self.cbid, shape)
+        store = infer_chunk_store(None, view, npy_store_path=self.tempdir, mmap='true')
+        assert_true(store.mmap)
+        data_source = TelstateDataSource(view, cbid, sn, store)
+        np.testing.assert_array_equal(data_source.data.vis[:, 3:5].compute(),
+                                      l0_data['correlator_data'][:, 3:5])
@@ -20,13 +20,19 @@ from builtins import object, range
 
 from numbers import Integral
 from functools import partial
+import tempfile
+import shutil
+import os
 
 import numpy as np
 import dask.array as da
-from nose.tools import assert_raises, assert_equal
+import mock
+from nose.tools import assert_raises, assert_equal, assert_true
 
 from katdal.lazy_indexer import (_range_to_slice, _simplify_index,
-                                 _dask_oindex, dask_getitem, DaskLazyIndexer)
+                                 _dask_oindex, dask_getitem, DaskLazyIndexer,
+                                 Prefetcher)
+from katdal.chunkstore_npy import NpyFileChunkStore
 
 
 def slice_to_range(s, l):
@@ -311,3 +317,226 @@ class TestDaskLazyIndexer(object):
         indexer.dataset
         indexer.add_transform(lambda x: 0 * x)
         np.testing.assert_array_equal(indexer[:], np.zeros_like(indexer))
+
+
+class TestDaskLazyIndexerDirectReads(object):
+    """Test reading chunks straight from a chunk store into the output."""
+    def setup(self):
+        shape = (10, 20, 30)
+        self.data = np.arange(np.product(shape)).reshape(shape)
+        self.tempdir = tempfile.mkdtemp()
+        self.store = NpyFileChunkStore(self.tempdir)
+        self.store.create_array('x')
+        data_dask = da.from_array(self.data, chunks=(2, 4, 30))
+        self.store.put_dask_array('x', data_dask).compute()
+        self.data_dask = self.store.get_dask_array('x', data_dask.chunks, self.data.dtype)
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _test_with(self, stage1=(), stage2=(), direct=True):
+        npy1 = numpy_oindex(self.data, stage1)
+        npy2 = numpy_oindex(npy1, stage2)
+        indexer = DaskLazyIndexer(self.data_dask, stage1)
+        assert_equal(indexer._direct_reads(stage2) is not None, direct)
+        np.testing.assert_array_equal(indexer[stage2], npy2)
+
+    def test_chunk_aligned(self):
+        self._test_with()
+        self._test_with(np.s_[2:8], np.s_[:, 4:12])
+        self._test_with(np.s_[[0, 1, 6, 7]], np.s_[:, :, :])
+        self._test_with(np.s_[[2, 3, 0, 1]])
+        self._test_with(np.s_[:, [True] * 8 + [False] * 4 + [True] * 8])
+
+    def test_not_chunk_aligned(self):
+        self._test_with(np.s_[1:8], direct=False)
+        self._test_with(np.s_[2:8], np.s_[:, :, 1:], direct=False)
+        self._test_with(np.s_[[3, 2]], direct=False)
+        self._test_with(np.s_[2:4], np.s_[0], direct=False)
+
+    def _destinations(self, chunks, stage1=(), stage2=()):
+        """Read selection of array stored with `chunks`, returning output and chunk destinations."""
+        self.store.create_array('y')
+        self.store.put_dask_array('y', da.from_array(self.data, chunks=chunks)).compute()
+        data_dask = self.store.get_dask_array('y', da.from_array(self.data, chunks).chunks,
+                                              self.data.dtype)
+        indexer = DaskLazyIndexer(data_dask, stage1)
+        with mock.patch.object(self.store, 'get_chunk_into',
+                               wraps=self.store.get_chunk_into) as get_chunk_into:
+            out = indexer[stage2]
+        np.testing.assert_array_equal(out, numpy_oindex(numpy_oindex(self.data, stage1), stage2))
+        return out, [call[0][3] for call in get_chunk_into.call_args_list]
+
+    def test_in_place_reads(self):
+        # Single dumps by channel ranges by all baselines, i.e. the usual visibility layout
+        out, destinations = self._destinations((1, 4, 30), np.s_[2:8], np.s_[:, 4:12])
+        assert_equal(len(destinations), 6 * 2)
+        assert_true(all(np.shares_memory(dest, out) for dest in destinations))
+        # Several dumps by all channels and baselines
+        out, destinations = self._destinations((2, 20, 30), np.s_[2:8])
+        assert_equal(len(destinations), 3)
+        assert_true(all(np.shares_memory(dest, out) for dest in destinations))
+
+    def test_staged_reads(self):
+        # Several dumps by a range of channels are not contiguous in the output
+        out, destinations = self._destinations((2, 4, 30), np.s_[2:8], np.s_[:, 4:12])
+        assert_equal(len(destinations), 3 * 2)
+        assert_true(not any(np.shares_memory(dest, out) for dest in destinations))
+        assert_true(all(dest.flags.c_contiguous for dest in destinations))
+
+    def test_missing_chunks_and_transforms(self):
+        os.remove(os.path.join(self.tempdir, 'x', '00002_00004_00000.npy'))
+        expected = self.data.copy()
+        expected[2:4, 4:8] = 0
+        indexer = DaskLazyIndexer(self.data_dask)
+        np.testing.assert_array_equal(indexer[:], expected)
+        indexer.add_transform(lambda x: 2 * x)
+        assert_true(indexer._direct_reads(()) is None)
+        np.testing.assert_array_equal(indexer[:], 2 * expected)
+
+    def test_mixed_get(self):
+        indexers = [DaskLazyIndexer(self.data_dask), DaskLazyIndexer(da.from_array(self.data, 3))]
+        out = [np.empty((4, 20, 30), self.data.dtype) for indexer in indexers]
+        DaskLazyIndexer.get(indexers, np.s_[4:8], out)
+        np.testing.assert_array_equal(out[0], self.data[4:8])
+        np.testing.assert_array_equal(out[1], self.data[4:8])
+
+
+class TestPrefetcher(object):
+    """Test the :class:`~katdal.lazy_indexer.Prefetcher` class."""
+    def setup(self):
+        shape = (10, 20, 30)
+        self.data = np.arange(np.product(shape)).reshape(shape)
+        self.flags = self.data % 3 == 0
+        self.prefetcher = Prefetcher(depth=2)
+        self.vis = DaskLazyIndexer(da.from_array(self.data, chunks=(1, 4, 5)),
+                                   np.s_[:, 2:], prefetcher=self.prefetcher)
+        self.flags_indexer = DaskLazyIndexer(da.from_array(self.flags, chunks=(2, 20, 30)),
+                                             np.s_[:, 2:], prefetcher=self.prefetcher)
+
+    def test_sequential(self):
+        arrays = [self.vis, self.flags_indexer]
+        for start in range(0, 10, 3):
+            keep = np.s_[start:start + 3, 1:5, 7]
+            vis, flags = DaskLazyIndexer.get(arrays, keep)
+            np.testing.assert_array_equal(vis, self.data[:, 2:][keep])
+            np.testing.assert_array_equal(flags, self.flags[:, 2:][keep])
+        # The first two blocks trigger the read-ahead
+        assert_equal(self.prefetcher.misses, 2)
+        assert_equal(self.prefetcher.hits, 2)
+        assert_equal(self.prefetcher.nbytes, 0)
+
+    def test_interleaved(self):
+        # Separate reads of each array in the loop are sequential per array
+        for start in range(0, 10, 2):
+            keep = np.s_[start:start + 2]
+            np.testing.assert_array_equal(self.vis[keep], self.data[:, 2:][keep])
+            np.testing.assert_array_equal(self.flags_indexer[keep], self.flags[:, 2:][keep])
+        # Each array misses its first two blocks and gets the rest read ahead
+        assert_equal(self.prefetcher.misses, 4)
+        assert_equal(self.prefetcher.hits, 6)
+        assert_equal(self.prefetcher.nbytes, 0)
+
+    def test_memory_limit(self):
+        self.prefetcher.max_bytes = 2 * 18 * 30 * self.data.itemsize
+        out = np.empty((2, 18, 30), self.data.dtype)
+        for start in range(0, 10, 2):
+            self.vis.get([self.vis], np.s_[start:start + 2], [out])
+            np.testing.assert_array_equal(out, self.data[start:start + 2, 2:])
+            assert_true(self.prefetcher.nbytes <= self.prefetcher.max_bytes)
+        assert_equal(self.prefetcher.misses, 2)
+        assert_equal(self.prefetcher.hits, 3)
+
+    def test_non_sequential(self):
+        for start in (0, 5, 1, 8, 4):
+            keep = np.s_[start:start + 2]
+            np.testing.assert_array_equal(self.vis[keep], self.data[:, 2:][keep])
+        # Changing the rest of the index restarts the sequence
+        np.testing.assert_array_equal(self.vis[6:8, 3], self.data[6:8, 5])
+        np.testing.assert_array_equal(self.vis[8:], self.data[8:, 2:])
+        # Fancy indices are passed through
+        np.testing.assert_array_equal(self.vis[[1, 3]], self.data[[1, 3], 2:])
+        assert_equal(self.prefetcher.hits, 0)
+        assert_equal(self.prefetcher.nbytes, 0)
+        # A transform invalidates blocks that were read ahead
+        self.vis[0:2]
+        self.vis[2:4]
+        self.vis.add_transform(lambda x: 2 * x)
+        np.testing.assert_array_equal(self.vis[4:6], 2 * self.data[4:6, 2:])
+        self.prefetcher.clear()
+        assert_equal(self.prefetcher.hits, 0)
+        assert_equal(self.prefetcher.nbytes, 0)
+
+
+class TestIterBlocks(object):
+    """Test :meth:`~katdal.lazy_indexer.DaskLazyIndexer.iter_blocks`."""
+    def setup(self):
+        shape = (10, 20, 30)
+        self.data = np.arange(np.product(shape)).reshape(shape)
+        self.flags = self.data % 3 == 0
+        self.vis = DaskLazyIndexer(da.from_array(self.data, chunks=(2, 4, 5)), np.s_[:, 2:])
+        self.flags_indexer = DaskLazyIndexer(da.from_array(self.flags, chunks=(4, 20, 30)),
+                                             np.s_[:, 2:])
+
+    def _iterate(self, axis=0, **kwargs):
+        arrays = [self.vis, self.flags_indexer]
+        indices = []
+        buffers = set()
+        for index, (vis, flags) in DaskLazyIndexer.iter_blocks(arrays, axis, **kwargs):
+            keep = (slice(None),) * axis + (index,)
+            np.testing.assert_array_equal(vis, self.data[:, 2:][keep])
+            np.testing.assert_array_equal(flags, self.flags[:, 2:][keep])
+            indices.append((index.start, index.stop))
+            buffers.add(id(vis.base if vis.base is not None else vis))
+        # Blocks are read into two alternating sets of buffers
+        assert_true(len(buffers) <= 2)
+        return indices
+
+    def test_aligned(self):
+        # Common chunk boundaries of the arrays along the first axis
+        assert_equal(self._iterate(), [(0, 4), (4, 8), (8, 10)])
+        assert_equal(self._iterate(block=9), [(0, 8), (8, 10)])
+        # Stretches between boundaries that exceed the block are split
+        assert_equal(self._iterate(block=3), [(0, 3), (3, 4), (4, 7), (7, 10)])
+        # Along the last axis the arrays share no chunk boundaries
+        assert_equal(self._iterate(axis=2, block=12), [(0, 12), (12, 24), (24, 30)])
+
+    def test_unaligned_and_max_bytes(self):
+        assert_equal(self._iterate(block=3, align=False), [(0, 3), (3, 6), (6, 9), (9, 10)])
+        assert_raises(ValueError, self._iterate, align=False)
+        dump_bytes = 18 * 30 * (self.data.itemsize + self.flags.itemsize)
+        indices = self._iterate(max_bytes=2 * 2 * dump_bytes)
+        assert_equal(indices, [(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)])
+
+    def test_direct_reads_and_errors(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            store = NpyFileChunkStore(tempdir)
+            store.create_array('x')
+            store.put_dask_array('x', da.from_array(self.data, chunks=(3, 20, 30))).compute()
+            x = DaskLazyIndexer(store.get_dask_array('x', ((3, 3, 3, 1), (20,), (30,)),
+                                                     self.data.dtype))
+            blocks = [(index, block[0].copy()) for index, block in DaskLazyIndexer.iter_blocks([x])]
+            assert_equal(len(blocks), 4)
+            for index, block in blocks:
+                np.testing.assert_array_equal(block, self.data[index])
+
+            # Errors while reading ahead are raised when the block is reached
+            def fail_late(block):
+                if block[0, 0, 0] >= 3000:
+                    raise ZeroDivisionError('Late failure')
+                return block
+
+            bad = DaskLazyIndexer(da.from_array(self.data, chunks=(5, 20, 30)))
+            bad.add_transform(partial(da.map_blocks, fail_late))
+            blocks = DaskLazyIndexer.iter_blocks([bad])
+            next(blocks)
+            assert_raises(ZeroDivisionError, next, blocks)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_mismatched_lengths(self):
+        other = DaskLazyIndexer(da.from_array(self.data[:5], chunks=2))
+        with assert_raises(ValueError):
+            list(DaskLazyIndexer.iter_blocks([self.vis, other]))
+        assert_equal(list(DaskLazyIndexer.iter_blocks([])), [])
@@ -18,6 +18,7 @@
 from __future__ import print_function, division, absolute_import
 from builtins import zip, range
 
+import os
 import logging
 
 import numpy as np
@@ -28,13 +29,13 @@ from .dataset import (DataSet, BrokenFile, Subarray, DEFAULT_SENSOR_PROPS,
                       DEFAULT_VIRTUAL_SENSORS, _robust_target,
                       _selection_to_list)
 from .datasources import VisFlagsWeights
+from .chunkstore import _as_bool
 from .spectral_window import SpectralWindow
 from .sensordata import SensorCache
 from .categorical import CategoricalData
-from .lazy_indexer import DaskLazyIndexer
-from .applycal import (add_applycal_sensors, calc_correction,
-                       apply_vis_correction, apply_weights_correction,
-                       apply_flags_correction, has_cal_product, CAL_PRODUCTS)
+from .lazy_indexer import DaskLazyIndexer, Prefetcher
+from .applycal import (add_applycal_sensors, calc_correction, apply_flags_correction,
+                       has_cal_product, CAL_PRODUCTS)
 from .flags import NAMES as FLAG_NAMES, DESCRIPTIONS as FLAG_DESCRIPTIONS
 
 
@@ -111,12 +112,21 @@ class VisibilityDataV4(DataSet):
         while the keyword 'all' means all available products will be applied.
         *NB* In future the default will probably change to 'all'.
         *NB* This is still very much an experimental feature...
+    applycal_cache : bool, optional
+        Keep the applycal corrections in an 'applycal' subdirectory of the
+        local chunk cache (the `cache_dir` keyword argument) and reuse them
+        when the dataset is opened again, until its cal solutions change
+    read_ahead : int, optional
+        When vis/flags/weights are read in consecutive blocks of dumps, read
+        this many blocks ahead in the background (the default is not to)
+    read_ahead_size : int or float, optional
+        Upper limit on the total size of blocks read ahead, in bytes
     kwargs : dict, optional
         Extra keyword arguments, typically meant for other formats and ignored
 
     """
     def __init__(self, source, ref_ant='', time_offset=0.0, applycal='',
-                 **kwargs):
+                 applycal_cache=False, read_ahead=0, read_ahead_size=1e9, **kwargs):
         DataSet.__init__(self, source.name, ref_ant, time_offset)
         attrs = source.metadata.attrs
 
@@ -330,7 +340,17 @@ class VisibilityDataV4(DataSet):
         # ------ Register applycal virtual sensors and products ------
 
         freqs = self.spectral_windows[0].channel_freqs
-        add_applycal_sensors(self.sensor, attrs, freqs)
+        corrections_dir = corrections_key = None
+        # Use the same cache directory as the chunk store (which may come from the URL)
+        cache_dir = getattr(source, 'cache_dir', None) or kwargs.get('cache_dir')
+        if _as_bool(applycal_cache):
+            if cache_dir:
+                corrections_dir = os.path.join(cache_dir, 'applycal')
+                corrections_key = '{}_{}'.format(getattr(source, 'capture_block_id', ''),
+                                                 getattr(source, 'stream_name', ''))
+            else:
+                logger.warning('No cache_dir given, so applycal corrections will not be cached')
+        add_applycal_sensors(self.sensor, attrs, freqs, corrections_dir, corrections_key)
         available_products = [product for product in CAL_PRODUCTS
                               if has_cal_product(self.sensor, attrs, product)]
         self._applycal = _selection_to_list(applycal, all=available_products)
@@ -341,9 +361,14 @@ class VisibilityDataV4(DataSet):
             self._corrections = calc_correction(self.source.data.vis.chunks, self.sensor,
                                                 self.subarrays[self.subarray].corr_products,
                                                 self._applycal)
-            corrected_vis = self._make_corrected(apply_vis_correction, self.source.data.vis)
-            corrected_flags = self._make_corrected(apply_flags_correction, self.source.data.flags)
-            corrected_weights = self._make_corrected(apply_weights_correction, self.source.data.weights)
+            # The data source may fuse the correction with other per-chunk processing
+            corrected_vis = self.source.data.corrected_vis(self._corrections)
+            # Keep the uint8 flag bits here, as the `flags` property does its
+            # own fused correction and flag type selection in _set_keep
+            raw_flags = self.source.data.flags
+            corrected_flags = da.core.elemwise(apply_flags_correction, raw_flags,
+                                               self._corrections, dtype=raw_flags.dtype)
+            corrected_weights = self.source.data.corrected_weights(self._corrections)
             name = self.source.data.name
             # Acknowledge that the applycal step is making the L1 product
             if 'sdp_l0' in name:
@@ -353,13 +378,14 @@ class VisibilityDataV4(DataSet):
             self._corrected = VisFlagsWeights(corrected_vis, corrected_flags, corrected_weights,
                                               name=name)
 
+        read_ahead = int(read_ahead)
+        self._prefetcher = Prefetcher(read_ahead, float(read_ahead_size)) \
+            if read_ahead > 0 else None
+
         # Apply default selection and initialise all members that depend
         # on selection in the process
         self.select(spw=0, subarray=0, ants=obs_ants)
 
-    def _make_corrected(self, apply_correction, data):
-        return da.core.elemwise(apply_correction, data, self._corrections, dtype=data.dtype)
-
     @property
     def _flags_keep(self):
         # Reverse flag indices as np.packbits has bit 0 as the MSB (we want LSB)
@@ -417,21 +443,23 @@ class VisibilityDataV4(DataSet):
         if not self.source.data:
             self._vis = self._weights = self._flags = None
         elif update_flags:
+            # Blocks read ahead for the old selection are of no further use
+            if self._prefetcher is not None:
+                self._prefetcher.clear()
             # Create first-stage index from dataset selectors. Note: use
             # the member variables, not the parameters, because the parameters
             # can be None to indicate no change
             stage1 = (self._time_keep, self._freq_keep, self._corrprod_keep)
             if update_all:
                 # Cache dask graphs for the data fields
-                self._vis = DaskLazyIndexer(self._corrected.vis, stage1)
-                self._weights = DaskLazyIndexer(self._corrected.weights, stage1)
-            flag_transforms = []
-            if ~self._flags_select != 0:
-                # Copy so that the lambda isn't affected by future changes
-                select = self._flags_select.copy()
-                flag_transforms.append(lambda flags: da.bitwise_and(select, flags))
-            flag_transforms.append(lambda flags: flags.view(np.bool_))
-            self._flags = DaskLazyIndexer(self._corrected.flags, stage1, flag_transforms)
+                self._vis = DaskLazyIndexer(self._corrected.vis, stage1,
+                                            prefetcher=self._prefetcher)
+                self._weights = DaskLazyIndexer(self._corrected.weights, stage1,
+                                                prefetcher=self._prefetcher)
+            # Apply correction and flag type selection in a single pass
+            flags = self.source.data.corrected_flags(self._corrections,
+                                                     int(self._flags_select[0]))
+            self._flags = DaskLazyIndexer(flags, stage1, prefetcher=self._prefetcher)
 
     @property
     def timestamps(self):
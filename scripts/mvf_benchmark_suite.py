@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Benchmark the throughput of katdal on synthetic MVF v4 datasets.
+
+This has three subcommands:
+
+  generate
+    Write a synthetic MVF v4 dataset (RDB file plus NPY chunks, including
+    calibration solutions for applycal) of configurable shape and chunking.
+  sweep
+    Time the loading of vis, weights and flags from synthetic datasets
+    (generated on demand) for all combinations of chunk shape, backend
+    (local NPY files or an in-process S3 stand-in with configurable latency
+    and bandwidth), dask worker count, joint vs separate loads and applycal
+    on / off, and write the results to a JSON file.
+  compare
+    Compare two JSON results files, e.g. produced by different versions
+    of katdal.
+
+Example::
+
+  mvf_benchmark_suite.py sweep --chunks 1,256 4,1024 --workers 4 16 \\
+      --s3-latency 0.02 --output new.json /tmp/benchmark
+  mvf_benchmark_suite.py compare old.json new.json
+"""
+from __future__ import print_function, division, absolute_import
+from builtins import range
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import logging
+
+import numpy as np
+import dask
+import dask.array as da
+import katsdptelstate
+from katsdptelstate.rdb_writer import RDBWriter
+
+import katdal
+from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.fake_s3 import FakeS3Server
+from katdal.lazy_indexer import DaskLazyIndexer
+
+
+CAPTURE_BLOCK_ID = '1234567890'
+STREAM_NAME = 'sdp_l0'
+ANTENNA_TEMPLATE = 'm{:03d}, -30:42:39.8, 21:26:38.0, 1035.0, 13.5, {} {} 0.0'
+TARGET = 'J1939-6342 | PKS1934-638, radec, 19:39:25.03, -63:42:45.6'
+# Bytes per visibility loaded (complex64 vis + uint8 flags + uint8 weights)
+BYTES_PER_VIS = 10
+
+logger = logging.getLogger('mvf_benchmark_suite')
+
+
+def chunk_shape(text):
+    """Parse chunk shape specified as 'DUMPS,CHANNELS'."""
+    try:
+        dumps, channels = [int(n) for n in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Chunk shape {!r} should be DUMPS,CHANNELS'.format(text))
+    return dumps, channels
+
+
+def dataset_path(workdir, shape, chunks):
+    """RDB file of synthetic dataset with given shape and chunks in `workdir`."""
+    name = 'synthetic_{}x{}x{}_{}x{}'.format(*(shape + chunks))
+    return os.path.join(workdir, name, CAPTURE_BLOCK_ID,
+                        '{}_{}.rdb'.format(CAPTURE_BLOCK_ID, STREAM_NAME))
+
+
+def _save_rdb(telstate, filename):
+    """Save `telstate` to RDB file (for both old and new katsdptelstate)."""
+    try:
+        writer = RDBWriter(client=telstate.backend)
+    except TypeError:
+        # katsdptelstate >= 0.10 binds the writer to the file instead
+        with RDBWriter(filename) as writer:
+            writer.save(telstate)
+    else:
+        writer.save(filename)
+
+
+def generate_dataset(rdb_path, n_dumps, n_chans, n_ants, chunks, dump_period=8.0,
+                     cal_n_chans=1024, seed=1):
+    """Write a synthetic MVF v4 dataset with RDB file at `rdb_path`.
+
+    The chunks are stored as NPY files next to the RDB file, with `chunks`
+    as (dumps, channels) per chunk (the baseline axis is not split).
+    """
+    store_path = os.path.dirname(os.path.dirname(rdb_path))
+    os.makedirs(os.path.dirname(rdb_path))
+    inputs = ['m{:03d}{}'.format(ant, pol) for ant in range(n_ants) for pol in 'hv']
+    bls_ordering = [(inp1, inp2) for ant1, ant2 in itertools.combinations_with_replacement(range(n_ants), 2)
+                    for inp1 in inputs[2 * ant1:2 * ant1 + 2]
+                    for inp2 in inputs[2 * ant2:2 * ant2 + 2]]
+    shape = (n_dumps, n_chans, len(bls_ordering))
+    dask_chunks = da.core.normalize_chunks(chunks + (shape[2],), shape)
+    random = da.random.RandomState(seed)
+    arrays = {
+        'correlator_data': (random.standard_normal(shape, chunks=dask_chunks) +
+                            1j * random.standard_normal(shape, chunks=dask_chunks)).astype(np.complex64),
+        'flags': (random.random_sample(shape, chunks=dask_chunks) < 0.01).astype(np.uint8),
+        'weights': random.randint(1, 256, shape, chunks=dask_chunks).astype(np.uint8),
+        'weights_channel': (random.random_sample(shape[:2], chunks=dask_chunks[:2]) +
+                            1.0).astype(np.float32)
+    }
+    # Write the chunks
+    store = NpyFileChunkStore(store_path)
+    prefix = '{}-{}'.format(CAPTURE_BLOCK_ID, STREAM_NAME.replace('_', '-'))
+    chunk_info = {}
+    results = []
+    for name, array in arrays.items():
+        array_name = store.join(prefix, name)
+        store.create_array(array_name)
+        results.append(store.put_dask_array(array_name, array))
+        chunk_info[name] = {'prefix': prefix, 'chunks': array.chunks, 'shape': array.shape,
+                            'dtype': np.lib.format.dtype_to_descr(array.dtype)}
+    for result_set in da.compute(*results):
+        for result in result_set.flat:
+            if result is not None:
+                raise result
+    for name in arrays:
+        store.mark_complete(store.join(prefix, name))
+
+    # Write the metadata
+    telstate = katsdptelstate.TelescopeState()
+    sync_time = 1.5e9
+    telstate['capture_block_id'] = CAPTURE_BLOCK_ID
+    telstate['stream_name'] = STREAM_NAME
+    telstate['sub_pool_resources'] = ','.join('m{:03d}'.format(ant) for ant in range(n_ants))
+    for ant in range(n_ants):
+        angle = 2 * np.pi * ant / n_ants
+        enu = (100 * np.cos(angle), 100 * np.sin(angle))
+        telstate['m{:03d}_observer'.format(ant)] = ANTENNA_TEMPLATE.format(ant, *enu)
+    telstate['sub_band'] = 'l'
+    telstate['obs_params'] = {'description': 'Synthetic dataset for benchmarks'}
+    telstate.add('obs_activity', 'track', ts=sync_time - 1.0)
+    telstate.add('cbf_target', TARGET, ts=sync_time - 1.0)
+    stream_view = telstate.view(STREAM_NAME)
+    stream_view['stream_type'] = 'sdp.vis'
+    stream_view['sync_time'] = sync_time
+    stream_view['int_time'] = dump_period
+    stream_view['bandwidth'] = 856e6
+    stream_view['center_freq'] = 1284e6
+    stream_view['n_chans'] = n_chans
+    stream_view['n_bls'] = len(bls_ordering)
+    stream_view['bls_ordering'] = np.array(bls_ordering)
+    stream_view['need_weights_power_scale'] = True
+    capture_stream_view = telstate.view(telstate.join(CAPTURE_BLOCK_ID, STREAM_NAME))
+    capture_stream_view['chunk_info'] = chunk_info
+    capture_stream_view['first_timestamp'] = 0.0
+    # Add calibration solutions: fixed delays and bandpasses, gains every 10 dumps
+    rs = np.random.RandomState(seed)
+    telstate['cal_antlist'] = ['m{:03d}'.format(ant) for ant in range(n_ants)]
+    telstate['cal_pol_ordering'] = ['h', 'v']
+    telstate['cal_center_freq'] = 1284e6
+    telstate['cal_bandwidth'] = 856e6
+    telstate['cal_n_chans'] = cal_n_chans
+    telstate.add('cal_product_K', 1e-9 * rs.standard_normal((2, n_ants)).astype(np.float32),
+                 ts=sync_time)
+    bandpass = np.exp(0.1j * rs.standard_normal((cal_n_chans, 2, n_ants))).astype(np.complex64)
+    telstate.add('cal_product_B', bandpass, ts=sync_time)
+    for dump in range(0, n_dumps, 10):
+        gains = np.exp(0.1j * rs.standard_normal((2, n_ants))).astype(np.complex64)
+        telstate.add('cal_product_G', gains, ts=sync_time + dump * dump_period)
+    _save_rdb(telstate, rdb_path)
+    return rdb_path
+
+
+def load_into_fake_s3(server, rdb_path):
+    """Copy the NPY chunks of the dataset at `rdb_path` into fake S3 `server`."""
+    store_path = os.path.dirname(os.path.dirname(rdb_path))
+    prefix = '{}-{}'.format(CAPTURE_BLOCK_ID, STREAM_NAME.replace('_', '-'))
+    bucket = server.buckets.setdefault(prefix, {})
+    prefix_path = os.path.join(store_path, prefix)
+    for array in os.listdir(prefix_path):
+        for filename in os.listdir(os.path.join(prefix_path, array)):
+            if filename.endswith('.npy'):
+                with open(os.path.join(prefix_path, array, filename), 'rb') as f:
+                    bucket[array + '/' + filename] = f.read()
+
+
+def time_reads(rdb_path, dumps_per_read, joint, applycal, workers, **kwargs):
+    """Time the loading of all vis, weights and flags in dataset (in seconds)."""
+    with dask.config.set(num_workers=workers):
+        f = katdal.open(rdb_path, applycal='all' if applycal else '', **kwargs)
+        # Trigger creation of the dask graphs, population of sensor cache for applycal etc
+        _ = (f.vis[0, 0, 0], f.weights[0, 0, 0], f.flags[0, 0, 0])
+        start = time.time()
+        for st in range(0, f.shape[0], dumps_per_read):
+            et = st + dumps_per_read
+            if joint:
+                DaskLazyIndexer.get([f.vis, f.weights, f.flags], np.s_[st:et])
+            else:
+                _ = (f.vis[st:et], f.weights[st:et], f.flags[st:et])
+        return time.time() - start, int(np.prod(f.shape)) * BYTES_PER_VIS
+
+
+def sweep(args):
+    """Run benchmarks over the parameter grid and write the results as JSON."""
+    results = []
+    shape = (args.dumps, args.channels, 2 * args.ants * (args.ants + 1))
+    server = FakeS3Server(latency=args.s3_latency, bandwidth=args.s3_bandwidth)
+    try:
+        for chunks in args.chunks:
+            rdb_path = dataset_path(args.workdir, shape, chunks)
+            if not os.path.exists(rdb_path):
+                logger.info('Generating dataset %s', rdb_path)
+                generate_dataset(rdb_path, args.dumps, args.channels, args.ants, chunks)
+            server.buckets.clear()
+            load_into_fake_s3(server, rdb_path)
+            backends = {'npy': {}, 's3': {'s3_endpoint_url': server.url}}
+            grid = itertools.product(args.backends, args.workers, (False, True), (False, True))
+            for backend, workers, joint, applycal in grid:
+                timings = [time_reads(rdb_path, args.time, joint, applycal, workers,
+                                      **backends[backend])
+                           for _ in range(args.repeats)]
+                # The fastest run is the least disturbed by other activity
+                seconds, nbytes = min(timings)
+                result = {'backend': backend, 'chunks': list(chunks), 'workers': workers,
+                          'joint': joint, 'applycal': applycal, 'seconds': seconds,
+                          'bytes': nbytes, 'mb_per_s': nbytes / seconds / 1e6}
+                logger.info('%s', result)
+                results.append(result)
+    finally:
+        server.close()
+    output = {'katdal_version': katdal.__version__,
+              'python_version': platform.python_version(),
+              'numpy_version': np.__version__,
+              'dask_version': dask.__version__,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'shape': list(shape),
+              'parameters': {'dumps_per_read': args.time, 'repeats': args.repeats,
+                             's3_latency': args.s3_latency, 's3_bandwidth': args.s3_bandwidth},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    logger.info('Wrote results to %s', args.output)
+
+
+def _result_key(result):
+    return (result['backend'], tuple(result['chunks']), result['workers'],
+            result['joint'], result['applycal'])
+
+
+def compare(args):
+    """Print throughput of matching benchmarks in two results files."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print('Old: katdal {} ({})'.format(old['katdal_version'], old['date']))
+    print('New: katdal {} ({})'.format(new['katdal_version'], new['date']))
+    if old['shape'] != new['shape'] or old['parameters'] != new['parameters']:
+        print('Warning: the datasets or parameters of the benchmarks differ')
+    old_results = {_result_key(result): result for result in old['results']}
+    print('{:7} {:>11} {:>7} {:>5} {:>8} {:>9} {:>9} {:>7}'.format(
+        'backend', 'chunks', 'workers', 'joint', 'applycal', 'old MB/s', 'new MB/s', 'ratio'))
+    for result in new['results']:
+        key = _result_key(result)
+        if key not in old_results:
+            continue
+        old_rate = old_results[key]['mb_per_s']
+        new_rate = result['mb_per_s']
+        print('{:7} {:>11} {:>7} {:>5} {:>8} {:9.1f} {:9.1f} {:7.2f}'.format(
+            key[0], '{}x{}'.format(*key[1]), key[2], str(key[3]), str(key[4]),
+            old_rate, new_rate, new_rate / old_rate))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the throughput of katdal on synthetic MVF v4 datasets')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    shape_parser = argparse.ArgumentParser(add_help=False)
+    shape_parser.add_argument('--dumps', type=int, default=64,
+                              help='Number of dumps in dataset [%(default)s]')
+    shape_parser.add_argument('--channels', type=int, default=4096,
+                              help='Number of channels in dataset [%(default)s]')
+    shape_parser.add_argument('--ants', type=int, default=8,
+                              help='Number of antennas in dataset [%(default)s]')
+
+    generate_parser = subparsers.add_parser(
+        'generate', parents=[shape_parser], help='Generate a synthetic dataset')
+    generate_parser.add_argument('--chunks', type=chunk_shape, default=(4, 1024),
+                                 metavar='DUMPS,CHANNELS',
+                                 help='Shape of each chunk [4,1024]')
+    generate_parser.add_argument('workdir', help='Directory in which to put dataset')
+
+    sweep_parser = subparsers.add_parser(
+        'sweep', parents=[shape_parser], help='Run benchmarks and save results')
+    sweep_parser.add_argument('--chunks', type=chunk_shape, nargs='+', default=[(4, 1024)],
+                              metavar='DUMPS,CHANNELS',
+                              help='Shapes of chunks to try [4,1024]')
+    sweep_parser.add_argument('--backends', nargs='+', choices=['npy', 's3'],
+                              default=['npy', 's3'], help='Chunk stores to try [all]')
+    sweep_parser.add_argument('--workers', type=int, nargs='+', default=[4, 16],
+                              help='Numbers of dask workers to try [%(default)s]')
+    sweep_parser.add_argument('--time', type=int, default=8,
+                              help='Number of dumps to read per batch [%(default)s]')
+    sweep_parser.add_argument('--repeats', type=int, default=3,
+                              help='Number of times to run each benchmark (keeping the '
+                              'fastest) [%(default)s]')
+    sweep_parser.add_argument('--s3-latency', type=float, default=0.01,
+                              help='Latency of each S3 request, in seconds [%(default)s]')
+    sweep_parser.add_argument('--s3-bandwidth', type=float,
+                              help='Bandwidth of each S3 request, in bytes per second [unlimited]')
+    sweep_parser.add_argument('--output', default='benchmark.json',
+                              help='JSON file in which to store results [%(default)s]')
+    sweep_parser.add_argument('workdir', help='Directory in which to keep datasets')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two sets of results')
+    compare_parser.add_argument('old', help='JSON file with reference results')
+    compare_parser.add_argument('new', help='JSON file with new results')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s [%(levelname)s] %(message)s')
+    if args.command == 'generate':
+        shape = (args.dumps, args.channels, 2 * args.ants * (args.ants + 1))
+        rdb_path = dataset_path(args.workdir, shape, args.chunks)
+        generate_dataset(rdb_path, args.dumps, args.channels, args.ants, args.chunks)
+        print(rdb_path)
+    elif args.command == 'sweep':
+        sweep(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (OSError, ValueError, KeyError) as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (c) 2019, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Recommend chunk shapes for the L0 stream of a dataset based on its use.
+
+The accesses are either read from a log (see
+:func:`katdal.chunk_advisor.load_access_log`) or generated by a declared
+workload. The best chunk shape is printed in the form of specs that can be
+passed straight to mvf_rechunk.py, e.g.::
+
+  mvf_rechunk.py $(mvf_chunk_advisor.py --workload per-channel-imaging --specs-only \\
+      1234567890_sdp_l0.rdb) 1234567890_sdp_l0.rdb /output/dir
+"""
+from __future__ import print_function, division, absolute_import
+
+import sys
+import argparse
+
+import numpy as np
+
+from katdal.chunk_advisor import (WORKLOADS, advise_chunks, estimate_reads,
+                                  workload_accesses, load_access_log)
+from katdal.datasources import TelstateDataSource
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Recommend chunk shapes (dumps and channels per chunk) for the L0 '
+        'stream of a dataset, based on a recorded access log or a declared workload.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--workload', choices=sorted(WORKLOADS),
+                       help='Declared workload')
+    group.add_argument('--access-log',
+                       help='File with one JSON selection per line, e.g. '
+                       '{"dumps": [0, 10], "channels": [0, 512]}')
+    parser.add_argument('--block', type=int, default=1,
+                        help='Dumps / channels / corrprods read at a time by workload [%(default)s]')
+    parser.add_argument('--min-chunk-size', type=float, default=1e6,
+                        help='Smallest acceptable chunk of visibilities, in bytes [%(default)s]')
+    parser.add_argument('--max-chunk-size', type=float, default=100e6,
+                        help='Largest acceptable chunk of visibilities, in bytes [%(default)s]')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Time per chunk request, in seconds [%(default)s]')
+    parser.add_argument('--bandwidth', type=float, default=100e6,
+                        help='Chunk retrieval rate, in bytes per second [%(default)s]')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of candidates to show [%(default)s]')
+    parser.add_argument('--specs-only', action='store_true',
+                        help='Only print the mvf_rechunk.py specs of the best candidate')
+    parser.add_argument('source', help='Input .rdb file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Lightweight open with no data - just to get the chunk info
+    ds = TelstateDataSource.from_url(args.source, upgrade_flags=False, chunk_store=None)
+    chunk_info = ds.telstate['chunk_info']
+    vis_info = chunk_info['correlator_data']
+    shape = tuple(vis_info['shape'])
+    # Weigh the arrays that are read along with the visibilities by their share per visibility
+    itemsize = 0.0
+    for info in chunk_info.values():
+        array_shape = tuple(info['shape'])
+        itemsize += np.dtype(info['dtype']).itemsize * np.prod(array_shape) / np.prod(shape)
+    if args.workload:
+        accesses = workload_accesses(shape, args.workload, args.block)
+    else:
+        accesses = load_access_log(args.access_log)
+    vis_itemsize = np.dtype(vis_info['dtype']).itemsize
+    advice = advise_chunks(shape, itemsize, accesses,
+                           min_chunk_size=args.min_chunk_size * itemsize / vis_itemsize,
+                           max_chunk_size=args.max_chunk_size * itemsize / vis_itemsize,
+                           latency=args.latency, bandwidth=args.bandwidth,
+                           n_arrays=len(chunk_info))
+    if not advice:
+        raise ValueError('No chunk shape fits the chunk size limits')
+    best = advice[0]
+    specs = ['{}/{}:{},{}'.format(ds.stream_name, array, best.chunks[0], best.chunks[1])
+             for array in sorted(chunk_info)]
+    if args.specs_only:
+        print(' '.join(specs))
+        return
+
+    print('Dataset {} has shape {} and {} accesses'.format(args.source, shape, len(accesses)))
+    bytes_read, requests, bytes_selected = estimate_reads(vis_info['chunks'], accesses, itemsize)
+    requests *= len(chunk_info)
+    current_cost = requests * args.latency + bytes_read / args.bandwidth
+    current_chunks = tuple(max(c) for c in vis_info['chunks'])
+    row = '{:>10} {:>10} {:>12} {:>14} {:>12} {:>10} {:>12}'
+    print(row.format('dumps', 'channels', 'chunk MB', 'MB read', 'requests',
+                     'efficiency', 'est. time s'))
+    print(row.format(current_chunks[0], current_chunks[1], '(current)',
+                     '{:.1f}'.format(bytes_read / 1e6), requests,
+                     '{:.3f}'.format(bytes_selected / bytes_read if bytes_read else 1.0),
+                     '{:.1f}'.format(current_cost)))
+    for candidate in advice[:args.top]:
+        print(row.format(candidate.chunks[0], candidate.chunks[1],
+                         '{:.1f}'.format(candidate.chunk_bytes / itemsize * vis_itemsize / 1e6),
+                         '{:.1f}'.format(candidate.bytes_read / 1e6), candidate.requests,
+                         '{:.3f}'.format(candidate.efficiency),
+                         '{:.1f}'.format(candidate.cost)))
+    print()
+    print('mvf_rechunk.py specs for best candidate:')
+    print(' '.join(specs))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (OSError, ValueError, KeyError) as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
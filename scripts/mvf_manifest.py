@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""Write chunk manifests for an existing MVF dataset.
+
+A manifest records which chunks of an array are present in the chunk store,
+so that opening the dataset does not have to list the store.
+"""
+
+from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()  # noqa: 402
+
+import sys
+import argparse
+import urllib.parse
+
+from katdal.chunkstore import ChunkStoreError
+from katdal.datasources import TelstateDataSource, view_capture_stream, infer_chunk_store
+
+
+def comma_list(value):
+    return value.split(',')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Write a chunk manifest for each array of a single capture block, '
+        'which speeds up subsequent opening of the dataset.')
+    parser.add_argument('--streams', type=comma_list, metavar='STREAM,STREAM',
+                        help='Streams to process [all]')
+    parser.add_argument('source', help='Input .rdb file or URL')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Lightweight open with no data - just to create telstate and identify the CBID
+    ds = TelstateDataSource.from_url(args.source, upgrade_flags=False, chunk_store=None)
+    cbid = ds.capture_block_id
+    telstate = ds.telstate.root().view(cbid)
+    streams = args.streams or telstate.get('sdp_archived_streams', [])
+    if not streams:
+        raise RuntimeError('Source dataset does not contain any streams')
+    url_parts = urllib.parse.urlparse(args.source, scheme='file')
+    kwargs = dict(urllib.parse.parse_qsl(url_parts.query))
+    for stream_name in streams:
+        sts = view_capture_stream(telstate, cbid, stream_name)
+        try:
+            chunk_info = sts['chunk_info']
+        except KeyError as exc:
+            raise RuntimeError('Could not get chunk info for {!r}: {}'.format(stream_name, exc))
+        for array_name, array_info in chunk_info.items():
+            store = infer_chunk_store(url_parts, sts, array=array_name, **kwargs)
+            full_name = store.join(array_info['prefix'], array_name)
+            try:
+                manifests = store.write_manifest(full_name)
+            except NotImplementedError:
+                raise RuntimeError('Chunk store of {!r} does not support manifests'
+                                   .format(full_name))
+            n_chunks = sum(len(manifest) for manifest in manifests.values())
+            print('{}: {} chunks'.format(full_name, n_chunks))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (RuntimeError, ChunkStoreError) as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
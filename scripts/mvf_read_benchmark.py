@@ -21,6 +21,11 @@ parser.add_argument('--dumps', type=int, help='Number of times to read')
 parser.add_argument('--joint', action='store_true', help='Load vis, weights, flags together')
 parser.add_argument('--applycal', help='Calibration solutions to apply')
 parser.add_argument('--workers', type=int, help='Number of dask workers')
+parser.add_argument('--read-ahead', type=int, default=0,
+                    help='Number of batches to read ahead in the background')
+parser.add_argument('--stream', action='store_true',
+                    help='Iterate over vis, weights, flags together in chunk-aligned blocks '
+                         'of up to --time dumps, reading the next block in the background')
 args = parser.parse_args()
 
 logging.basicConfig(level='INFO', format='%(asctime)s [%(levelname)s] %(message)s')
@@ -30,6 +35,8 @@ logging.info('Starting')
 kwargs = {}
 if args.applycal is not None:
     kwargs['applycal'] = args.applycal
+if args.read_ahead:
+    kwargs['read_ahead'] = args.read_ahead
 f = katdal.open(args.filename, **kwargs)
 logging.info('File loaded, shape %s', f.shape)
 if args.channels:
@@ -40,15 +47,20 @@ if args.dumps:
 _ = (f.vis[0, 0, 0], f.weights[0, 0, 0], f.flags[0, 0, 0])
 logging.info('Selection complete')
 start = time.time()
-for st in range(0, f.shape[0], args.time):
-    et = st + args.time
-    if args.joint:
-        vis, weights, flags = DaskLazyIndexer.get([f.vis, f.weights, f.flags], np.s_[st:et])
-    else:
-        vis = f.vis[st:et]
-        weights = f.weights[st:et]
-        flags = f.flags[st:et]
-    logging.info('Loaded %d dumps', vis.shape[0])
+if args.stream:
+    for index, (vis, weights, flags) in DaskLazyIndexer.iter_blocks([f.vis, f.weights, f.flags],
+                                                                    block=args.time):
+        logging.info('Loaded %d dumps', vis.shape[0])
+else:
+    for st in range(0, f.shape[0], args.time):
+        et = st + args.time
+        if args.joint:
+            vis, weights, flags = DaskLazyIndexer.get([f.vis, f.weights, f.flags], np.s_[st:et])
+        else:
+            vis = f.vis[st:et]
+            weights = f.weights[st:et]
+            flags = f.flags[st:et]
+        logging.info('Loaded %d dumps', vis.shape[0])
 size = np.product(f.shape) * 10
 elapsed = time.time() - start
 logging.info('Loaded %d bytes in %.3f s (%.3f MB/s)', size, elapsed, size / elapsed / 1e6)
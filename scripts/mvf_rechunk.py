@@ -19,9 +19,10 @@ import numpy as np
 import dask
 import dask.array as da
 
-from katdal.chunkstore import ChunkStoreError
+from katdal.chunkstore import ChunkStoreError, available_codecs
 from katdal.chunkstore_s3 import S3ChunkStore
 from katdal.chunkstore_npy import NpyFileChunkStore
+from katdal.chunkstore_pack import PackFileChunkStore
 from katdal.datasources import TelstateDataSource, view_capture_stream, infer_chunk_store
 from katdal.flags import DATA_LOST
 from katdal.applycal import from_block_function    # TODO: get from dask once available there
@@ -90,6 +91,11 @@ def parse_args():
                         help='Streams to copy [all]')
     parser.add_argument('--s3-endpoint-url', help='URL where rechunked data will be uploaded')
     parser.add_argument('--new-prefix', help='Replacement for capture block ID in output bucket names')
+    parser.add_argument('--codec', choices=available_codecs(),
+                        help='Compress output chunks with this codec [none]')
+    parser.add_argument('--pack', action='store_true',
+                        help='Append output chunks to a few large pack files per array '
+                        'instead of writing a separate NPY file per chunk')
     parser.add_argument('source', help='Input .rdb file')
     parser.add_argument('dest', help='Output directory')
     parser.add_argument('spec', nargs='*', default=[], type=RechunkSpec,
@@ -183,19 +189,31 @@ def main():
         arrays[key].data = arrays[key].data.rechunk({0: spec.time, 1: spec.freq})
 
     # Write out the new data
-    dest_store = NpyFileChunkStore(args.dest)
+    if args.pack:
+        dest_store = PackFileChunkStore(args.dest, codec=args.codec)
+    else:
+        dest_store = NpyFileChunkStore(args.dest, codec=args.codec)
     stores = []
     for array in arrays.values():
         full_name = dest_store.join(array.chunk_info['prefix'], array.array_name)
         dest_store.create_array(full_name)
         stores.append(dest_store.put_dask_array(full_name, array.data))
         array.chunk_info['chunks'] = array.data.chunks
+        # Record the codec so that readers know what to expect
+        array.chunk_info.pop('codec', None)
+        if args.codec is not None:
+            array.chunk_info['codec'] = args.codec
     stores = da.compute(*stores)
     # put_dask_array returns an array with an exception object per chunk
     for result_set in stores:
         for result in result_set.flat:
             if result is not None:
                 raise result
+    # Record the chunks that were written so that readers need not list them
+    for array in arrays.values():
+        dest_store.write_manifest(dest_store.join(array.chunk_info['prefix'], array.array_name))
+    if args.pack:
+        dest_store.close()
 
     # Fix up chunk_info for new chunking
     for stream_name in streams: